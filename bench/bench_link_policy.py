@@ -0,0 +1,97 @@
+"""
+Microbenchmark: DomainTrie (reversed-label suffix index) vs a linear rule scan.
+
+    python bench/bench_link_policy.py [rules] [lookups]
+
+Imports bot.py only for DomainTrie/_split_url; no network is touched.
+"""
+import os
+import random
+import string
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("SNAPSHOT_CACHE", "0")
+os.environ.setdefault("PERSIST_WORKER", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+TLDS = ["com", "net", "io", "org", "xyz", "co", "me"]
+
+
+def rand_label(rng, n=None):
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(n or rng.randint(3, 10)))
+
+
+def make_rules(rng, n):
+    rules = []
+    for i in range(n):
+        host = f"{rand_label(rng)}.{rng.choice(TLDS)}"
+        if i % 10 == 0:
+            host = f"{rand_label(rng)}.{host}"
+        if i % 25 == 0:
+            host = f"{host}/{rand_label(rng)}"
+        rules.append((host, "deny" if i % 3 else "allow"))
+    return rules
+
+
+def make_urls(rng, rules, n):
+    urls = []
+    for i in range(n):
+        if i % 2 and rules:
+            host = rng.choice(rules)[0].split("/")[0]
+            urls.append(f"https://{rand_label(rng, 4)}.{host}/{rand_label(rng)}?q=1")
+        else:
+            urls.append(f"https://{rand_label(rng)}.{rng.choice(TLDS)}/{rand_label(rng)}")
+    return urls
+
+
+def linear_match(rules, host, path):
+    best, best_key = None, (-1, -1)
+    for rule, verdict in rules:
+        rhost, _, rpath = rule.partition("/")
+        rpath = "/" + rpath if rpath else ""
+        if not (host == rhost or host.endswith("." + rhost)):
+            continue
+        if rpath and not (path == rpath or path.startswith(rpath + "/")):
+            continue
+        key = (len(rhost), len(rpath))
+        if key > best_key:
+            best, best_key = verdict, key
+    return best
+
+
+def bench(n_rules, n_lookups, seed=7):
+    rng = random.Random(seed)
+    rules = [(bot.normalize_domain_rule(r), v) for r, v in make_rules(rng, n_rules)]
+    urls = make_urls(rng, rules, n_lookups)
+    parsed = [bot._split_url(u) for u in urls]
+
+    t0 = time.perf_counter()
+    trie = bot.DomainTrie(rules)
+    build_ms = (time.perf_counter() - t0) * 1000.0
+
+    t0 = time.perf_counter()
+    got = [trie.match(h, p) for h, p in parsed]
+    trie_s = time.perf_counter() - t0
+
+    n_lin = min(len(parsed), 2000)
+    t0 = time.perf_counter()
+    want = [linear_match(rules, h, p) for h, p in parsed[:n_lin]]
+    lin_s = time.perf_counter() - t0
+
+    assert got[:n_lin] == want, "trie and linear scan disagree"
+    print(
+        f"rules={n_rules:>6} build={build_ms:7.1f}ms "
+        f"trie={trie_s / len(parsed) * 1e6:6.2f}us/lookup "
+        f"linear={lin_s / n_lin * 1e6:9.2f}us/lookup"
+    )
+
+
+if __name__ == "__main__":
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [100, 1000, 5000, 20000]
+    for n in sizes:
+        bench(n, lookups)
@@ -0,0 +1,113 @@
+"""
+Microbenchmark: premium emoji entity builder over the bot's real panel / command texts.
+
+    python bench/bench_premium_emoji.py [rounds]
+
+Compares the previous per-emoji text.find loop (code-point offsets) with the single-pass
+scanner (raw scan, and apply_premium_emoji_entities with its per-text cache), and checks
+that every entity lands on its emoji in UTF-16 units.
+No network is touched; every PREMIUM_EMOJI_MAP entry gets a fake custom_emoji_id.
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("SNAPSHOT_CACHE", "0")
+os.environ.setdefault("PERSIST_WORKER", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+def legacy_entities(text):
+    # previous implementation: one text.find sweep per emoji, offsets in code points
+    entities = []
+    for emoji, custom_id in bot.PREMIUM_EMOJI_MAP.items():
+        if not custom_id:
+            continue
+        start = 0
+        while True:
+            idx = text.find(emoji, start)
+            if idx == -1:
+                break
+            entities.append({"type": "custom_emoji", "offset": idx, "length": len(emoji), "custom_emoji_id": custom_id})
+            start = idx + len(emoji)
+    return entities or None
+
+
+def panel_texts():
+    texts = [bot.HELP_TEXT, "🤖 歡迎使用 10K DOG - Jarvis", "🤖 10K DOG - Jarvis"]
+    for v in bot.COMMANDS.values():
+        texts.append(v["text"] if isinstance(v, dict) else v)
+    for title, _ in bot._NAV_PANELS.values():
+        texts.append(title)
+    texts.extend(prompt for _, _, prompt in bot._INPUT_PROMPTS.values())
+    for markup in (bot.main_menu(), bot.admin_main_panel(), bot.admin_admin_panel(bot.SUPER_ADMIN)):
+        texts.extend(btn["text"] for row in markup["inline_keyboard"] for btn in row)
+    texts.append(
+        "🔍 用戶 UID 查詢結果\n\n👤 姓名：𝙅𝙖𝙧𝙫𝙞𝙨 🐶\n🔢 UID：8126033106\n📧 用戶名：@tenkdog"
+    )
+    texts.append(
+        "📊 操作紀錄\n\n📊 最近操作紀錄：\n\n"
+        + "".join(f"⏰ 10/{d:02d} 12:00 | 👤 管理員 | wl_add | {{'chat_id': -100123}}\n" for d in range(1, 13))
+    )
+    return [t for t in texts if t]
+
+
+def check_utf16(text, entities):
+    u16 = text.encode("utf-16-le")
+    ids = {cid: e for e, cid in bot.PREMIUM_EMOJI_MAP.items()}
+    for ent in entities or ():
+        got = u16[ent["offset"] * 2:(ent["offset"] + ent["length"]) * 2].decode("utf-16-le")
+        assert got == ids[ent["custom_emoji_id"]], (got, ent)
+
+
+def timeit(fn, texts, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - t0) / (rounds * len(texts)) * 1e6
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for i, emoji in enumerate(list(bot.PREMIUM_EMOJI_MAP)):
+        bot.PREMIUM_EMOJI_MAP[emoji] = str(5368324170671202000 + i)
+    bot.invalidate_premium_emoji()
+    texts = panel_texts()
+
+    shifted = 0
+    for t in texts:
+        _, ents = bot.apply_premium_emoji_entities(t)
+        check_utf16(t, ents)
+        old = sorted((e["offset"], e["custom_emoji_id"]) for e in legacy_entities(t) or ())
+        shifted += old != [(e["offset"], e["custom_emoji_id"]) for e in ents or ()]
+
+    _, regex, by_first = bot._premium_scanner()
+
+    def scan(t):
+        return bot._scan_premium_emoji(t, regex, by_first)
+
+    print(f"texts={len(texts)} emojis_with_id={len(bot.PREMIUM_EMOJI_MAP)}")
+    print(f"texts whose entities differ from the legacy builder (UTF-16 shift / overlap): {shifted}")
+    print(f"{'texts':<18} {'n':>3} {'chars':>6} {'legacy':>9} {'scan':>9} {'cached':>9}  (us/text)")
+    groups = [
+        ("short (<80 chars)", [t for t in texts if len(t) < 80]),
+        ("long (>=80 chars)", [t for t in texts if len(t) >= 80]),
+        ("all", texts),
+    ]
+    for label, group in groups:
+        if not group:
+            continue
+        legacy_us = timeit(legacy_entities, group, rounds)
+        scan_us = timeit(scan, group, rounds)
+        cached_us = timeit(bot.apply_premium_emoji_entities, group, rounds)
+        chars = sum(len(t) for t in group) / len(group)
+        print(f"{label:<18} {len(group):>3} {chars:>6.0f} {legacy_us:>9.2f} {scan_us:>9.2f} {cached_us:>9.2f}")
+    print("cache", bot.PREMIUM_ENTITY_CACHE.stats())
+
+
+if __name__ == "__main__":
+    main()
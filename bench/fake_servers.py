@@ -0,0 +1,241 @@
+"""
+Local stand-ins for the Telegram Bot API and the GitHub Gist API.
+
+Both run as in-process threaded HTTP servers on 127.0.0.1 with configurable latency,
+error injection and (Telegram) 429 responses. Point the bot at them with
+TG_API_BASE / GITHUB_API_BASE before importing bot.py.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_TG_PATH = re.compile(r"^/bot[^/]*/(\w+)$")
+_GIST_PATH = re.compile(r"^/gists/([^/?]+)$")
+
+
+class UpstreamConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_429=0.0, retry_after=1, seed=1):
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.error_rate = float(error_rate)
+        self.rate_429 = float(rate_429)
+        self.retry_after = int(retry_after)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def roll(self):
+        """
+        Sleep for the configured latency; returns "429", "error" or None.
+        """
+        with self._lock:
+            jitter = self._rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+            r = self._rng.random()
+        delay = (self.latency_ms + jitter) / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+        if r < self.rate_429:
+            return "429"
+        if r < self.rate_429 + self.error_rate:
+            return "error"
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        try:
+            return json.loads(raw.decode("utf-8")) if raw else {}
+        except ValueError:
+            return {}
+
+    def _send(self, status, obj=None, headers=None):
+        data = b"" if obj is None else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+
+class FakeTelegram:
+    """
+    POST /bot<token>/<method>: canned results for the methods the bot uses.
+    """
+
+    def __init__(self, config: UpstreamConfig = None, admin_ids=(8126033106,)):
+        self.config = config or UpstreamConfig()
+        self.admin_ids = list(admin_ids)
+        self.calls = Counter()  # (method, status)
+        self._mid = 100000
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, method, status):
+        with self._lock:
+            self.calls[(method, status)] += 1
+
+    def _result(self, method, payload):
+        if method == "sendMessage":
+            with self._lock:
+                self._mid += 1
+                return {"message_id": self._mid, "chat": {"id": payload.get("chat_id")}, "date": int(time.time())}
+        if method == "getChat":
+            cid = payload.get("chat_id")
+            if str(cid).startswith("-100"):
+                return {"id": cid, "type": "supergroup", "title": f"Bench group {cid}"}
+            return {"id": cid, "type": "private", "first_name": f"User{cid}"}
+        if method == "getChatAdministrators":
+            return [{"status": "creator" if i == 0 else "administrator", "user": {"id": a, "first_name": "Admin"}}
+                    for i, a in enumerate(self.admin_ids)]
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": payload.get("user_id")}}
+        if method == "getForumTopic":
+            return {"name": f"Topic {payload.get('message_thread_id')}"}
+        return True
+
+    def handler(self):
+        fake = self
+
+        class H(_Handler):
+            def do_POST(self):
+                m = _TG_PATH.match(self.path.split("?", 1)[0])
+                payload = self._body()
+                if not m:
+                    self._send(404, {"ok": False, "error_code": 404})
+                    return
+                method = m.group(1)
+                outcome = fake.config.roll()
+                if outcome == "429":
+                    fake.count(method, 429)
+                    ra = fake.config.retry_after
+                    self._send(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                     "parameters": {"retry_after": ra}}, {"Retry-After": str(ra)})
+                    return
+                if outcome == "error":
+                    fake.count(method, 500)
+                    self._send(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+                    return
+                fake.count(method, 200)
+                self._send(200, {"ok": True, "result": fake._result(method, payload)})
+
+            do_GET = do_POST
+
+        return H
+
+
+class FakeGist:
+    """
+    GET/PATCH /gists/<id> with ETag / If-None-Match (304) semantics and partial file updates.
+    """
+
+    def __init__(self, config: UpstreamConfig = None, gists=None):
+        self.config = config or UpstreamConfig()
+        self.gists = {gid: dict(files) for gid, files in (gists or {}).items()}  # gid -> {filename: content}
+        self.etags = {gid: 1 for gid in self.gists}
+        self.calls = Counter()  # (verb, status)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def _doc(self, gid):
+        return {"id": gid, "files": {fn: {"filename": fn, "content": c, "truncated": False}
+                                     for fn, c in self.gists.get(gid, {}).items()}}
+
+    def handler(self):
+        fake = self
+
+        class H(_Handler):
+            def _common(self, verb):
+                m = _GIST_PATH.match(self.path.split("?", 1)[0])
+                if not m:
+                    self._send(404, {"message": "Not Found"})
+                    return None
+                if fake.config.roll() is not None:
+                    with fake._lock:
+                        fake.calls[(verb, 502)] += 1
+                    self._send(502, {"message": "Bad Gateway"})
+                    return None
+                return m.group(1)
+
+            def do_GET(self):
+                gid = self._common("GET")
+                if gid is None:
+                    return
+                with fake._lock:
+                    fake.gists.setdefault(gid, {})
+                    etag = f'"{gid}-{fake.etags.setdefault(gid, 1)}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        fake.calls[("GET", 304)] += 1
+                        self._send(304, None, {"ETag": etag})
+                        return
+                    doc = fake._doc(gid)
+                body = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+                with fake._lock:
+                    fake.calls[("GET", 200)] += 1
+                    fake.bytes_out += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PATCH(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(n) if n else b""
+                gid = self._common("PATCH")
+                if gid is None:
+                    return
+                with fake._lock:
+                    fake.bytes_in += len(raw)
+                try:
+                    files = (json.loads(raw.decode("utf-8")) or {}).get("files") or {}
+                except ValueError:
+                    self._send(400, {"message": "Problems parsing JSON"})
+                    return
+                with fake._lock:
+                    store = fake.gists.setdefault(gid, {})
+                    for fn, v in files.items():
+                        if v is None:
+                            store.pop(fn, None)
+                        else:
+                            store[fn] = v.get("content", "")
+                    fake.etags[gid] = fake.etags.get(gid, 1) + 1
+                    etag = f'"{gid}-{fake.etags[gid]}"'
+                    doc = fake._doc(gid)
+                    fake.calls[("PATCH", 200)] += 1
+                self._send(200, doc, {"ETag": etag})
+
+        return H
+
+
+def start_server(fake, host="127.0.0.1", port=0) -> str:
+    """
+    Serve `fake` on a daemon thread; returns its base URL.
+    """
+    srv = ThreadingHTTPServer((host, port), fake.handler())
+    srv.daemon_threads = True
+    fake.server = srv
+    threading.Thread(target=srv.serve_forever, name=f"fake-{type(fake).__name__}", daemon=True).start()
+    return f"http://{host}:{srv.server_address[1]}"
+
+
+def stop_server(fake):
+    if fake.server is not None:
+        fake.server.shutdown()
+        fake.server.server_close()
+        fake.server = None
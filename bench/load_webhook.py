@@ -0,0 +1,296 @@
+"""
+Offline load harness: replays synthetic updates into /webhook against local
+Telegram / Gist stand-ins (bench/fake_servers.py) and reports throughput and
+p50/p95/p99 per update kind.
+
+    python bench/load_webhook.py [--updates 2000] [--concurrency 16] [--tg-latency-ms 40]
+                                 [--tg-429-rate 0.01] [--gist-latency-ms 120] [--json]
+                                 [--max-p95-ms 50]
+
+No network access is needed; BOT_TOKEN / GIST_* / *_API_BASE are set here before bot.py is imported.
+With --max-p95-ms the script exits 1 when the overall p95 exceeds the budget (CI gate).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from fake_servers import FakeGist, FakeTelegram, UpstreamConfig, start_server, stop_server  # noqa: E402
+
+SUPER_ADMIN = 8126033106
+GROUPS = [-1001000000001, -1001000000002, -1001000000003]
+DEFAULT_MIX = "chatter=60,link=12,album=6,callback=12,command=10"
+CALLBACKS = ["p_main", "p_group", "p_admin", "a_list"]
+GROUP_CALLBACKS = ["g_vio_list", "g_wl_list"]
+SPAM_LINKS = ["https://spam-{n}.xyz/promo", "t.me/joinchat/{n}", "https://bit.ly/{n}"]
+WORDS = "今天 大家 早安 價格 狗狗 行情 社群 活動 hello moon wen pump chart 觀望 好 讚".split()
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    i = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[i]
+
+
+def parse_mix(s):
+    out = []
+    for part in s.split(","):
+        k, _, w = part.partition("=")
+        out.append((k.strip(), float(w or 1)))
+    return out
+
+
+class UpdateFactory:
+    def __init__(self, seed=7, first_id=1):
+        self.rng = random.Random(seed)
+        self.update_id = first_id
+        self.mid = first_id
+        self.album_seq = 1
+
+    def _ids(self):
+        self.update_id += 1
+        self.mid += 1
+        return self.update_id, self.mid
+
+    def _msg(self, chat_id, user_id, text, chat_type="supergroup", **extra):
+        uid, mid = self._ids()
+        chat = {"id": chat_id, "type": chat_type}
+        if chat_type == "supergroup":
+            chat["title"] = f"Bench group {chat_id}"
+        msg = {"message_id": mid, "date": int(time.time()), "chat": chat,
+               "from": {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}}
+        if text is not None:
+            msg["text"] = text
+        msg.update(extra)
+        return {"update_id": uid, "message": msg}
+
+    def chatter(self):
+        r = self.rng
+        return [self._msg(r.choice(GROUPS), r.randint(10_000, 60_000), " ".join(r.choice(WORDS) for _ in range(r.randint(2, 12))))]
+
+    def link(self):
+        r = self.rng
+        url = r.choice(SPAM_LINKS).format(n=r.randint(1, 10**6))
+        return [self._msg(r.choice(GROUPS), r.randint(60_000, 90_000), f"免費領取 {url}")]
+
+    def album(self):
+        r = self.rng
+        chat, user = r.choice(GROUPS), r.randint(90_000, 99_999)
+        self.album_seq += 1
+        gid = f"bench{self.album_seq}"
+        out = []
+        for i in range(r.randint(2, 6)):
+            extra = {"media_group_id": gid, "photo": [{"file_id": f"p{self.album_seq}_{i}", "width": 90, "height": 90}]}
+            if i == 0:
+                extra["caption"] = "加群 https://spam-album.xyz/join"
+            out.append(self._msg(chat, user, None, **extra))
+        return out
+
+    def callback(self):
+        r = self.rng
+        self.update_id += 1
+        self.mid += 1
+        chat = {"id": SUPER_ADMIN, "type": "private"}
+        data = r.choice(CALLBACKS)
+        if r.random() < 0.4:
+            data = f"{r.choice(GROUP_CALLBACKS)}:{r.choice(GROUPS)}"
+        return [{"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id), "data": data,
+            "from": {"id": SUPER_ADMIN, "is_bot": False, "first_name": "Admin"},
+            "message": {"message_id": self.mid, "date": int(time.time()), "chat": chat, "text": "panel"}}}]
+
+    def command(self):
+        r = self.rng
+        user = r.choice([SUPER_ADMIN, r.randint(10_000, 60_000)])
+        return [self._msg(user, user, r.choice(["/start", "/help", "/admin"]), chat_type="private")]
+
+
+def build_workload(n, mix, seed, first_id=1):
+    # update_id / message_id ranges must not overlap between runs (the bot drops redeliveries)
+    f = UpdateFactory(seed, first_id)
+    kinds = [k for k, _ in mix]
+    weights = [w for _, w in mix]
+    rng = random.Random(seed + 1)
+    out = []
+    while len(out) < n:
+        kind = rng.choices(kinds, weights)[0]
+        for upd in getattr(f, kind)():
+            out.append((kind, upd))
+    return out[:n]
+
+
+def setup_env(tg_base, gh_base, snapshot_dir, outbox_workers):
+    os.environ["BOT_TOKEN"] = "bench:token"
+    os.environ["GIST_TOKEN"] = "bench"
+    os.environ["GIST_ID_CORE"] = "core"
+    os.environ["GIST_ID_RT_JARVIS"] = "rt"
+    os.environ["TG_API_BASE"] = tg_base
+    os.environ["GITHUB_API_BASE"] = gh_base
+    os.environ["SNAPSHOT_DIR"] = snapshot_dir
+    if outbox_workers is not None:
+        os.environ["OUTBOX_WORKERS"] = str(outbox_workers)
+
+
+def run(args):
+    tg = FakeTelegram(UpstreamConfig(args.tg_latency_ms, args.tg_jitter_ms, args.tg_error_rate,
+                                     args.tg_429_rate, args.retry_after, args.seed))
+    gist = FakeGist(UpstreamConfig(args.gist_latency_ms, args.gist_jitter_ms, args.gist_error_rate, 0.0, 1, args.seed + 1))
+    tg_base, gh_base = start_server(tg), start_server(gist)
+    setup_env(tg_base, gh_base, tempfile.mkdtemp(prefix="jarvis-bench-"), args.outbox_workers)
+
+    import bot  # noqa: E402  (after env is in place)
+
+    _tls = threading.local()
+    server = None
+    if args.inproc:
+        def post(upd):
+            # one test client per worker thread
+            c = getattr(_tls, "client", None)
+            if c is None:
+                c = _tls.client = bot.app.test_client()
+            return c.post("/webhook", json=upd).status_code
+    else:
+        import requests
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *a, **k):
+                pass
+
+        server = make_server("127.0.0.1", 0, bot.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+        def post(upd):
+            s = getattr(_tls, "session", None)
+            if s is None:
+                s = _tls.session = requests.Session()
+            return s.post(url, json=upd, timeout=30).status_code
+
+    workload = build_workload(args.warmup, parse_mix(args.mix), args.seed + 100)
+    for _, upd in workload:
+        post(upd)
+    bot.drain_outbox(timeout=10.0)
+    tg.calls.clear()
+
+    workload = build_workload(args.updates, parse_mix(args.mix), args.seed, first_id=10_000_000)
+    lat = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    it = iter(workload)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(it, None)
+            if item is None:
+                return
+            kind, upd = item
+            t0 = time.perf_counter()
+            try:
+                code = post(upd)
+            except Exception:
+                code = -1
+            dt = (time.perf_counter() - t0) * 1000.0
+            with lock:
+                lat[kind].append(dt)
+                if code != 200:
+                    errors[kind] += 1
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+
+    t_drain = time.perf_counter()
+    drained = bot.drain_outbox(timeout=args.drain_timeout)
+    drain_s = time.perf_counter() - t_drain
+
+    def summary(vals):
+        v = sorted(vals)
+        return {"n": len(v), "p50_ms": round(percentile(v, 50), 2), "p95_ms": round(percentile(v, 95), 2),
+                "p99_ms": round(percentile(v, 99), 2), "max_ms": round(v[-1], 2) if v else 0.0}
+
+    every = [x for vals in lat.values() for x in vals]
+    report = {
+        "updates": len(every),
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(every) / elapsed, 1) if elapsed else 0.0,
+        "overall": summary(every),
+        "by_kind": {k: summary(v) for k, v in sorted(lat.items())},
+        "http_errors": dict(errors),
+        "outbox_drain_s": round(drain_s, 3),
+        "outbox_drained": drained,
+        "outbox_left": bot.outbox_depth(),  # usually per-chat notice throttling, not a stall
+        "telegram_calls": {f"{m}:{s}": n for (m, s), n in sorted(tg.calls.items())},
+        "gist_calls": {f"{v}:{s}": n for (v, s), n in sorted(gist.calls.items())},
+    }
+
+    if server is not None:
+        server.shutdown()
+    stop_server(tg)
+    stop_server(gist)
+    return report
+
+
+def print_report(r):
+    print(f"updates={r['updates']} concurrency={r['concurrency']} elapsed={r['elapsed_s']}s "
+          f"throughput={r['throughput_ups']} upd/s")
+    print(f"{'kind':<10} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    rows = list(r["by_kind"].items()) + [("overall", r["overall"])]
+    for k, s in rows:
+        print(f"{k:<10} {s['n']:>6} {s['p50_ms']:>8.2f}m {s['p95_ms']:>8.2f}m {s['p99_ms']:>8.2f}m {s['max_ms']:>8.2f}m")
+    print(f"outbox drain={r['outbox_drain_s']}s drained={r['outbox_drained']} left={r['outbox_left']} http_errors={r['http_errors'] or 0}")
+    print("telegram:", r["telegram_calls"])
+    print("gist:", r["gist_calls"])
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--updates", type=int, default=2000)
+    ap.add_argument("--warmup", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="kind=weight,... (chatter, link, album, callback, command)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--tg-latency-ms", type=float, default=40.0)
+    ap.add_argument("--tg-jitter-ms", type=float, default=20.0)
+    ap.add_argument("--tg-error-rate", type=float, default=0.0)
+    ap.add_argument("--tg-429-rate", type=float, default=0.0)
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--gist-latency-ms", type=float, default=120.0)
+    ap.add_argument("--gist-jitter-ms", type=float, default=60.0)
+    ap.add_argument("--gist-error-rate", type=float, default=0.0)
+    ap.add_argument("--outbox-workers", type=int, default=None)
+    ap.add_argument("--drain-timeout", type=float, default=30.0)
+    ap.add_argument("--inproc", action="store_true", help="drive app.test_client() instead of a local HTTP server")
+    ap.add_argument("--json", action="store_true")
+    ap.add_argument("--max-p95-ms", type=float, default=None, help="exit 1 if overall p95 exceeds this budget")
+    args = ap.parse_args(argv)
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    if args.max_p95_ms is not None and report["overall"]["p95_ms"] > args.max_p95_ms:
+        print(f"FAIL: p95 {report['overall']['p95_ms']}ms > budget {args.max_p95_ms}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
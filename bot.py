@@ -4,10 +4,21 @@ import re
 import datetime
 import pytz
 import threading
+import atexit
+import sqlite3
+import copy
+import queue
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait as _futures_wait
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
 from time import time as _now
-from flask import Flask, request
+from flask import Flask, request, g, has_request_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+_IMPORT_T0 = _now()
 
 app = Flask(__name__)
 
@@ -17,15 +28,38 @@ SUPER_ADMIN = 8126033106
 
 GIST_TOKEN = os.environ.get("GIST_TOKEN")
 
+# upstream base URLs (overridable for local stand-ins, see bench/)
+TG_API_BASE = os.environ.get("TG_API_BASE", "https://api.telegram.org").strip().rstrip("/")
+GITHUB_API_BASE = os.environ.get("GITHUB_API_BASE", "https://api.github.com").strip().rstrip("/")
+
+# Vercel / Lambda freeze the instance once the response is sent: background threads can't be
+# trusted to finish, so persistence runs inline there by default
+SERVERLESS = bool(os.environ.get("VERCEL") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+
 # ✅ NEW: split gist ids
 GIST_ID_CORE = os.environ.get("GIST_ID_CORE", "").strip()
 GIST_ID_RT_JARVIS = os.environ.get("GIST_ID_RT_JARVIS", "").strip()
 
+# ✅ storage backend: "gist" (default) or "sqlite"; CORE / RT can be overridden separately
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gist").strip().lower()
+CORE_STORAGE = os.environ.get("CORE_STORAGE", STORAGE_BACKEND).strip().lower()
+RT_STORAGE = os.environ.get("RT_STORAGE", STORAGE_BACKEND).strip().lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "10k_dog_jarvis.db").strip()
+
 TAIWAN_TZ = pytz.timezone("Asia/Taipei")
 
 # ✅ filenames inside each gist
 CORE_FILENAME = "10k_dog_core.json"
-RT_FILENAME = "10k_dog_runtime_jarvis.json"
+RT_FILENAME = "10k_dog_runtime_jarvis.json"  # legacy single-document RT (migrated to shards on load)
+
+# ✅ RT shards: one file per chat for violations, one file per day for logs
+RT_SHARD_PREFIX = "10k_dog_rt_jarvis"
+RT_SHARD_VIO = "vio"
+RT_SHARD_LOGS = "logs"
+MAX_LOGS = 200
+
+# dirty marks: "*" = whole document, "<section>[:<key>]" for core, "vio:<chat>[:<uid>]" / "logs:<day>" for RT
+DIRTY_ALL = "*"
 
 BOT_NAME = "10K DOG - Jarvis"
 
@@ -35,8 +69,10 @@ KEY_ADMINS = "admins"
 KEY_THREADS_JARVIS = "allowed_threads_jarvis"
 KEY_THREADS_SPARKSIGN = "allowed_threads_sparksign"
 KEY_SPARKSIGN_SETTINGS = "sparksign_settings"
-KEY_LINK_SETTINGS = "link_settings"       # { chat_id: { enabled: bool, mute_days: int, third_action } }
+KEY_LINK_SETTINGS = "link_settings"       # { chat_id: { enabled, mute_days, third_action, flood_* } }
 KEY_LINK_WHITELIST = "link_whitelist"     # { chat_id: { user_id: {added_by, added_time} } }
+KEY_AD_KEYWORDS = "ad_keywords"           # { chat_id: { keyword: {added_by, added_time} } }
+KEY_LINK_DOMAINS = "link_domains"         # { chat_id: { "allow"|"deny": { rule: {added_by, added_time} } } }
 
 # Runtime keys (Jarvis 高頻)
 KEY_LINK_VIOLATIONS = "link_violations"   # { chat_id: { user_id: {count:int, last_time:iso} } }
@@ -50,25 +86,82 @@ PREMIUM_EMOJI_MAP = {
 }
 
 
+_PREMIUM_SCANNER = [None]  # ((map, version), candidate regex | None, {first char: [(emoji, custom_id, utf16_len, extra_units)]})
+_PREMIUM_EMOJI_VERSION = [0]
+
+
+def invalidate_premium_emoji():
+    # call after editing PREMIUM_EMOJI_MAP in place (rebinding it is picked up on its own)
+    _PREMIUM_EMOJI_VERSION[0] += 1
+
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) >> 1
+
+
+def _premium_scanner():
+    """
+    Candidate regex = one char class: the BMP first chars of emojis that have an id, plus every
+    astral char (needed anyway for the running UTF-16 offset). A small class scans much faster in
+    re than a 26-way alternation; the candidate is then resolved longest-first by startswith.
+    Rebuilt (and PREMIUM_ENTITY_CACHE dropped) when PREMIUM_EMOJI_MAP is rebound or
+    invalidate_premium_emoji() is called; the hot path is an identity + int check.
+    """
+    sc = _PREMIUM_SCANNER[0]
+    if sc is None or sc[0][0] is not PREMIUM_EMOJI_MAP or sc[0][1] != _PREMIUM_EMOJI_VERSION[0]:
+        key = (PREMIUM_EMOJI_MAP, _PREMIUM_EMOJI_VERSION[0])
+        snapshot = dict(PREMIUM_EMOJI_MAP)
+        by_first = {}
+        for e, cid in snapshot.items():
+            if e and cid:
+                by_first.setdefault(e[0], []).append((e, cid, _utf16_len(e), _utf16_len(e) - len(e)))
+        for cands in by_first.values():
+            cands.sort(key=lambda c: len(c[0]), reverse=True)
+        bmp = "".join(re.escape(c) for c in sorted(by_first) if ord(c) <= 0xFFFF)
+        regex = re.compile(f"[{bmp}\U00010000-\U0010FFFF]") if by_first else None
+        sc = _PREMIUM_SCANNER[0] = (key, regex, by_first)
+        PREMIUM_ENTITY_CACHE.clear()
+    return sc
+
+
 def apply_premium_emoji_entities(text: str):
+    """
+    -> (text, custom_emoji entities | None). Single left-to-right pass; offset/length are
+    UTF-16 code units as the Bot API expects (astral emoji count as 2).
+    """
     if not text:
         return text, None
+    _, regex, by_first = _premium_scanner()
+    if regex is None:
+        return text, None
+
+    cached = PREMIUM_ENTITY_CACHE.get(text)
+    if cached is TTLCache.MISS:
+        cached = _scan_premium_emoji(text, regex, by_first)
+        PREMIUM_ENTITY_CACHE.set(text, cached)
+
+    return text, [dict(e) for e in cached] if cached else None
 
+
+def _scan_premium_emoji(text: str, regex, by_first: dict):
     entities = []
-    for emoji, custom_id in PREMIUM_EMOJI_MAP.items():
-        if not custom_id:
-            continue
-        start = 0
-        while True:
-            idx = text.find(emoji, start)
-            if idx == -1:
+    shift = 0  # UTF-16 units minus code points so far
+    end = 0
+    for m in regex.finditer(text):
+        i = m.start()
+        if i < end:
+            continue  # inside an emoji already taken
+        c = text[i]
+        for emoji, custom_id, n16, extra in by_first.get(c, ()):
+            if text.startswith(emoji, i):
+                entities.append({"type": "custom_emoji", "offset": i + shift, "length": n16, "custom_emoji_id": custom_id})
+                shift += extra
+                end = i + len(emoji)
                 break
-            entities.append(
-                {"type": "custom_emoji", "offset": idx, "length": len(emoji), "custom_emoji_id": custom_id}
-            )
-            start = idx + len(emoji)
-
-    return text, entities if entities else None
+        else:
+            if ord(c) > 0xFFFF:
+                shift += 1
+    return tuple(entities) or None
 
 
 def extract_first_custom_emoji_id(message: dict):
@@ -84,6 +177,321 @@ def extract_first_custom_emoji_id(message: dict):
     return None
 
 
+# ================== Stats (in-process counters) ==================
+STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+def stat_inc(name: str, n: int = 1):
+    with _STATS_LOCK:
+        STATS[name] = STATS.get(name, 0) + n
+
+
+def stat_observe(name: str, value: float):
+    with _STATS_LOCK:
+        o = STATS.get(name)
+        if not isinstance(o, dict):
+            o = {"count": 0, "sum": 0.0, "max": 0.0}
+            STATS[name] = o
+        o["count"] += 1
+        o["sum"] += float(value)
+        o["max"] = max(o["max"], float(value))
+
+
+def stats_snapshot() -> dict:
+    with _STATS_LOCK:
+        return {k: (dict(v) if isinstance(v, dict) else v) for k, v in STATS.items()}
+
+
+# ================== Metrics (Prometheus text exposition) ==================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HISTOGRAMS = {}        # name -> {"help", "series": {labels tuple: [bucket counts..., sum, count]}}
+LABELED_COUNTERS = {}  # name -> {"help", "series": {labels tuple: value}}
+_METRICS_LOCK = threading.Lock()
+
+
+def hist_observe(name: str, seconds: float, help_text: str = "", **labels):
+    key = tuple(sorted(labels.items()))
+    with _METRICS_LOCK:
+        h = HISTOGRAMS.setdefault(name, {"help": help_text, "series": {}})
+        row = h["series"].get(key)
+        if row is None:
+            row = h["series"][key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if seconds <= le:
+                row[i] += 1
+                break
+        row[-2] += float(seconds)
+        row[-1] += 1
+
+
+def metric_inc(name: str, value: float = 1, help_text: str = "", **labels):
+    key = tuple(sorted(labels.items()))
+    with _METRICS_LOCK:
+        c = LABELED_COUNTERS.setdefault(name, {"help": help_text, "series": {}})
+        c["series"][key] = c["series"].get(key, 0) + value
+
+
+def _prom_labels(labels, extra=None) -> str:
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def _prom_histograms(lines: list):
+    with _METRICS_LOCK:
+        snap = {n: (h["help"], {k: list(v) for k, v in h["series"].items()}) for n, h in HISTOGRAMS.items()}
+    for name, (help_text, series) in sorted(snap.items()):
+        lines.append(f"# HELP {name} {help_text or name}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, row in sorted(series.items()):
+            cum = 0
+            for i, le in enumerate(LATENCY_BUCKETS):
+                cum += row[i]
+                lines.append(f"{name}_bucket{_prom_labels(labels, [('le', le)])} {cum}")
+            lines.append(f"{name}_bucket{_prom_labels(labels, [('le', '+Inf')])} {row[-1]}")
+            lines.append(f"{name}_sum{_prom_labels(labels)} {row[-2]:.6f}")
+            lines.append(f"{name}_count{_prom_labels(labels)} {row[-1]}")
+
+
+def _prom_counters(lines: list):
+    with _METRICS_LOCK:
+        snap = {n: (c["help"], dict(c["series"])) for n, c in LABELED_COUNTERS.items()}
+    for name, (help_text, series) in sorted(snap.items()):
+        lines.append(f"# HELP {name} {help_text or name}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, v in sorted(series.items()):
+            lines.append(f"{name}{_prom_labels(labels)} {v}")
+
+
+def _prom_gauge(lines: list, name: str, help_text: str, series):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} gauge")
+    for labels, v in series:
+        lines.append(f"{name}{_prom_labels(labels)} {v}")
+
+
+# ================== TTL / LRU caches ==================
+CACHES = {}
+
+
+class TTLCache:
+    """
+    Bounded LRU with per-entry TTL. Negative entries (value None) use neg_ttl.
+    get() returns TTLCache.MISS when absent/expired.
+    """
+    MISS = object()
+
+    def __init__(self, name: str, maxsize: int, ttl: float, neg_ttl: float = None):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.neg_ttl = float(neg_ttl if neg_ttl is not None else ttl)
+        self._data = OrderedDict()  # key -> (expires_ts, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.neg_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        CACHES[name] = self
+
+    def get(self, key, count: bool = True):
+        now = _now()
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is None or ent[0] <= now:
+                if ent is not None:
+                    self._data.pop(key, None)
+                if count:
+                    self.misses += 1
+                return TTLCache.MISS
+            self._data.move_to_end(key)
+            if count:
+                if ent[1] is None:
+                    self.neg_hits += 1
+                else:
+                    self.hits += 1
+            return ent[1]
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.neg_ttl if value is None else self.ttl
+        with self._lock:
+            self._data[key] = (_now() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_negative(self, key):
+        self.set(key, None)
+
+    def add(self, key, value=True, ttl: float = None) -> bool:
+        """
+        Atomic insert-if-absent: True if the key was not (live) in the cache.
+        """
+        now = _now()
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is not None and ent[0] > now:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.neg_hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "negative_hits": self.neg_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.neg_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+def cache_stats() -> dict:
+    return {name: c.stats() for name, c in list(CACHES.items())}
+
+
+# premium emoji entities per text (panel / command texts repeat a lot)
+PREMIUM_ENTITY_CACHE = TTLCache(
+    "premium_entities",
+    int(os.environ.get("PREMIUM_ENTITY_CACHE_MAX", "512")),
+    float(os.environ.get("PREMIUM_ENTITY_CACHE_TTL", "3600")),
+)
+
+
+# ================== Idempotency (redelivered updates / replayed actions) ==================
+SEEN_TTL = float(os.environ.get("SEEN_TTL", "3600"))
+SEEN_MAX = int(os.environ.get("SEEN_MAX", "50000"))
+SEEN_UPDATES = TTLCache("seen_updates", SEEN_MAX, SEEN_TTL)
+SEEN_ACTIONS = TTLCache("seen_actions", SEEN_MAX, SEEN_TTL)
+
+
+def first_delivery(update: dict) -> bool:
+    """
+    False if this update_id was already processed (Telegram redelivery after a slow/failed ack).
+    """
+    stat_inc("updates_total")
+    uid = update.get("update_id")
+    if uid is None:
+        return True
+    if SEEN_UPDATES.add(int(uid)):
+        return True
+    stat_inc("updates_duplicate")
+    return False
+
+
+def claim_once(chat_id, message_id, action: str) -> bool:
+    """
+    True the first time (chat_id, message_id, action) is claimed; replays (edits, redeliveries) get False.
+    """
+    if not message_id:
+        return True
+    if SEEN_ACTIONS.add((int(chat_id), int(message_id), action)):
+        return True
+    stat_inc(f"action_replays:{action}")
+    return False
+
+
+def dedup_stats() -> dict:
+    st = stats_snapshot()
+    total = int(st.get("updates_total", 0) or 0)
+    dup = int(st.get("updates_duplicate", 0) or 0)
+    return {
+        "updates": total,
+        "duplicates": dup,
+        "duplicate_rate": round(dup / total, 4) if total else 0.0,
+        "action_replays": sum(v for k, v in st.items() if k.startswith("action_replays:") and isinstance(v, int)),
+    }
+
+
+# ================== HTTP (pooled keep-alive sessions per upstream) ==================
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05"))
+
+_HTTP_SESSIONS = {}
+_HTTP_LOCK = threading.Lock()
+
+
+def _build_session(upstream: str) -> requests.Session:
+    if upstream == "github":
+        # gist GET/PATCH are idempotent: retry connect errors and 5xx
+        retry = Retry(
+            total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=HTTP_RETRIES,
+            status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "PATCH"}),
+            backoff_factor=0.3, raise_on_status=False,
+        )
+    else:
+        # Telegram POSTs are not idempotent: only retry when the request never left
+        retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0, backoff_factor=0.2)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry, pool_block=False)
+    sess = requests.Session()
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+
+def http_session(upstream: str) -> requests.Session:
+    """
+    Thread-safe shared session for "telegram" / "github" (re-created after fork).
+    """
+    pid = os.getpid()
+    ent = _HTTP_SESSIONS.get(upstream)
+    if ent is not None and ent[0] == pid:
+        return ent[1]
+    with _HTTP_LOCK:
+        ent = _HTTP_SESSIONS.get(upstream)
+        if ent is None or ent[0] != pid:
+            ent = (pid, _build_session(upstream))
+            _HTTP_SESSIONS[upstream] = ent
+        return ent[1]
+
+
+def _http_timeout(read_timeout):
+    return (HTTP_CONNECT_TIMEOUT, read_timeout)
+
+
+def http_pool_stats() -> dict:
+    """
+    Per upstream: new connections opened vs requests served on reused keep-alive connections.
+    """
+    out = {}
+    for upstream, (pid, sess) in list(_HTTP_SESSIONS.items()):
+        new_conns = 0
+        reqs = 0
+        for adapter in set(sess.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                new_conns += int(getattr(pool, "num_connections", 0) or 0)
+                reqs += int(getattr(pool, "num_requests", 0) or 0)
+        out[upstream] = {"requests": reqs, "new_connections": new_conns, "reused": max(0, reqs - new_conns)}
+    return out
+
+
 # ================== Gist I/O (三檔分離: CORE + RT_JARVIS) ==================
 CORE_DATA = {}
 RT_DATA = {}
@@ -113,14 +521,36 @@ RT_CACHE = {
 }
 
 DATA_TTL_SEC = float(os.environ.get("DATA_TTL_SEC", "45"))
-SAVE_DEBOUNCE_SEC = float(os.environ.get("SAVE_DEBOUNCE_SEC", "2.5"))
+# long-running hosts: dirty-aware reloads merge instead of overwrite, so writes can be batched longer.
+# serverless: anything unflushed when the instance is frozen / recycled is lost, keep the window short
+SAVE_DEBOUNCE_SEC = float(os.environ.get("SAVE_DEBOUNCE_SEC", "2.5" if SERVERLESS else "10"))
+SAVE_MAX_DELAY_SEC = float(os.environ.get("SAVE_MAX_DELAY_SEC", "10" if SERVERLESS else "30"))  # cap for continuously-dirty caches
 CB_FAIL_THRESHOLD = int(os.environ.get("CB_FAIL_THRESHOLD", "3"))
 CB_OPEN_SEC = float(os.environ.get("CB_OPEN_SEC", "10"))
 
+# Warm-start snapshot (serverless cold starts): last synced doc + ETag on local disk
+SNAPSHOT_ENABLED = os.environ.get("SNAPSHOT_CACHE", "1") != "0"
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "/tmp").strip() or "/tmp"
+SNAPSHOT_MIN_INTERVAL_SEC = float(os.environ.get("SNAPSHOT_MIN_INTERVAL_SEC", "15"))
+
 LOAD_LOCK_CORE = threading.Lock()
 SAVE_LOCK_CORE = threading.Lock()
 LOAD_LOCK_RT = threading.Lock()
 SAVE_LOCK_RT = threading.Lock()
+# add-a-mark / swap-out-the-set is atomic: a mark can't land in a set the flush already took
+DIRTY_MARKS_LOCK = threading.Lock()
+# request-side write + mark vs. reload merge + rebind: a write can't land in a dict being replaced
+DATA_LOCK_CORE = threading.Lock()
+DATA_LOCK_RT = threading.Lock()
+
+# Background persistence worker (owns flush_core_if_due / flush_rt_if_due)
+PERSIST_WORKER_ENABLED = os.environ.get("PERSIST_WORKER", "0" if SERVERLESS else "1") != "0"
+PERSIST_BACKOFF_MIN_SEC = float(os.environ.get("PERSIST_BACKOFF_MIN_SEC", "0.5"))
+PERSIST_BACKOFF_MAX_SEC = float(os.environ.get("PERSIST_BACKOFF_MAX_SEC", "60"))
+
+_PERSIST_WAKE = threading.Event()
+_PERSIST_START_LOCK = threading.Lock()
+_PERSIST_STATE = {"thread": None, "force": False, "backoff": 0.0}
 
 
 def _github_headers(extra: dict = None):
@@ -163,6 +593,8 @@ def get_default_core():
         KEY_SPARKSIGN_SETTINGS: {},
         KEY_LINK_SETTINGS: {},
         KEY_LINK_WHITELIST: {},
+        KEY_AD_KEYWORDS: {},
+        KEY_LINK_DOMAINS: {},
     }
 
 
@@ -191,6 +623,8 @@ def _ensure_core_defaults(loaded: dict) -> dict:
     loaded.setdefault(KEY_ADMINS, get_default_core()[KEY_ADMINS])
     loaded.setdefault(KEY_LINK_SETTINGS, {})
     loaded.setdefault(KEY_LINK_WHITELIST, {})
+    loaded.setdefault(KEY_AD_KEYWORDS, {})
+    loaded.setdefault(KEY_LINK_DOMAINS, {})
 
     # type safety
     if not isinstance(loaded.get(KEY_THREADS_JARVIS), dict):
@@ -205,6 +639,10 @@ def _ensure_core_defaults(loaded: dict) -> dict:
         loaded[KEY_LINK_SETTINGS] = {}
     if not isinstance(loaded.get(KEY_LINK_WHITELIST), dict):
         loaded[KEY_LINK_WHITELIST] = {}
+    if not isinstance(loaded.get(KEY_AD_KEYWORDS), dict):
+        loaded[KEY_AD_KEYWORDS] = {}
+    if not isinstance(loaded.get(KEY_LINK_DOMAINS), dict):
+        loaded[KEY_LINK_DOMAINS] = {}
 
     return loaded
 
@@ -221,16 +659,39 @@ def _ensure_rt_defaults(loaded: dict) -> dict:
     return loaded
 
 
-def _gist_get_by_id(gid: str, filename: str, cache: dict, ensure_fn):
+def _gist_request(op: str, url: str, **kwargs):
+    """
+    op: "get" / "raw" / "patch". Records latency, status and bytes moved for /metrics.
+    """
+    t0 = _now()
+    status = "error"
+    try:
+        r = http_session("github").request("PATCH" if op == "patch" else "GET", url, **kwargs)
+        status = str(r.status_code)
+        try:
+            metric_inc("jarvis_gist_bytes_total", len(r.content or b""), "Gist payload bytes", op=op, direction="in")
+            if op == "patch" and r.request is not None:
+                metric_inc("jarvis_gist_bytes_total", len(r.request.body or b""), "Gist payload bytes", op=op, direction="out")
+        except Exception:
+            pass
+        return r
+    finally:
+        hist_observe("jarvis_gist_request_duration_seconds", _now() - t0, "GitHub Gist API latency", op=op, status=status)
+
+
+def _gist_fetch_files(gid: str, cache: dict):
+    """
+    GET gist → { filename: file_obj } (None on 304). Records known filenames in cache["files"].
+    """
     if not gid:
         raise RuntimeError("no gist id")
-    url = f"https://api.github.com/gists/{gid}"
+    url = f"{GITHUB_API_BASE}/gists/{gid}"
 
     extra = {}
     if cache.get("etag"):
         extra["If-None-Match"] = cache["etag"]
 
-    r = requests.get(url, headers=_github_headers(extra), timeout=12)
+    r = _gist_request("get", url, headers=_github_headers(extra), timeout=_http_timeout(12))
 
     if r.status_code == 304:
         return None  # no change
@@ -244,37 +705,423 @@ def _gist_get_by_id(gid: str, filename: str, cache: dict, ensure_fn):
 
     gist_data = r.json() or {}
     files = gist_data.get("files") or {}
+    cache["files"] = set(files.keys())
+    return files
+
+
+def _gist_file_content(file_obj: dict) -> str:
+    file_obj = file_obj or {}
+    if file_obj.get("truncated") and file_obj.get("raw_url"):
+        # GitHub truncates large files in the gist listing; fetch the raw blob instead
+        r = _gist_request("raw", file_obj["raw_url"], headers=_github_headers(), timeout=_http_timeout(12))
+        if r.status_code != 200:
+            raise RuntimeError(f"gist raw get failed: {r.status_code}")
+        return r.text or ""
+    return file_obj.get("content", "") or ""
+
+
+def _gist_get_by_id(gid: str, filename: str, cache: dict, ensure_fn):
+    files = _gist_fetch_files(gid, cache)
+    if files is None:
+        return None  # no change
+
     if filename not in files:
         # file missing: do NOT overwrite with empty; create minimal defaults for this side only
         defaults = ensure_fn({})
         _gist_patch_by_id(gid, filename, defaults, cache)
         return defaults
 
-    content = (files[filename] or {}).get("content", "") or ""
+    content = _gist_file_content(files[filename])
     loaded = json.loads(content) if content else {}
     return ensure_fn(loaded)
 
 
-def _gist_patch_by_id(gid: str, filename: str, data_to_save: dict, cache: dict):
+def _snapshot_copy(data):
+    # dict.copy()/list.copy() 在 C 裡完成、不釋放 GIL → 每一層都是原子複製；
+    # 之後只走訪自己的副本，請求執行緒同時修改也不會 "changed size during iteration"
+    if isinstance(data, dict):
+        return {k: _snapshot_copy(v) for k, v in data.copy().items()}
+    if isinstance(data, list):
+        return [_snapshot_copy(v) for v in data.copy()]
+    return data
+
+
+def _json_snapshot(data, **kwargs) -> str:
+    # serialize a private copy, never the live dicts
+    return json.dumps(_snapshot_copy(data), ensure_ascii=False, **kwargs)
+
+
+def _gist_patch_files(gid: str, files: dict, cache: dict):
+    """
+    PATCH only the given files: { filename: content_str | None }  (None = delete file)
+    """
     if not gid:
         raise RuntimeError("no gist id")
-    files = {filename: {"content": json.dumps(data_to_save, ensure_ascii=False, indent=2)}}
-    r = requests.patch(
-        f"https://api.github.com/gists/{gid}",
+    known = cache.get("files")
+    body = {}
+    for fn, content in files.items():
+        if content is None:
+            # deleting a file the gist doesn't have is a 422 on GitHub
+            if known is not None and fn not in known:
+                continue
+            body[fn] = None
+        else:
+            body[fn] = {"content": content}
+    if not body:
+        return
+    r = _gist_request(
+        "patch",
+        f"{GITHUB_API_BASE}/gists/{gid}",
         headers=_github_headers(),
-        json={"files": files},
-        timeout=12,
+        json={"files": body},
+        timeout=_http_timeout(12),
     )
     if r.status_code not in (200, 201):
         raise RuntimeError(f"gist patch failed: {r.status_code} {getattr(r, 'text', '')[:200]}")
     etag = r.headers.get("ETag")
     if etag:
         cache["etag"] = etag
+    if known is not None:
+        for fn, v in body.items():
+            if v is None:
+                known.discard(fn)
+            else:
+                known.add(fn)
 
 
-def refresh_core(force: bool = False):
+def _gist_patch_by_id(gid: str, filename: str, data_to_save: dict, cache: dict):
+    _gist_patch_files(gid, {filename: _json_snapshot(data_to_save, indent=2)}, cache)
+
+
+# ---------- RT shards ----------
+def _rt_vio_filename(ck: str) -> str:
+    return f"{RT_SHARD_PREFIX}.{RT_SHARD_VIO}.{ck}.json"
+
+
+def _rt_logs_filename(day: str) -> str:
+    return f"{RT_SHARD_PREFIX}.{RT_SHARD_LOGS}.{day}.json"
+
+
+def _log_day(entry: dict) -> str:
+    ts = str((entry or {}).get("timestamp", "") or "")
+    return ts[:10].replace("-", "") or "00000000"
+
+
+def core_mark(section: str, key=None) -> str:
+    return section if key is None else f"{section}:{key}"
+
+
+def rt_mark_vio(ck: str, uid=None) -> str:
+    return f"{RT_SHARD_VIO}:{ck}" if uid is None else f"{RT_SHARD_VIO}:{ck}:{uid}"
+
+
+def rt_mark_logs(day: str) -> str:
+    return f"{RT_SHARD_LOGS}:{day}"
+
+
+def _rt_all_shards(data: dict) -> set:
+    shards = {rt_mark_vio(ck) for ck in (data.get(KEY_LINK_VIOLATIONS) or {}).keys()}
+    shards |= {rt_mark_logs(_log_day(e)) for e in (data.get(KEY_LOGS) or [])}
+    return shards
+
+
+def _rt_files_from_gist(gid: str, cache: dict):
+    """
+    Assemble RT_DATA from shard files (or the legacy single document).
+    Returns None on 304.
+    """
+    files = _gist_fetch_files(gid, cache)
+    if files is None:
+        return None
+
+    vio_prefix = f"{RT_SHARD_PREFIX}.{RT_SHARD_VIO}."
+    logs_prefix = f"{RT_SHARD_PREFIX}.{RT_SHARD_LOGS}."
+    sharded = [fn for fn in files.keys() if fn.startswith(RT_SHARD_PREFIX + ".")]
+
+    if not sharded and RT_FILENAME in files:
+        # one-time migration: next flush writes every shard and drops the legacy file
+        content = _gist_file_content(files[RT_FILENAME])
+        loaded = _ensure_rt_defaults(json.loads(content) if content else {})
+        cache["dirty_marks"] = {DIRTY_ALL}
+        cache["migrate_legacy"] = True
+        _mark_dirty(cache)
+        return loaded
+
+    vio = {}
+    logs = []
+    for fn in sharded:
+        content = _gist_file_content(files[fn])
+        part = json.loads(content) if content else None
+        if fn.startswith(vio_prefix) and isinstance(part, dict):
+            vio[fn[len(vio_prefix):-len(".json")]] = part
+        elif fn.startswith(logs_prefix) and isinstance(part, list):
+            logs.extend(e for e in part if isinstance(e, dict))
+    logs.sort(key=lambda e: str(e.get("timestamp", "")))
+    return _ensure_rt_defaults({KEY_LINK_VIOLATIONS: vio, KEY_LOGS: logs[-MAX_LOGS:]})
+
+
+def _rt_shard_payload(data: dict, shards: set, cache: dict) -> dict:
+    """
+    Serialize only the dirty shards → { filename: content | None }.
+    """
+    vio = data.get(KEY_LINK_VIOLATIONS) or {}
+    logs = data.get(KEY_LOGS) or []
+
+    # row marks (vio:<chat>:<uid>) collapse to their chat shard
+    shards = {m if m.count(":") < 2 else m.rsplit(":", 1)[0] for m in shards}
+
+    if DIRTY_ALL in shards:
+        shards = set(shards) | _rt_all_shards(data)
+        # stale shard files (chat cleared / day rotated out) get deleted
+        for fn in cache.get("files") or set():
+            if fn.startswith(RT_SHARD_PREFIX + "."):
+                kind, _, rest = fn[len(RT_SHARD_PREFIX) + 1:].partition(".")
+                shards.add(f"{kind}:{rest[:-len('.json')]}")
+        if cache.get("migrate_legacy"):
+            shards.add("legacy")
+
+    by_day = None
+    out = {}
+    for shard in shards:
+        if shard == DIRTY_ALL:
+            continue
+        if shard == "legacy":
+            out[RT_FILENAME] = None
+            continue
+        kind, _, key = shard.partition(":")
+        if kind == RT_SHARD_VIO:
+            part = vio.get(key)
+            out[_rt_vio_filename(key)] = _json_snapshot(part, separators=(",", ":")) if part else None
+        elif kind == RT_SHARD_LOGS:
+            if by_day is None:
+                by_day = {}
+                for e in list(logs):
+                    by_day.setdefault(_log_day(e), []).append(e)
+            part = by_day.get(key)
+            out[_rt_logs_filename(key)] = _json_snapshot(part, separators=(",", ":")) if part else None
+    return out
+
+
+# ================== Storage backends ==================
+# Every backend exposes the same interface; CORE_DATA / RT_DATA stay the in-memory read model
+# and flush_*_if_due hands the backend the dirty marks collected since the last save.
+class GistStore:
+    name = "gist"
+    snapshot_ok = True  # ETags are stable across processes
+
+    def core_enabled(self) -> bool:
+        return bool(GIST_TOKEN and GIST_ID_CORE)
+
+    def rt_enabled(self) -> bool:
+        return bool(GIST_TOKEN and GIST_ID_RT_JARVIS)
+
+    def load_core(self, cache: dict):
+        return _gist_get_by_id(GIST_ID_CORE, CORE_FILENAME, cache, _ensure_core_defaults)
+
+    def load_rt(self, cache: dict):
+        return _rt_files_from_gist(GIST_ID_RT_JARVIS, cache)
+
+    def save_core(self, data: dict, marks: set, cache: dict):
+        # core is one small shared document (SparkSign reads it too): always whole-file
+        _gist_patch_by_id(GIST_ID_CORE, CORE_FILENAME, data, cache)
+
+    def save_rt(self, data: dict, marks: set, cache: dict):
+        _gist_patch_files(GIST_ID_RT_JARVIS, _rt_shard_payload(data, marks, cache), cache)
+
+
+class SqliteStore:
+    """
+    Local SQLite engine: row-level upserts keyed by the dirty marks.
+    cache["etag"] holds PRAGMA data_version, so other processes' commits trigger a reload.
+    """
+    name = "sqlite"
+    snapshot_ok = False  # already local; data_version is per-connection
+
+    def __init__(self, path: str, seed=None):
+        self.path = path
+        self.seed = seed  # optional GistStore to import from when the DB is empty
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS core_kv (
+                    section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                    PRIMARY KEY (section, key)
+                );
+                CREATE TABLE IF NOT EXISTS link_violations (
+                    chat TEXT NOT NULL, uid TEXT NOT NULL, count INTEGER NOT NULL, last_time TEXT,
+                    PRIMARY KEY (chat, uid)
+                );
+                CREATE TABLE IF NOT EXISTS admin_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, day TEXT NOT NULL, entry TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_admin_logs_day ON admin_logs(day);
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def core_enabled(self) -> bool:
+        return True
+
+    def rt_enabled(self) -> bool:
+        return True
+
+    def _unchanged(self, db, cache: dict) -> bool:
+        ver = f"sqlite:{db.execute('PRAGMA data_version').fetchone()[0]}"
+        if cache.get("etag") == ver:
+            return True
+        cache["etag"] = ver
+        return False
+
+    # ---------- core ----------
+    def load_core(self, cache: dict):
+        with self._lock:
+            db = self._db()
+            if self._unchanged(db, cache):
+                return None
+            rows = db.execute("SELECT section, key, value FROM core_kv").fetchall()
+            if not rows and self.seed is not None and self.seed.core_enabled():
+                loaded = self.seed.load_core({}) or {}
+                self.save_core(_ensure_core_defaults(loaded), {DIRTY_ALL}, cache)
+                return _ensure_core_defaults(loaded)
+            loaded = {}
+            for section, key, value in rows:
+                v = json.loads(value)
+                if key == "":
+                    loaded[section] = v
+                else:
+                    loaded.setdefault(section, {})[key] = v
+            return _ensure_core_defaults(loaded)
+
+    def _put_core_section(self, db, data: dict, section: str):
+        db.execute("DELETE FROM core_kv WHERE section = ?", (section,))
+        value = data.get(section)
+        if isinstance(value, dict):
+            db.executemany(
+                "INSERT INTO core_kv (section, key, value) VALUES (?, ?, ?)",
+                [(section, str(k), _json_snapshot(v)) for k, v in list(value.items())],
+            )
+        elif value is not None:
+            db.execute("INSERT INTO core_kv (section, key, value) VALUES (?, '', ?)", (section, _json_snapshot(value)))
+
+    def save_core(self, data: dict, marks: set, cache: dict):
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                if DIRTY_ALL in marks:
+                    db.execute("DELETE FROM core_kv")
+                    for section in list(data.keys()):
+                        self._put_core_section(db, data, section)
+                else:
+                    for m in marks:
+                        section, _, key = m.partition(":")
+                        if not key:
+                            self._put_core_section(db, data, section)
+                            continue
+                        value = (data.get(section) or {}).get(key)
+                        if value is None:
+                            db.execute("DELETE FROM core_kv WHERE section = ? AND key = ?", (section, key))
+                        else:
+                            db.execute(
+                                "INSERT INTO core_kv (section, key, value) VALUES (?, ?, ?) "
+                                "ON CONFLICT(section, key) DO UPDATE SET value = excluded.value",
+                                (section, key, _json_snapshot(value)),
+                            )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    # ---------- rt ----------
+    def load_rt(self, cache: dict):
+        with self._lock:
+            db = self._db()
+            if self._unchanged(db, cache):
+                return None
+            vio = {}
+            for chat, uid, count, last_time in db.execute("SELECT chat, uid, count, last_time FROM link_violations"):
+                vio.setdefault(chat, {})[uid] = {"count": int(count), "last_time": last_time}
+            rows = db.execute("SELECT entry FROM admin_logs ORDER BY id DESC LIMIT ?", (MAX_LOGS,)).fetchall()
+            if not vio and not rows and self.seed is not None and self.seed.rt_enabled():
+                loaded = _ensure_rt_defaults(self.seed.load_rt({}) or {})
+                self.save_rt(loaded, {DIRTY_ALL}, cache)
+                return loaded
+            logs = [json.loads(r[0]) for r in reversed(rows)]
+            return _ensure_rt_defaults({KEY_LINK_VIOLATIONS: vio, KEY_LOGS: logs})
+
+    def _put_vio_row(self, db, vio: dict, ck: str, uid: str):
+        rec = (vio.get(ck) or {}).get(uid)
+        if not rec:
+            db.execute("DELETE FROM link_violations WHERE chat = ? AND uid = ?", (ck, uid))
+            return
+        db.execute(
+            "INSERT INTO link_violations (chat, uid, count, last_time) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(chat, uid) DO UPDATE SET count = excluded.count, last_time = excluded.last_time",
+            (ck, uid, int(rec.get("count", 0) or 0), str(rec.get("last_time", "") or "")),
+        )
+
+    def _put_vio_chat(self, db, vio: dict, ck: str):
+        db.execute("DELETE FROM link_violations WHERE chat = ?", (ck,))
+        for uid in list((vio.get(ck) or {}).keys()):
+            self._put_vio_row(db, vio, ck, uid)
+
+    def _put_logs_day(self, db, logs: list, day: str):
+        db.execute("DELETE FROM admin_logs WHERE day = ?", (day,))
+        db.executemany(
+            "INSERT INTO admin_logs (day, entry) VALUES (?, ?)",
+            [(day, _json_snapshot(e)) for e in logs if _log_day(e) == day],
+        )
+
+    def save_rt(self, data: dict, marks: set, cache: dict):
+        vio = data.get(KEY_LINK_VIOLATIONS) or {}
+        logs = list(data.get(KEY_LOGS) or [])
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                if DIRTY_ALL in marks:
+                    db.execute("DELETE FROM link_violations")
+                    db.execute("DELETE FROM admin_logs")
+                    for ck in list(vio.keys()):
+                        self._put_vio_chat(db, vio, ck)
+                    for day in sorted({_log_day(e) for e in logs}):
+                        self._put_logs_day(db, logs, day)
+                else:
+                    for m in marks:
+                        parts = m.split(":")
+                        if parts[0] == RT_SHARD_VIO and len(parts) == 3:
+                            self._put_vio_row(db, vio, parts[1], parts[2])
+                        elif parts[0] == RT_SHARD_VIO and len(parts) == 2:
+                            self._put_vio_chat(db, vio, parts[1])
+                        elif parts[0] == RT_SHARD_LOGS and len(parts) == 2:
+                            self._put_logs_day(db, logs, parts[1])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+
+def _make_store(kind: str):
+    if kind == "sqlite":
+        return SqliteStore(SQLITE_PATH, seed=GistStore())
+    return GistStore()
+
+
+STORE_CORE = _make_store(CORE_STORAGE)
+STORE_RT = STORE_CORE if (RT_STORAGE == CORE_STORAGE and CORE_STORAGE == "sqlite") else _make_store(RT_STORAGE)
+
+
+def _load_core(force: bool = False):
     global CORE_DATA
-    if not GIST_TOKEN or not GIST_ID_CORE:
+    if not STORE_CORE.core_enabled():
         if not CORE_DATA:
             CORE_DATA = get_default_core()
         return
@@ -297,13 +1144,29 @@ def refresh_core(force: bool = False):
         if (not force) and CORE_DATA and (now - float(CORE_CACHE.get("loaded_ts", 0) or 0) < DATA_TTL_SEC):
             return
 
-        loaded = _gist_get_by_id(GIST_ID_CORE, CORE_FILENAME, CORE_CACHE, _ensure_core_defaults)
+        saves = CORE_CACHE.get("save_seq", 0)
+        loaded = STORE_CORE.load_core(CORE_CACHE)
         if loaded is None:
+            stat_inc("core_not_modified")
             CORE_CACHE["loaded_ts"] = now
             _cb_record_success(CORE_CACHE)
             return
-        CORE_DATA = loaded
+        with DATA_LOCK_CORE:
+            if CORE_CACHE.get("save_seq", 0) != saves:
+                # a flush landed while we were loading: this document may predate it; next revalidation refetches
+                stat_inc("core_stale_load_dropped")
+                return
+            # decide on the dirty state *now*: writes made while the load was in flight count too
+            prev_base = CORE_CACHE.get("base")
+            CORE_CACHE["base"] = copy.deepcopy(loaded)
+            with DIRTY_MARKS_LOCK:
+                marks = set(CORE_CACHE.get("dirty_marks") or ()) | set(CORE_CACHE.get("flushing_marks") or ())
+            if marks and CORE_DATA:
+                CORE_DATA = _merge_dirty("core", prev_base, CORE_DATA, loaded, marks)
+            else:
+                CORE_DATA = loaded
         CORE_CACHE["loaded_ts"] = now
+        _snapshot_save("core", CORE_CACHE, force=True)
         _cb_record_success(CORE_CACHE)
     except Exception as e:
         _cb_record_failure(CORE_CACHE, f"refresh_core: {e}")
@@ -316,9 +1179,9 @@ def refresh_core(force: bool = False):
             pass
 
 
-def refresh_rt(force: bool = False):
+def _load_rt(force: bool = False):
     global RT_DATA
-    if not GIST_TOKEN or not GIST_ID_RT_JARVIS:
+    if not STORE_RT.rt_enabled():
         if not RT_DATA:
             RT_DATA = get_default_rt_jarvis()
         return
@@ -341,13 +1204,29 @@ def refresh_rt(force: bool = False):
         if (not force) and RT_DATA and (now - float(RT_CACHE.get("loaded_ts", 0) or 0) < DATA_TTL_SEC):
             return
 
-        loaded = _gist_get_by_id(GIST_ID_RT_JARVIS, RT_FILENAME, RT_CACHE, _ensure_rt_defaults)
+        saves = RT_CACHE.get("save_seq", 0)
+        loaded = STORE_RT.load_rt(RT_CACHE)
         if loaded is None:
+            stat_inc("rt_not_modified")
             RT_CACHE["loaded_ts"] = now
             _cb_record_success(RT_CACHE)
             return
-        RT_DATA = loaded
+        with DATA_LOCK_RT:
+            if RT_CACHE.get("save_seq", 0) != saves:
+                # a flush landed while we were loading: this document may predate it; next revalidation refetches
+                stat_inc("rt_stale_load_dropped")
+                return
+            # decide on the dirty state *now*: writes made while the load was in flight count too
+            prev_base = RT_CACHE.get("base")
+            RT_CACHE["base"] = copy.deepcopy(loaded)
+            with DIRTY_MARKS_LOCK:
+                marks = set(RT_CACHE.get("dirty_marks") or ()) | set(RT_CACHE.get("flushing_marks") or ())
+            if marks and RT_DATA:
+                RT_DATA = _merge_dirty("rt", prev_base, RT_DATA, loaded, marks)
+            else:
+                RT_DATA = loaded
         RT_CACHE["loaded_ts"] = now
+        _snapshot_save("rt", RT_CACHE, force=True)
         _cb_record_success(RT_CACHE)
     except Exception as e:
         _cb_record_failure(RT_CACHE, f"refresh_rt: {e}")
@@ -360,99 +1239,491 @@ def refresh_rt(force: bool = False):
             pass
 
 
-def refresh_data(force: bool = False):
-    refresh_core(force=force)
-    refresh_rt(force=force)
-
-
-def mark_dirty_core():
-    CORE_CACHE["dirty"] = True
-    CORE_CACHE["dirty_ts"] = _now()
-
+# ---------- warm-start snapshot ----------
+def _snapshot_path(side: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"10k_dog_jarvis_{side}.snapshot.json")
 
-def mark_dirty_rt():
-    RT_CACHE["dirty"] = True
-    RT_CACHE["dirty_ts"] = _now()
 
-
-def flush_core_if_due(force: bool = False):
-    if not GIST_TOKEN or not GIST_ID_CORE or not CORE_DATA or not CORE_CACHE.get("dirty"):
+def _snapshot_save(side: str, cache: dict, force: bool = False):
+    """
+    Persist the synced base + its ETag. Throttled; data and ETag always travel together,
+    so an older snapshot is still a consistent If-None-Match pair.
+    """
+    store = STORE_CORE if side == "core" else STORE_RT
+    if not SNAPSHOT_ENABLED or not getattr(store, "snapshot_ok", False) or cache.get("base") is None:
         return
     now = _now()
-    if (not force) and (now - float(CORE_CACHE.get("dirty_ts", 0) or 0) < SAVE_DEBOUNCE_SEC):
-        return
-    if _cb_is_open(CORE_CACHE):
+    if (not force) and now - float(cache.get("snapshot_ts", 0) or 0) < SNAPSHOT_MIN_INTERVAL_SEC:
         return
-    if not SAVE_LOCK_CORE.acquire(timeout=0.15):
-        return
-
+    cache["snapshot_ts"] = now
     try:
-        now = _now()
-        if (not force) and (now - float(CORE_CACHE.get("dirty_ts", 0) or 0) < SAVE_DEBOUNCE_SEC):
-            return
-        CORE_CACHE["last_flush_ts"] = now
-        _gist_patch_by_id(GIST_ID_CORE, CORE_FILENAME, CORE_DATA, CORE_CACHE)
-        CORE_CACHE["dirty"] = False
-        CORE_CACHE["last_ok_flush_ts"] = now
-        _cb_record_success(CORE_CACHE)
+        path = _snapshot_path(side)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        body = {
+            "etag": cache.get("etag"),
+            "files": sorted(cache.get("files") or []),
+            "saved_ts": now,
+            "data": cache.get("base"),
+        }
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(_json_snapshot(body, separators=(",", ":")))
+        os.replace(tmp, path)
     except Exception as e:
-        _cb_record_failure(CORE_CACHE, f"flush_core: {e}")
-    finally:
-        try:
-            SAVE_LOCK_CORE.release()
-        except Exception:
-            pass
-
+        print(f"[SNAPSHOT_SAVE_ERR] {side}:", e)
 
-def flush_rt_if_due(force: bool = False):
-    if not GIST_TOKEN or not GIST_ID_RT_JARVIS or not RT_DATA or not RT_CACHE.get("dirty"):
-        return
-    now = _now()
-    if (not force) and (now - float(RT_CACHE.get("dirty_ts", 0) or 0) < SAVE_DEBOUNCE_SEC):
-        return
-    if _cb_is_open(RT_CACHE):
-        return
-    if not SAVE_LOCK_RT.acquire(timeout=0.15):
-        return
 
+def _snapshot_load(side: str, cache: dict, ensure_fn):
+    """
+    Returns the snapshot document (and primes ETag/base) or None.
+    loaded_ts stays 0 so the first accessor revalidates in the background.
+    """
+    store = STORE_CORE if side == "core" else STORE_RT
+    if not SNAPSHOT_ENABLED or not getattr(store, "snapshot_ok", False):
+        return None
     try:
-        now = _now()
-        if (not force) and (now - float(RT_CACHE.get("dirty_ts", 0) or 0) < SAVE_DEBOUNCE_SEC):
-            return
-        RT_CACHE["last_flush_ts"] = now
-        _gist_patch_by_id(GIST_ID_RT_JARVIS, RT_FILENAME, RT_DATA, RT_CACHE)
-        RT_CACHE["dirty"] = False
-        RT_CACHE["last_ok_flush_ts"] = now
-        _cb_record_success(RT_CACHE)
+        with open(_snapshot_path(side), "r", encoding="utf-8") as f:
+            body = json.load(f)
+        data = body.get("data")
+        if not isinstance(data, dict) or not data:
+            return None
+        cache["etag"] = body.get("etag")
+        cache["files"] = set(body.get("files") or [])
+        cache["base"] = copy.deepcopy(data)
+        cache["loaded_ts"] = 0.0
+        cache["snapshot_ts"] = float(body.get("saved_ts", 0) or 0)
+        return ensure_fn(data)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        _cb_record_failure(RT_CACHE, f"flush_rt: {e}")
-    finally:
-        try:
-            SAVE_LOCK_RT.release()
-        except Exception:
-            pass
-
+        print(f"[SNAPSHOT_LOAD_ERR] {side}:", e)
+        return None
 
-def try_flush_dirty(force: bool = False):
-    # Opportunistic flush, split
-    flush_core_if_due(force=force)
-    flush_rt_if_due(force=force)
 
+def warm_start():
+    """
+    Cold start: serve the disk snapshot immediately, fall back to a blocking load per side.
+    """
+    global CORE_DATA, RT_DATA
+    core = _snapshot_load("core", CORE_CACHE, _ensure_core_defaults) if STORE_CORE.core_enabled() else None
+    if core is not None:
+        CORE_DATA = core
+        stat_inc("core_warm_start_snapshot")
+    else:
+        refresh_core(force=True)
 
-def update_core(key, value):
-    refresh_core(force=False)
-    CORE_DATA[key] = value
-    mark_dirty_core()
+    rt = _snapshot_load("rt", RT_CACHE, _ensure_rt_defaults) if STORE_RT.rt_enabled() else None
+    if rt is not None:
+        RT_DATA = rt
+        stat_inc("rt_warm_start_snapshot")
+    else:
+        refresh_rt(force=True)
+
+
+# ---------- dirty-aware reload (three-way merge) ----------
+# cache["base"] is the last synced document (loaded or flushed). On reload while dirty,
+# every dirty mark is merged base/local/remote; everything else takes the remote copy.
+def _mark_path(side: str, mark: str):
+    if mark == DIRTY_ALL:
+        return ()
+    if side == "core":
+        section, _, key = mark.partition(":")
+        return (section, key) if key else (section,)
+    kind, _, rest = mark.partition(":")
+    if kind == RT_SHARD_VIO:
+        return (KEY_LINK_VIOLATIONS,) + tuple(rest.split(":", 1))
+    return (KEY_LOGS,)
+
+
+def _get_path(doc, path):
+    for p in path:
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(p)
+    return doc
+
+
+def _set_path(doc: dict, path, value):
+    if not path:
+        return
+    for p in path[:-1]:
+        nxt = doc.get(p)
+        if not isinstance(nxt, dict):
+            if value is None:
+                return
+            nxt = {}
+            doc[p] = nxt
+        doc = nxt
+    if value is None:
+        doc.pop(path[-1], None)
+    else:
+        doc[path[-1]] = value
+
+
+def _merge3(base, local, remote, key=None):
+    if local == base:
+        return remote
+    if remote == base:
+        return local
+    if key == "count" and all(isinstance(v, int) for v in (local, remote)):
+        # violation counters: apply our delta on top of theirs
+        return max(0, remote + local - (base if isinstance(base, int) else 0))
+    if isinstance(local, dict) and isinstance(remote, dict):
+        b = base if isinstance(base, dict) else {}
+        out = {}
+        for k in set(local) | set(remote) | set(b):
+            v = _merge3(b.get(k), local.get(k), remote.get(k), k)
+            if v is not None:
+                out[k] = v
+        return out
+    if isinstance(local, list) and isinstance(remote, list):
+        # logs: union, ordered by timestamp
+        seen = set()
+        out = []
+        for e in remote + local:
+            sig = json.dumps(e, sort_keys=True, ensure_ascii=False)
+            if sig not in seen:
+                seen.add(sig)
+                out.append(e)
+        out.sort(key=lambda e: str((e or {}).get("timestamp", "")) if isinstance(e, dict) else "")
+        return out[-MAX_LOGS:]
+    return local
+
+
+def _merge_dirty(side: str, base, local: dict, remote: dict, marks: set) -> dict:
+    """
+    Keep unflushed local writes (per dirty mark) on top of a freshly loaded remote document.
+    Caller holds the side's DATA_LOCK, so no request writes while we merge.
+    """
+    base = base or {}
+    merged = remote
+    for mark in marks:
+        path = _mark_path(side, mark)
+        value = _merge3(_get_path(base, path), _get_path(local, path), _get_path(remote, path))
+        if not path:
+            merged = value if isinstance(value, dict) else merged
+        else:
+            _set_path(merged, path, copy.deepcopy(value))
+    stat_inc(f"{side}_merged_reloads")
+    return merged
+
+
+def _base_apply(side: str, cache: dict, data: dict, marks: set):
+    """
+    After a successful save, the flushed values become the new merge base.
+    """
+    base = cache.get("base")
+    if base is None or DIRTY_ALL in marks:
+        cache["base"] = json.loads(_json_snapshot(data))
+        return
+    for mark in marks:
+        path = _mark_path(side, mark)
+        v = _get_path(data, path)
+        _set_path(base, path, json.loads(_json_snapshot(v)) if v is not None else None)
+
+
+_REVALIDATE_LOCK = threading.Lock()
+
+
+def _revalidate_async(cache: dict, load_fn, label: str):
+    """
+    Single-flight background revalidation (conditional GET with the stored ETag).
+    """
+    if _cb_is_open(cache):
+        return
+    with _REVALIDATE_LOCK:
+        if cache.get("revalidating"):
+            return
+        cache["revalidating"] = True
+
+    def run():
+        t0 = _now()
+        try:
+            load_fn(force=False)
+        except Exception as e:
+            print(f"[REVALIDATE_ERR] {label}:", e)
+        finally:
+            stat_observe(f"{label}_revalidate_ms", (_now() - t0) * 1000.0)
+            cache["revalidating"] = False
+
+    stat_inc(f"{label}_revalidations")
+    try:
+        threading.Thread(target=run, name=f"revalidate-{label}", daemon=True).start()
+    except Exception:
+        cache["revalidating"] = False
+
+
+def refresh_core(force: bool = False):
+    """
+    Stale-while-revalidate: only a cold cache (or force=True) loads inline.
+    An expired TTL keeps serving the in-memory snapshot and revalidates in the background.
+    """
+    if force or not CORE_DATA or not STORE_CORE.core_enabled():
+        _load_core(force=force)
+        return
+    if _now() - float(CORE_CACHE.get("loaded_ts", 0) or 0) < DATA_TTL_SEC:
+        return
+    stat_inc("core_stale_serves")
+    _revalidate_async(CORE_CACHE, _load_core, "core")
+
+
+def refresh_rt(force: bool = False):
+    if force or not RT_DATA or not STORE_RT.rt_enabled():
+        _load_rt(force=force)
+        return
+    if _now() - float(RT_CACHE.get("loaded_ts", 0) or 0) < DATA_TTL_SEC:
+        return
+    stat_inc("rt_stale_serves")
+    _revalidate_async(RT_CACHE, _load_rt, "rt")
+
+
+def refresh_data(force: bool = False):
+    refresh_core(force=force)
+    refresh_rt(force=force)
+
+
+def _mark_dirty(cache: dict):
+    if not cache.get("dirty"):
+        cache["dirty_since"] = _now()
+    cache["dirty"] = True
+    cache["dirty_ts"] = _now()
+    cache["dirty_gen"] = int(cache.get("dirty_gen", 0) or 0) + 1
+    # non-blocking: just wake the persistence worker so it re-plans its deadline
+    _PERSIST_WAKE.set()
+
+
+def mark_dirty_core(mark: str = DIRTY_ALL):
+    with DIRTY_MARKS_LOCK:
+        CORE_CACHE.setdefault("dirty_marks", set()).add(mark or DIRTY_ALL)
+    _mark_dirty(CORE_CACHE)
+
+
+def mark_dirty_rt(mark: str = DIRTY_ALL):
+    with DIRTY_MARKS_LOCK:
+        RT_CACHE.setdefault("dirty_marks", set()).add(mark or DIRTY_ALL)
+    _mark_dirty(RT_CACHE)
+
+
+def _flush_due(cache: dict, now: float) -> bool:
+    # trailing debounce, capped so a continuously written cache still flushes
+    if now - float(cache.get("dirty_ts", 0) or 0) >= SAVE_DEBOUNCE_SEC:
+        return True
+    return now - float(cache.get("dirty_since", 0) or 0) >= SAVE_MAX_DELAY_SEC
+
+
+def flush_core_if_due(force: bool = False):
+    if not STORE_CORE.core_enabled() or not CORE_DATA or not CORE_CACHE.get("dirty"):
+        return
+    now = _now()
+    if (not force) and not _flush_due(CORE_CACHE, now):
+        return
+    if _cb_is_open(CORE_CACHE):
+        return
+    if not SAVE_LOCK_CORE.acquire(timeout=0.15):
+        return
+
+    try:
+        now = _now()
+        if (not force) and not _flush_due(CORE_CACHE, now):
+            return
+        CORE_CACHE["last_flush_ts"] = now
+        gen = CORE_CACHE.get("dirty_gen", 0)
+        with DIRTY_MARKS_LOCK:
+            taken = CORE_CACHE.get("dirty_marks") or {DIRTY_ALL}
+            CORE_CACHE["dirty_marks"] = set()
+            CORE_CACHE["flushing_marks"] = taken  # a reload during the save still merges these
+        try:
+            STORE_CORE.save_core(CORE_DATA, taken, CORE_CACHE)
+        except Exception:
+            with DIRTY_MARKS_LOCK:
+                CORE_CACHE["dirty_marks"] |= taken
+            raise
+        CORE_CACHE["save_seq"] = CORE_CACHE.get("save_seq", 0) + 1
+        _base_apply("core", CORE_CACHE, CORE_DATA, taken)
+        _snapshot_save("core", CORE_CACHE)
+        # writes that landed while the PATCH was in flight keep the cache dirty
+        if CORE_CACHE.get("dirty_gen", 0) == gen:
+            CORE_CACHE["dirty"] = False
+        else:
+            CORE_CACHE["dirty_since"] = now
+        CORE_CACHE["last_ok_flush_ts"] = now
+        _cb_record_success(CORE_CACHE)
+    except Exception as e:
+        _cb_record_failure(CORE_CACHE, f"flush_core: {e}")
+    finally:
+        CORE_CACHE["flushing_marks"] = None
+        try:
+            SAVE_LOCK_CORE.release()
+        except Exception:
+            pass
 
 
-def update_rt(key, value):
+def flush_rt_if_due(force: bool = False):
+    if not STORE_RT.rt_enabled() or not RT_DATA or not RT_CACHE.get("dirty"):
+        return
+    now = _now()
+    if (not force) and not _flush_due(RT_CACHE, now):
+        return
+    if _cb_is_open(RT_CACHE):
+        return
+    if not SAVE_LOCK_RT.acquire(timeout=0.15):
+        return
+
+    try:
+        now = _now()
+        if (not force) and not _flush_due(RT_CACHE, now):
+            return
+        RT_CACHE["last_flush_ts"] = now
+        gen = RT_CACHE.get("dirty_gen", 0)
+        with DIRTY_MARKS_LOCK:
+            taken = RT_CACHE.get("dirty_marks") or {DIRTY_ALL}
+            RT_CACHE["dirty_marks"] = set()
+            RT_CACHE["flushing_marks"] = taken  # a reload during the save still merges these
+        try:
+            STORE_RT.save_rt(RT_DATA, taken, RT_CACHE)
+        except Exception:
+            with DIRTY_MARKS_LOCK:
+                RT_CACHE["dirty_marks"] |= taken
+            raise
+        RT_CACHE["migrate_legacy"] = False
+        RT_CACHE["save_seq"] = RT_CACHE.get("save_seq", 0) + 1
+        _base_apply("rt", RT_CACHE, RT_DATA, taken)
+        _snapshot_save("rt", RT_CACHE)
+        # writes that landed while the PATCH was in flight keep the cache dirty
+        if RT_CACHE.get("dirty_gen", 0) == gen:
+            RT_CACHE["dirty"] = False
+        else:
+            RT_CACHE["dirty_since"] = now
+        RT_CACHE["last_ok_flush_ts"] = now
+        _cb_record_success(RT_CACHE)
+    except Exception as e:
+        _cb_record_failure(RT_CACHE, f"flush_rt: {e}")
+    finally:
+        RT_CACHE["flushing_marks"] = None
+        try:
+            SAVE_LOCK_RT.release()
+        except Exception:
+            pass
+
+
+def try_flush_dirty(force: bool = False):
+    # Synchronous flush, split (worker / shutdown / PERSIST_WORKER=0)
+    flush_core_if_due(force=force)
+    flush_rt_if_due(force=force)
+
+
+def _persist_next_wait():
+    """
+    Seconds until the next flush is due (None = sleep until woken).
+    """
+    now = _now()
+    waits = []
+    for cache in (CORE_CACHE, RT_CACHE):
+        if not cache.get("dirty"):
+            continue
+        due = min(
+            float(cache.get("dirty_ts", 0) or 0) + SAVE_DEBOUNCE_SEC,
+            float(cache.get("dirty_since", 0) or 0) + SAVE_MAX_DELAY_SEC,
+        )
+        due = max(due, float(cache.get("cb_open_until", 0) or 0))
+        waits.append(max(0.05, due - now))
+    if not waits:
+        return None
+    return max(min(waits), _PERSIST_STATE["backoff"])
+
+
+def _persist_worker_loop():
+    while True:
+        try:
+            _PERSIST_WAKE.wait(timeout=_persist_next_wait())
+            _PERSIST_WAKE.clear()
+            force = bool(_PERSIST_STATE["force"])
+            _PERSIST_STATE["force"] = False
+
+            if _PERSIST_STATE["backoff"] and not force:
+                # still backing off from a failed flush; only sleep out the remainder
+                if _now() - float(_PERSIST_STATE.get("last_attempt_ts", 0) or 0) < _PERSIST_STATE["backoff"]:
+                    continue
+
+            _PERSIST_STATE["last_attempt_ts"] = _now()
+            try_flush_dirty(force=force)
+
+            # still dirty + past debounce => the flush failed (or CB is open): back off
+            now = _now()
+            failed = any(
+                c.get("dirty") and _flush_due(c, now)
+                for c in (CORE_CACHE, RT_CACHE)
+            )
+            if failed:
+                prev = _PERSIST_STATE["backoff"]
+                _PERSIST_STATE["backoff"] = min(PERSIST_BACKOFF_MAX_SEC, max(PERSIST_BACKOFF_MIN_SEC, prev * 2))
+            else:
+                _PERSIST_STATE["backoff"] = 0.0
+        except Exception as e:
+            print("[PERSIST_ERR]", e)
+
+
+def start_persist_worker():
+    if not PERSIST_WORKER_ENABLED:
+        return
+    t = _PERSIST_STATE.get("thread")
+    if t is not None and t.is_alive():
+        return
+    with _PERSIST_START_LOCK:
+        t = _PERSIST_STATE.get("thread")
+        if t is not None and t.is_alive():
+            return
+        t = threading.Thread(target=_persist_worker_loop, name="persist-worker", daemon=True)
+        t.start()
+        _PERSIST_STATE["thread"] = t
+
+
+def request_flush(force: bool = False):
+    """
+    Non-blocking: ask the persistence worker to flush (force skips debounce).
+    """
+    if not PERSIST_WORKER_ENABLED:
+        try_flush_dirty(force=force)
+        return
+    if force:
+        _PERSIST_STATE["force"] = True
+    start_persist_worker()  # re-spawn after fork (gunicorn) if needed
+    _PERSIST_WAKE.set()
+
+
+def update_core(key, value, marks=None):
+    refresh_core(force=False)
+    with DATA_LOCK_CORE:
+        CORE_DATA[key] = value
+        for mark in (marks or [core_mark(key)]):
+            mark_dirty_core(mark)
+
+
+def update_rt(key, value, marks=None):
     refresh_rt(force=False)
-    RT_DATA[key] = value
-    mark_dirty_rt()
+    with DATA_LOCK_RT:
+        RT_DATA[key] = value
+        for mark in (marks or [DIRTY_ALL]):
+            mark_dirty_rt(mark)
 
 
-# initial best-effort load
-refresh_data(force=True)
+# initial best-effort load (disk snapshot first, revalidated lazily with If-None-Match)
+warm_start()
+start_persist_worker()
+stat_observe("startup_ready_ms", (_now() - _IMPORT_T0) * 1000.0)
+
+
+@atexit.register
+def _flush_on_exit():
+    # queued actions may still write violations / logs: drain them first, then persist
+    try:
+        drain_outbox(timeout=5.0)
+    except Exception:
+        pass
+    try:
+        try_flush_dirty(force=True)
+    except Exception as e:
+        print("[PERSIST_EXIT_ERR]", e)
+
 
 # ================== Data Accessors ==================
 def get_admins():
@@ -485,6 +1756,16 @@ def get_link_whitelist_map():
     return CORE_DATA.get(KEY_LINK_WHITELIST, {}) or {}
 
 
+def get_ad_keywords_map():
+    refresh_core(force=False)
+    return CORE_DATA.get(KEY_AD_KEYWORDS, {}) or {}
+
+
+def get_link_domains_map():
+    refresh_core(force=False)
+    return CORE_DATA.get(KEY_LINK_DOMAINS, {}) or {}
+
+
 def get_link_violations_map():
     refresh_rt(force=False)
     return RT_DATA.get(KEY_LINK_VIOLATIONS, {}) or {}
@@ -509,7 +1790,7 @@ def add_admin(admin_id: int, added_by: int) -> bool:
         "added_time": datetime.datetime.now(TAIWAN_TZ).isoformat(),
         "is_super": False,
     }
-    update_core(KEY_ADMINS, admins)
+    update_core(KEY_ADMINS, admins, [core_mark(KEY_ADMINS, s)])
     return True
 
 
@@ -526,7 +1807,7 @@ def remove_admin(admin_id: int, removed_by: int):
         return False, "❌ 您沒有管理員權限"
 
     del admins[s]
-    update_core(KEY_ADMINS, admins)
+    update_core(KEY_ADMINS, admins, [core_mark(KEY_ADMINS, s)])
     return True, "✅ 已移除管理員"
 
 
@@ -543,28 +1824,483 @@ def toggle_thread(chat_id, thread_id, add=True, scope="jarvis"):
         del threads[key]
 
     if scope == "jarvis":
-        update_core(KEY_THREADS_JARVIS, threads)
+        update_core(KEY_THREADS_JARVIS, threads, [core_mark(KEY_THREADS_JARVIS, key)])
     else:
-        update_core(KEY_THREADS_SPARKSIGN, threads)
+        update_core(KEY_THREADS_SPARKSIGN, threads, [core_mark(KEY_THREADS_SPARKSIGN, key)])
     return True
 
 
+# ================== Telegram rate limiting ==================
+# Token buckets in front of tg(): one global bucket for every call, plus a per-chat bucket for
+# message-producing methods. A 429's retry_after blocks the chat (or the whole bot) until it expires.
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))          # calls / sec
+TG_GLOBAL_BURST = float(os.environ.get("TG_GLOBAL_BURST", "25"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))              # private chat msgs / sec
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "3"))
+TG_GROUP_RATE_PER_MIN = float(os.environ.get("TG_GROUP_RATE_PER_MIN", "20"))
+TG_GROUP_BURST = float(os.environ.get("TG_GROUP_BURST", "5"))
+# synchronous tg() calls run on the webhook thread: give up quickly instead of queueing behind the limiter
+TG_SYNC_MAX_WAIT_SEC = float(os.environ.get("TG_SYNC_MAX_WAIT_SEC", "1"))
+TG_MAX_ATTEMPTS = int(os.environ.get("TG_MAX_ATTEMPTS", "4"))
+
+TG_SEND_METHODS = {
+    "sendMessage", "editMessageText", "sendPhoto", "sendDocument", "sendAnimation", "copyMessage", "forwardMessage",
+}
+
+# lower = sooner (across chats; each chat stays FIFO): enforcement first, UI acks next, chat messages last
+TG_PRIORITY = {
+    "deleteMessage": 0, "deleteMessages": 0, "restrictChatMember": 0, "banChatMember": 0,
+    "unbanChatMember": 0, "kick": 0,
+    "answerCallbackQuery": 1,
+    "editMessageText": 2,
+    "sendMessage": 3,
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.ts = _now()
+
+    def _refill(self, now: float):
+        if now > self.ts:
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1.0
+
+
+class RateLimiter:
+    MAX_CHAT_BUCKETS = 20000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        self._chats = {}
+        self._blocked = {}  # chat_key | "*" -> until_ts
+
+    def _chat_bucket(self, ck: str) -> TokenBucket:
+        b = self._chats.get(ck)
+        if b is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # drop buckets that are full again (idle chats)
+                now = _now()
+                for k in [k for k, v in self._chats.items() if v.wait_time(now) == 0.0 and v.tokens >= v.burst]:
+                    self._chats.pop(k, None)
+            if ck.startswith("-"):
+                b = TokenBucket(TG_GROUP_RATE_PER_MIN / 60.0, TG_GROUP_BURST)
+            else:
+                b = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            self._chats[ck] = b
+        return b
+
+    def reserve(self, method: str, chat_id=None) -> float:
+        """
+        Take the tokens and return 0, or return the seconds to wait (nothing taken).
+        """
+        now = _now()
+        ck = str(chat_id) if chat_id is not None else None
+        with self._lock:
+            blocked = max(self._blocked.get("*", 0.0), self._blocked.get(ck, 0.0) if ck else 0.0)
+            if blocked > now:
+                return blocked - now
+            wait = self._global.wait_time(now)
+            chat_b = self._chat_bucket(ck) if (ck and method in TG_SEND_METHODS) else None
+            if chat_b is not None:
+                wait = max(wait, chat_b.wait_time(now))
+            if wait > 0:
+                return wait
+            self._global.take()
+            if chat_b is not None:
+                chat_b.take()
+            return 0.0
+
+    def acquire(self, method: str, chat_id=None, max_wait: float = TG_SYNC_MAX_WAIT_SEC) -> bool:
+        t0 = _now()
+        while True:
+            wait = self.reserve(method, chat_id)
+            if wait <= 0:
+                stat_observe("tg_limiter_wait_ms", (_now() - t0) * 1000.0)
+                return True
+            if _now() - t0 + wait > max_wait:
+                stat_inc(f"tg_limiter_timeout:{method}")
+                return False
+            threading.Event().wait(min(wait, 1.0))
+
+    def penalize(self, chat_id, retry_after: float):
+        key = str(chat_id) if chat_id is not None else "*"
+        with self._lock:
+            self._blocked[key] = max(self._blocked.get(key, 0.0), _now() + float(retry_after))
+            if len(self._blocked) > 1000:
+                now = _now()
+                self._blocked = {k: v for k, v in self._blocked.items() if v > now}
+
+
+TG_LIMITER = RateLimiter()
+
+
+def _retry_after(r) -> float:
+    try:
+        return float(((r.json() or {}).get("parameters") or {}).get("retry_after") or 1)
+    except Exception:
+        return 1.0
+
+
 # ================== Telegram API helpers ==================
-def tg(method: str, payload: dict, timeout=10):
+def tg(method: str, payload: dict, timeout=10, limited=False):
+    """
+    limited=True: the caller (outbox worker) already holds a limiter slot and handles 429 itself.
+    """
+    chat_id = (payload or {}).get("chat_id")
+    if not limited and not TG_LIMITER.acquire(method, chat_id):
+        return None
     try:
-        return requests.post(f"https://api.telegram.org/bot{TOKEN}/{method}", json=payload, timeout=timeout)
+        r = _tg_post(method, payload, timeout)
+        if r is not None and r.status_code == 429:
+            ra = _retry_after(r)
+            stat_inc(f"tg_429:{method}")
+            TG_LIMITER.penalize(chat_id, ra)
+            if not limited and ra <= TG_SYNC_MAX_WAIT_SEC and TG_LIMITER.acquire(method, chat_id):
+                r = _tg_post(method, payload, timeout)
+        return r
     except Exception as e:
         print("tg err:", e)
         return None
 
 
+def _tg_post(method: str, payload: dict, timeout):
+    t0 = _now()
+    status = "error"
+    try:
+        url = f"{TG_API_BASE}/bot{TOKEN}/{method}"
+        if isinstance(payload, PreparedPayload):
+            r = http_session("telegram").post(
+                url, data=payload.to_json(), headers=_JSON_HEADERS, timeout=_http_timeout(timeout)
+            )
+        else:
+            r = http_session("telegram").post(url, json=payload, timeout=_http_timeout(timeout))
+        status = str(r.status_code)
+        return r
+    finally:
+        hist_observe("jarvis_tg_request_duration_seconds", _now() - t0,
+                     "Telegram Bot API call latency", method=method, status=status)
+
+
+# ================== Outbound action queue ==================
+# Fire-and-forget Telegram actions (deletes, restricts, warnings, panel edits, callback answers)
+# run on a small worker pool so the webhook can ack immediately. Actions are sharded by chat_id
+# into per-chat lanes: enforcement (TG_PRIORITY 0) runs FIFO ahead of the chat's other actions,
+# everything else runs FIFO after it, so nothing ever overtakes an earlier delete / restrict
+# (a warning can't beat the delete it refers to). TG_PRIORITY of each lane's head decides which
+# chat goes next. A lane whose head the rate limiter or a 429 holds back is parked, not reordered.
+# OUTBOX_WORKERS=0 runs them inline, the default on serverless hosts that freeze the process
+# after the response (queued items would be lost there).
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "0" if SERVERLESS else "4"))
+OUTBOX_MAX = int(os.environ.get("OUTBOX_MAX", "5000"))
+
+_OUTBOX = {"pid": None, "queues": [], "threads": []}
+_OUTBOX_LOCK = threading.Lock()
+
+
+class ActionQueue:
+    """
+    Per-chat lanes: heap of (0 for enforcement else 1, seq, item).
+    ready heap (priority of the lane's head, seq, chat): one entry per runnable lane; a lane handed
+    to the worker stays out of it until task_done()/defer().
+    delayed heap (not_before, seq, item): enqueue_delayed items, joining their lane when due.
+    parked heap (not_before, token, chat): lanes whose head was deferred by the limiter / a 429.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lanes = {}
+        self._state = {}  # chat -> "ready" | "running" | parked token
+        self._ready = []
+        self._delayed = []
+        self._parked = []
+        self._seq = 0
+        self._size = 0
+        self._cv = threading.Condition()
+        self.unfinished_tasks = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _make_ready(self, key):
+        self._state[key] = "ready"
+        heapq.heappush(self._ready, (self._lanes[key][0][2]["priority"], self._next_seq(), key))
+
+    def _push_item(self, key, item: dict):
+        lane = self._lanes.setdefault(key, [])
+        heapq.heappush(lane, (0 if item["priority"] <= 0 else 1, item["seq"], item))
+        return lane
+
+    def _append(self, item: dict):
+        key = str(item["chat_id"])
+        item["seq"] = self._next_seq()
+        lane = self._push_item(key, item)
+        state = self._state.get(key)
+        if state is None or (state not in ("ready", "running") and lane[0][2] is item):
+            self._make_ready(key)  # new lane, or enforcement arriving at a lane parked on a message
+
+    def put(self, item: dict, not_before: float = 0.0, force: bool = False):
+        with self._cv:
+            if not force and self._size >= self.maxsize:
+                raise queue.Full
+            if not_before > _now():
+                heapq.heappush(self._delayed, (not_before, self._next_seq(), item))
+            else:
+                self._append(item)
+            self._size += 1
+            self.unfinished_tasks += 1
+            self._cv.notify_all()  # drain_outbox may be waiting on the same condition
+
+    def defer(self, item: dict, not_before: float):
+        # back into its lane at its original position; park the lane if it is still the head
+        with self._cv:
+            key = str(item["chat_id"])
+            lane = self._push_item(key, item)
+            if lane[0][2] is item:
+                token = self._next_seq()
+                self._state[key] = token
+                heapq.heappush(self._parked, (not_before, token, key))
+            else:
+                self._make_ready(key)
+            self._size += 1
+            self._cv.notify_all()
+
+    def get(self) -> dict:
+        with self._cv:
+            while True:
+                now = _now()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._append(heapq.heappop(self._delayed)[2])
+                while self._parked and self._parked[0][0] <= now:
+                    _, token, key = heapq.heappop(self._parked)
+                    if self._state.get(key) == token:
+                        self._make_ready(key)
+                if self._ready:
+                    key = heapq.heappop(self._ready)[2]
+                    self._state[key] = "running"
+                    self._size -= 1
+                    return heapq.heappop(self._lanes[key])[2]
+                due = [h[0][0] for h in (self._delayed, self._parked) if h]
+                self._cv.wait(min(due) - now if due else None)
+
+    def task_done(self, item: dict):
+        with self._cv:
+            key = str(item["chat_id"])
+            if self._lanes.get(key):
+                self._make_ready(key)
+            else:
+                self._lanes.pop(key, None)
+                self._state.pop(key, None)
+            self.unfinished_tasks = max(0, self.unfinished_tasks - 1)
+            self._cv.notify_all()
+
+    def join(self, timeout: float) -> bool:
+        with self._cv:
+            return self._cv.wait_for(lambda: not self.unfinished_tasks, timeout)
+
+
+def _run_action(label: str, fn, args, kwargs, enq_ts: float = None):
+    t0 = _now()
+    if enq_ts is not None:
+        stat_observe("outbox_wait_ms", (t0 - enq_ts) * 1000.0)
+    ok = False
+    res = None
+    try:
+        res = fn(*args, **kwargs)
+        if isinstance(res, requests.Response):
+            ok = res.status_code == 200
+        else:
+            ok = res is not None and res is not False
+    except Exception as e:
+        print(f"[OUTBOX_ERR] {label}:", e)
+    if not (isinstance(res, requests.Response) and res.status_code == 429):
+        stat_inc(f"outbox_{'ok' if ok else 'fail'}:{label}")
+    stat_observe(f"outbox_ms:{label}", (_now() - t0) * 1000.0)
+    return res
+
+
+def _outbox_worker(q: ActionQueue):
+    while True:
+        item = q.get()
+        requeued = False
+        try:
+            method = item.get("tg_method")
+            if method:
+                wait = TG_LIMITER.reserve(method, item.get("chat_id"))
+                if wait > 0:
+                    q.defer(item, _now() + wait)
+                    requeued = True
+                    continue
+            res = _run_action(item["label"], item["fn"], item["args"], item["kwargs"], item["enq_ts"])
+            if isinstance(res, requests.Response) and res.status_code == 429:
+                item["attempts"] = int(item.get("attempts", 0)) + 1
+                if item["attempts"] < TG_MAX_ATTEMPTS:
+                    stat_inc(f"outbox_rescheduled:{item['label']}")
+                    q.defer(item, _now() + _retry_after(res))
+                    requeued = True
+                else:
+                    stat_inc(f"outbox_fail:{item['label']}")
+        finally:
+            if not requeued:
+                q.task_done(item)
+
+
+def _outbox_queues():
+    pid = os.getpid()
+    if _OUTBOX["pid"] == pid:
+        return _OUTBOX["queues"]
+    with _OUTBOX_LOCK:
+        if _OUTBOX["pid"] != pid:
+            queues = [ActionQueue(OUTBOX_MAX) for _ in range(OUTBOX_WORKERS)]
+            threads = []
+            for i, q in enumerate(queues):
+                t = threading.Thread(target=_outbox_worker, args=(q,), name=f"outbox-{i}", daemon=True)
+                t.start()
+                threads.append(t)
+            _OUTBOX.update({"pid": pid, "queues": queues, "threads": threads})
+        return _OUTBOX["queues"]
+
+
+def enqueue_action(chat_id, label: str, fn, *args, **kwargs):
+    """
+    Queue fn(*args, **kwargs) on the chat's lane (enforcement first, then FIFO; see ActionQueue).
+    """
+    _enqueue(chat_id, label, fn, args, kwargs)
+
+
+def enqueue_delayed(chat_id, label: str, delay: float, fn, *args, **kwargs):
+    """
+    Like enqueue_action, but the item becomes ready only after `delay` seconds.
+    """
+    _enqueue(chat_id, label, fn, args, kwargs, not_before=_now() + max(0.0, float(delay)))
+
+
+def _enqueue(chat_id, label: str, fn, args, kwargs, not_before: float = 0.0):
+    if OUTBOX_WORKERS <= 0:
+        if not_before > _now():
+            t = threading.Timer(not_before - _now(), _run_action, args=(label, fn, args, kwargs))
+            t.daemon = True
+            t.start()
+            return
+        _run_action(label, fn, args, kwargs)
+        return
+    queues = _outbox_queues()
+    item = {
+        "enq_ts": _now(),
+        "label": label,
+        "fn": fn,
+        "args": args,
+        "kwargs": kwargs,
+        "chat_id": chat_id,
+        "priority": TG_PRIORITY.get(label, 2),
+        "tg_method": label if fn is tg else None,
+    }
+    if fn is tg:
+        kwargs["limited"] = True
+    q = queues[hash(str(chat_id)) % len(queues)]
+    try:
+        q.put(item, not_before=not_before)
+        stat_inc("outbox_enqueued")
+    except queue.Full:
+        # 滿了（多半是 raid）：不在 webhook 執行緒上同步呼叫；執法 / callback ack 照樣排入，
+        # 警告訊息、面板編輯這類低優先的直接丟棄
+        if item["priority"] <= TG_PRIORITY["answerCallbackQuery"]:
+            q.put(item, not_before=not_before, force=True)
+            stat_inc("outbox_overflow_forced")
+        else:
+            stat_inc(f"outbox_overflow_dropped:{label}")
+
+
+def tg_async(method: str, payload: dict, timeout=10):
+    enqueue_action(payload.get("chat_id"), method, tg, method, payload, timeout=timeout)
+
+
+# ================== Inline webhook reply ==================
+# Telegram executes one method call returned in the webhook response body; the first
+# inline-eligible action of an update claims that slot, later ones use the normal API path.
+INLINE_REPLY_ENABLED = os.environ.get("INLINE_REPLY", "1") != "0"
+
+
+def _claim_inline(method: str, payload: dict) -> bool:
+    if not INLINE_REPLY_ENABLED or not has_request_context():
+        return False
+    if not getattr(g, "inline_open", False) or getattr(g, "inline_reply", None) is not None:
+        return False
+    if isinstance(payload, PreparedPayload):
+        g.inline_reply = payload.to_json(method)
+    else:
+        reply = {"method": method}
+        reply.update(payload)
+        g.inline_reply = reply
+    stat_inc(f"inline_reply:{method}")
+    return True
+
+
+def _tg_send(method: str, payload: dict, timeout=10, wait=False, inline=False):
+    if inline and not wait and _claim_inline(method, payload):
+        return None
+    if wait:
+        return tg(method, payload, timeout=timeout)
+    tg_async(method, payload, timeout=timeout)
+    return None
+
+
+def outbox_depth() -> int:
+    return sum(q.qsize() for q in (_OUTBOX.get("queues") or []))
+
+
+def drain_outbox(timeout: float = 5.0) -> bool:
+    deadline = _now() + timeout
+    for q in list(_OUTBOX.get("queues") or []):
+        q.join(max(0.0, deadline - _now()))
+    return outbox_depth() == 0
+
+
 def _prepare_reply_markup(markup):
     if isinstance(markup, str):
         return markup
     return json.dumps(markup, ensure_ascii=False)
 
 
-def send_message(chat_id, text, markup=None, thread_id=None, parse_mode=None, entities=None, disable_preview=True):
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class PreparedPayload(dict):
+    """
+    Per-send fields (chat_id, message_thread_id) as a normal dict, plus the static members of the
+    body already serialized once (`static_json`: '"text":...,"reply_markup":...' without braces).
+    """
+
+    def __init__(self, static_json: str, **fields):
+        super().__init__(fields)
+        self.static_json = static_json
+
+    def to_json(self, method: str = None) -> bytes:
+        head = dict(self)
+        if method:
+            head = {"method": method, **head}
+        parts = [json.dumps(head, ensure_ascii=False, separators=(",", ":"))[1:-1], self.static_json]
+        return ("{" + ",".join(p for p in parts if p) + "}").encode("utf-8")
+
+
+def send_message(chat_id, text, markup=None, thread_id=None, parse_mode=None, entities=None, disable_preview=True, wait=False, inline=False):
     try:
         payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": bool(disable_preview)}
         if thread_id is not None:
@@ -576,13 +2312,13 @@ def send_message(chat_id, text, markup=None, thread_id=None, parse_mode=None, en
         elif parse_mode:
             payload["parse_mode"] = parse_mode
 
-        return tg("sendMessage", payload, timeout=8)
+        return _tg_send("sendMessage", payload, timeout=8, wait=wait, inline=inline)
     except Exception as e:
         print(f"傳送訊息錯誤: {e}")
         return None
 
 
-def edit_message_text(chat_id, message_id, text, markup=None, parse_mode=None, entities=None, disable_preview=True):
+def edit_message_text(chat_id, message_id, text, markup=None, parse_mode=None, entities=None, disable_preview=True, wait=False):
     payload = {"chat_id": chat_id, "message_id": int(message_id), "text": text, "disable_web_page_preview": bool(disable_preview)}
     if markup:
         payload["reply_markup"] = _prepare_reply_markup(markup)
@@ -590,25 +2326,82 @@ def edit_message_text(chat_id, message_id, text, markup=None, parse_mode=None, e
         payload["entities"] = entities
     elif parse_mode:
         payload["parse_mode"] = parse_mode
-    return tg("editMessageText", payload, timeout=10)
+    return _tg_send("editMessageText", payload, timeout=10, wait=wait)
 
 
-def delete_message(chat_id, message_id):
-    return tg("deleteMessage", {"chat_id": chat_id, "message_id": int(message_id)}, timeout=10)
+def delete_message(chat_id, message_id, wait=False):
+    return _tg_send("deleteMessage", {"chat_id": chat_id, "message_id": int(message_id)}, timeout=10, wait=wait)
 
 
-def answer_callback(callback_id):
+def delete_messages(chat_id, message_ids, wait=False):
+    """
+    Bulk delete (deleteMessages, up to 100 ids per call); falls back to one-by-one if rejected.
+    """
+    ids = sorted({int(m) for m in message_ids if m})
+    if not wait:
+        enqueue_action(chat_id, "deleteMessages", delete_messages, chat_id, ids, wait=True)
+        return None
+    ok = True
+    for i in range(0, len(ids), 100):
+        chunk = ids[i:i + 100]
+        r = tg("deleteMessages", {"chat_id": chat_id, "message_ids": chunk}, timeout=10)
+        if r is None or r.status_code != 200:
+            ok = False
+            for mid in chunk:
+                delete_message(chat_id, mid, wait=True)
+    return ok
+
+
+def answer_callback(callback_id, chat_id=None, inline=False):
     try:
-        tg("answerCallbackQuery", {"callback_query_id": callback_id}, timeout=5)
+        payload = {"callback_query_id": callback_id}
+        if inline and _claim_inline("answerCallbackQuery", payload):
+            return
+        enqueue_action(chat_id, "answerCallbackQuery", tg, "answerCallbackQuery", {"callback_query_id": callback_id}, timeout=5)
     except:
         pass
 
 
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "1800"))
+USER_CACHE_NEG_TTL = float(os.environ.get("USER_CACHE_NEG_TTL", "600"))
+USER_CACHE_MAX = int(os.environ.get("USER_CACHE_MAX", "5000"))
+USER_CACHE = TTLCache("user_profiles", USER_CACHE_MAX, USER_CACHE_TTL, USER_CACHE_NEG_TTL)
+
+
+def remember_user(user: dict):
+    """
+    Prime the profile cache from a User object seen in an update (no API call).
+    """
+    if not isinstance(user, dict) or not user.get("id") or user.get("is_bot"):
+        return
+    try:
+        USER_CACHE.set(int(user["id"]), {
+            "id": int(user["id"]),
+            "first_name": user.get("first_name", "") or "",
+            "last_name": user.get("last_name", "") or "",
+            "username": user.get("username", "") or "",
+        })
+    except Exception:
+        pass
+
+
 def get_user_info(user_id):
     try:
-        r = tg("getChat", {"chat_id": user_id}, timeout=6)
-        if r and r.status_code == 200:
-            return r.json().get("result", {})
+        uid = int(user_id)
+    except Exception:
+        return None
+    cached = USER_CACHE.get(uid)
+    if cached is not TTLCache.MISS:
+        return cached
+    try:
+        r = tg("getChat", {"chat_id": uid}, timeout=6)
+        if r is not None and r.status_code == 200:
+            info = r.json().get("result", {})
+            USER_CACHE.set(uid, info)
+            return info
+        if r is not None and r.status_code in (400, 403):
+            # chat not found / never talked to the bot: remember that for a while
+            USER_CACHE.set_negative(uid)
     except:
         pass
     return None
@@ -641,21 +2434,87 @@ def group_user_label(user_id: int) -> str:
         return "未知用戶"
 
 
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_NEG_TTL = float(os.environ.get("CHAT_CACHE_NEG_TTL", "600"))
+CHAT_CACHE_MAX = int(os.environ.get("CHAT_CACHE_MAX", "1000"))
+CHAT_CACHE = TTLCache("chat_meta", CHAT_CACHE_MAX, CHAT_CACHE_TTL, CHAT_CACHE_NEG_TTL)
+TOPIC_CACHE = TTLCache("forum_topics", CHAT_CACHE_MAX * 8, CHAT_CACHE_TTL, CHAT_CACHE_NEG_TTL)
+
+
+def remember_chat(chat: dict):
+    """
+    Prime chat metadata from an update's chat object (groups only; users go to USER_CACHE).
+    """
+    if not isinstance(chat, dict) or not chat.get("id") or not chat.get("title"):
+        return
+    try:
+        cid = int(chat["id"])
+        prev = CHAT_CACHE.get(cid, count=False)
+        info = dict(prev) if isinstance(prev, dict) else {}
+        info.update({k: chat[k] for k in ("id", "title", "type", "username", "is_forum") if k in chat})
+        CHAT_CACHE.set(cid, info)
+    except Exception:
+        pass
+
+
+def remember_topics(msg: dict):
+    """
+    Learn forum topic names from service messages (forum_topic_created / edited);
+    topic messages also carry the creation message as reply_to_message.
+    """
+    try:
+        cid = int(msg["chat"]["id"])
+        tid = msg.get("message_thread_id")
+        for m in (msg, msg.get("reply_to_message") or {}):
+            for k in ("forum_topic_created", "forum_topic_edited"):
+                name = (m.get(k) or {}).get("name")
+                if name and tid:
+                    TOPIC_CACHE.set((cid, int(tid)), name)
+        new_title = msg.get("new_chat_title")
+        if new_title:
+            remember_chat({**msg["chat"], "title": new_title})
+    except Exception:
+        pass
+
+
 def get_chat_info(chat_id):
     try:
-        r = tg("getChat", {"chat_id": chat_id}, timeout=6)
-        if r and r.status_code == 200:
-            return r.json().get("result", {})
+        cid = int(chat_id)
+    except Exception:
+        return None
+    cached = CHAT_CACHE.get(cid)
+    if cached is not TTLCache.MISS:
+        return cached
+    try:
+        r = tg("getChat", {"chat_id": cid}, timeout=6)
+        if r is not None and r.status_code == 200:
+            info = r.json().get("result", {})
+            CHAT_CACHE.set(cid, info)
+            return info
+        if r is not None and r.status_code in (400, 403):
+            CHAT_CACHE.set_negative(cid)
     except:
         pass
     return None
 
 
 def get_thread_name(chat_id, thread_id):
+    try:
+        key = (int(chat_id), int(thread_id))
+    except Exception:
+        return "未知話題"
+    cached = TOPIC_CACHE.get(key)
+    if cached is not TTLCache.MISS:
+        return cached or "未知話題"
     try:
         r = tg("getForumTopic", {"chat_id": chat_id, "message_thread_id": thread_id}, timeout=6)
-        if r and r.status_code == 200:
-            return r.json().get("result", {}).get("name", "未知話題")
+        if r is not None and r.status_code == 200:
+            name = r.json().get("result", {}).get("name")
+            if name:
+                TOPIC_CACHE.set(key, name)
+                return name
+        if r is not None and 400 <= r.status_code < 500:
+            TOPIC_CACHE.set_negative(key)
     except:
         pass
     return "未知話題"
@@ -671,7 +2530,107 @@ def get_chat_member_status(chat_id: int, user_id: int):
     return None
 
 
-def restrict_member(chat_id: int, user_id: int, until_ts: int):
+# ---- per-chat administrator roster (getChatAdministrators, TTL + chat_member invalidation) ----
+ADMIN_ROSTER_TTL = float(os.environ.get("ADMIN_ROSTER_TTL", "600"))
+ADMIN_ROSTER_NEG_TTL = float(os.environ.get("ADMIN_ROSTER_NEG_TTL", "60"))
+ADMIN_ROSTER_MAX = int(os.environ.get("ADMIN_ROSTER_MAX", "500"))
+ADMIN_ROSTER = TTLCache("chat_admins", ADMIN_ROSTER_MAX, ADMIN_ROSTER_TTL, ADMIN_ROSTER_NEG_TTL)
+# last good roster per chat: served (briefly re-cached) when a refetch fails transiently
+ADMIN_ROSTER_RETRY_SEC = float(os.environ.get("ADMIN_ROSTER_RETRY_SEC", "15"))
+ADMIN_ROSTER_LAST = TTLCache("chat_admins_last", ADMIN_ROSTER_MAX, float(os.environ.get("ADMIN_ROSTER_LAST_TTL", "86400")))
+ADMIN_STATUSES = ("administrator", "creator")
+_ROSTER_LOCKS = {}
+_ROSTER_LOCKS_GUARD = threading.Lock()
+
+
+def _roster_lock(chat_id: int) -> threading.Lock:
+    with _ROSTER_LOCKS_GUARD:
+        lk = _ROSTER_LOCKS.get(chat_id)
+        if lk is None:
+            lk = _ROSTER_LOCKS[chat_id] = threading.Lock()
+        return lk
+
+
+def get_chat_admin_ids(chat_id: int):
+    """
+    frozenset of admin/creator user ids, or None if the roster can't be fetched.
+    Concurrent misses for the same chat share one getChatAdministrators call.
+    Only a definitive 400/403 (bot not in the chat / no rights) is negative-cached; a limiter
+    timeout, 429, 5xx or network error keeps serving the last good roster without caching the failure.
+    """
+    cid = int(chat_id)
+    cached = ADMIN_ROSTER.get(cid)
+    if cached is not TTLCache.MISS:
+        return cached
+    with _roster_lock(cid):
+        cached = ADMIN_ROSTER.get(cid, count=False)
+        if cached is not TTLCache.MISS:
+            return cached
+        stat_inc("admin_roster_fetches")
+        r = None
+        try:
+            r = tg("getChatAdministrators", {"chat_id": cid}, timeout=8)
+            if r is not None and r.status_code == 200:
+                ids = frozenset(
+                    int((m.get("user") or {}).get("id"))
+                    for m in (r.json().get("result") or [])
+                    if (m.get("user") or {}).get("id")
+                )
+                ADMIN_ROSTER.set(cid, ids)
+                ADMIN_ROSTER_LAST.set(cid, ids)
+                return ids
+        except Exception as e:
+            print("[ADMIN_ROSTER]", e)
+        if r is not None and r.status_code in (400, 403):
+            ADMIN_ROSTER.set_negative(cid)
+            ADMIN_ROSTER_LAST.pop(cid)
+            return None
+        stat_inc("admin_roster_transient_fail")
+        last = ADMIN_ROSTER_LAST.get(cid, count=False)
+        if last is TTLCache.MISS:
+            return None
+        ADMIN_ROSTER.set(cid, last, ttl=ADMIN_ROSTER_RETRY_SEC)
+        return last
+
+
+def is_chat_admin(chat_id: int, user_id: int) -> bool:
+    ids = get_chat_admin_ids(chat_id)
+    if ids is not None:
+        return int(user_id) in ids
+    # roster unavailable: fall back to a single member lookup
+    return get_chat_member_status(chat_id, user_id) in ADMIN_STATUSES
+
+
+def apply_chat_member_update(cm: dict, own: bool = False):
+    """
+    chat_member / my_chat_member: patch the cached roster in place (or drop it).
+    """
+    try:
+        remember_chat(cm.get("chat"))
+        cid = int(cm["chat"]["id"])
+        if own:
+            # bot's own rights changed: the roster may now be (un)fetchable
+            ADMIN_ROSTER.pop(cid)
+            ADMIN_ROSTER_LAST.pop(cid)
+            return
+        uid = int(((cm.get("new_chat_member") or {}).get("user") or {}).get("id"))
+        new_st = ((cm.get("new_chat_member") or {}).get("status") or "").lower()
+        old_st = ((cm.get("old_chat_member") or {}).get("status") or "").lower()
+        if (new_st in ADMIN_STATUSES) == (old_st in ADMIN_STATUSES):
+            return
+        ADMIN_ROSTER_LAST.pop(cid)
+        ids = ADMIN_ROSTER.get(cid, count=False)
+        if not isinstance(ids, frozenset):
+            ADMIN_ROSTER.pop(cid)
+            return
+        ids = ids | {uid} if new_st in ADMIN_STATUSES else ids - {uid}
+        ADMIN_ROSTER.set(cid, ids)
+        ADMIN_ROSTER_LAST.set(cid, ids)
+    except Exception as e:
+        print("[CHAT_MEMBER]", e)
+
+
+def restrict_member(chat_id: int, user_id: int, until_ts: int, wait=False):
     payload = {
         "chat_id": chat_id,
         "user_id": user_id,
@@ -693,16 +2652,20 @@ def restrict_member(chat_id: int, user_id: int, until_ts: int):
             "can_manage_topics": False,
         },
     }
-    return tg("restrictChatMember", payload, timeout=10)
+    return _tg_send("restrictChatMember", payload, timeout=10, wait=wait)
+
 
+def ban_member(chat_id: int, user_id: int, wait=False):
+    return _tg_send("banChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=10, wait=wait)
 
-def ban_member(chat_id: int, user_id: int):
-    return tg("banChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=10)
 
+def kick_member_no_ban(chat_id: int, user_id: int, wait=False):
+    if not wait:
+        # ban + unban must stay back-to-back: run the whole sequence as one queued action
+        enqueue_action(chat_id, "kick", kick_member_no_ban, chat_id, user_id, wait=True)
+        return None
 
-def kick_member_no_ban(chat_id: int, user_id: int):
-    st = get_chat_member_status(chat_id, user_id)
-    if st in ("administrator", "creator"):
+    if is_chat_admin(chat_id, user_id):
         return False
 
     r1 = tg("banChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=10)
@@ -733,10 +2696,13 @@ def log_action(admin_id, action, target=None, details=None):
             log_entry["target_name"] = get_display_name(target_info)
 
     logs.append(log_entry)
-    if len(logs) > 200:
-        logs = logs[-200:]
+    marks = {rt_mark_logs(_log_day(log_entry))}
+    if len(logs) > MAX_LOGS:
+        # trimmed days get rewritten (or deleted) too
+        marks |= {rt_mark_logs(_log_day(e)) for e in logs[:-MAX_LOGS]}
+        logs = logs[-MAX_LOGS:]
 
-    update_rt(KEY_LOGS, logs)
+    update_rt(KEY_LOGS, logs, marks)
 
 
 # ================== Permissions ==================
@@ -879,6 +2845,79 @@ def main_menu():
     }
 
 
+# ================== Static replies (pre-serialized) ==================
+# /start、/help、COMMANDS 與群組選單按鈕的回覆內容固定：text / reply_markup / entities 只序列化一次，
+# 之後每次送出只補 chat_id（+ message_thread_id）。
+# 來源物件被換掉（COMMANDS[k] = ...、HELP_TEXT = ...）會自動重建；原地修改請呼叫 invalidate_static_replies()。
+_STATIC_REPLIES = {}  # key -> (version, source, static_json)
+_STATIC_REPLY_VERSION = [0]
+# module-level so the cache's identity check holds across calls
+_START_REPLY = ("🤖 歡迎使用 10K DOG - Jarvis", main_menu)
+_MENU_REPLY = ("🤖 10K DOG - Jarvis", main_menu)
+
+
+def invalidate_static_replies():
+    _STATIC_REPLY_VERSION[0] += 1
+
+
+def _static_reply_source(key: str):
+    if key == "/start":
+        return _START_REPLY
+    if key == "main_menu":
+        return _MENU_REPLY
+    if key == "help":
+        return HELP_TEXT
+    return COMMANDS.get(key)
+
+
+def _compile_static_reply(src) -> str:
+    if isinstance(src, tuple):
+        text, build_markup = src
+        markup, parse_mode, entities = build_markup(), None, None
+    elif isinstance(src, dict):
+        text, markup = src.get("text", ""), src.get("markup")
+        parse_mode, entities = src.get("parse_mode"), src.get("entities")
+    else:
+        text, markup, parse_mode, entities = src, None, None, None
+
+    fields = {"text": text, "disable_web_page_preview": True}
+    if markup:
+        fields["reply_markup"] = _prepare_reply_markup(markup)
+    if not entities and not parse_mode:
+        entities = apply_premium_emoji_entities(text)[1]
+    if entities:
+        fields["entities"] = entities
+    elif parse_mode:
+        fields["parse_mode"] = parse_mode
+    return json.dumps(fields, ensure_ascii=False, separators=(",", ":"))[1:-1]
+
+
+def static_reply_json(key: str):
+    src = _static_reply_source(key)
+    if src is None:
+        return None
+    version = _STATIC_REPLY_VERSION[0]
+    hit = _STATIC_REPLIES.get(key)
+    if hit is not None and hit[0] == version and hit[1] is src:
+        stat_inc("static_reply_hit")
+        return hit[2]
+    stat_inc("static_reply_compile")
+    static_json = _compile_static_reply(src)
+    _STATIC_REPLIES[key] = (version, src, static_json)
+    return static_json
+
+
+def send_static_reply(chat_id, key: str, thread_id=None, inline=False) -> bool:
+    static_json = static_reply_json(key)
+    if static_json is None:
+        return False
+    payload = PreparedPayload(static_json, chat_id=chat_id)
+    if thread_id is not None:
+        payload["message_thread_id"] = thread_id
+    _tg_send("sendMessage", payload, timeout=8, inline=inline)
+    return True
+
+
 # ================== Link moderation: detect / whitelist / violations ==================
 LINK_REGEX = re.compile(r"(https?://|www\.|t\.me/|bit\.ly/|tinyurl\.com/|discord\.gg/)", re.I)
 # ===== 廣告關鍵字（全域固定版）=====
@@ -893,6 +2932,140 @@ def _norm_text(s: str) -> str:
     s = s.replace("_", "").replace("-", "").replace(".", "")
     return s
 
+
+class KeywordMatcher:
+    """
+    Aho–Corasick automaton over keyword variants (lowercased + _norm_text).
+    search() scans raw + "\x00" + normalized text in one pass; no pattern contains "\x00".
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(dict.fromkeys(k for k in keywords if k))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]  # keyword matched at this state (via fail chain), or None
+        for kw in self.keywords:
+            for pat in {kw.lower(), _norm_text(kw)}:
+                if pat:
+                    self._insert(pat, kw)
+        self._link()
+
+    def _insert(self, pat: str, kw: str):
+        st = 0
+        for ch in pat:
+            nxt = self._goto[st].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[st][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+            st = nxt
+        if self._out[st] is None:
+            self._out[st] = kw
+
+    def _link(self):
+        frontier = list(self._goto[0].values())
+        while frontier:
+            nxt_frontier = []
+            for st in frontier:
+                for ch, child in self._goto[st].items():
+                    f = self._fail[st]
+                    while f and ch not in self._goto[f]:
+                        f = self._fail[f]
+                    cand = self._goto[f].get(ch, 0)
+                    self._fail[child] = cand if cand != child else 0
+                    if self._out[child] is None:
+                        self._out[child] = self._out[self._fail[child]]
+                    nxt_frontier.append(child)
+            frontier = nxt_frontier
+
+    def search(self, text: str):
+        """
+        First keyword found in text (raw or normalized form), or None.
+        """
+        if not self.keywords or not text:
+            return None
+        goto, fail, out = self._goto, self._fail, self._out
+        st = 0
+        for ch in text.lower() + "\x00" + _norm_text(text):
+            while st and ch not in goto[st]:
+                st = fail[st]
+            st = goto[st].get(ch, 0)
+            if out[st] is not None:
+                return out[st]
+        return None
+
+
+_GLOBAL_AD_MATCHER = KeywordMatcher(AD_KEYWORDS)
+_AD_MATCHERS = {}  # ck -> (keyword dict ref, version, matcher)
+_AD_KW_VERSION = {}  # ck -> bumped by ad_keyword_add/remove
+_AD_MATCHERS_LOCK = threading.Lock()
+
+
+def chat_ad_keywords(chat_id: int) -> list:
+    return list((get_ad_keywords_map().get(_chat_key(chat_id)) or {}).keys())
+
+
+def ad_matcher(chat_id=None) -> KeywordMatcher:
+    """
+    Compiled matcher for AD_KEYWORDS + the chat's own list; rebuilt only when that list changes
+    (local edit bumps the version, a core reload swaps the dict object).
+    """
+    if chat_id is None:
+        return _GLOBAL_AD_MATCHER
+    ck = _chat_key(chat_id)
+    kws = get_ad_keywords_map().get(ck)
+    if not kws:
+        return _GLOBAL_AD_MATCHER
+    ver = _AD_KW_VERSION.get(ck, 0)
+    ent = _AD_MATCHERS.get(ck)
+    if ent is not None and ent[0] is kws and ent[1] == ver:
+        return ent[2]
+    with _AD_MATCHERS_LOCK:
+        t0 = _now()
+        m = KeywordMatcher(list(AD_KEYWORDS) + list(kws.keys()))
+        _AD_MATCHERS[ck] = (kws, ver, m)
+        stat_observe("ad_matcher_build_ms", (_now() - t0) * 1000.0)
+    return m
+
+
+def ad_keyword_add(chat_id: int, keyword: str, added_by: int) -> bool:
+    kw = (keyword or "").strip()
+    if not kw:
+        return False
+    m = get_ad_keywords_map()
+    ck = _chat_key(chat_id)
+    m.setdefault(ck, {})
+    if kw in m[ck]:
+        return False
+    m[ck][kw] = {"added_by": int(added_by), "added_time": datetime.datetime.now(TAIWAN_TZ).isoformat()}
+    _AD_KW_VERSION[ck] = _AD_KW_VERSION.get(ck, 0) + 1
+    update_core(KEY_AD_KEYWORDS, m, [core_mark(KEY_AD_KEYWORDS, ck)])
+    return True
+
+
+def ad_keyword_remove(chat_id: int, keyword: str) -> bool:
+    kw = (keyword or "").strip()
+    m = get_ad_keywords_map()
+    ck = _chat_key(chat_id)
+    if kw not in (m.get(ck) or {}):
+        return False
+    m[ck].pop(kw, None)
+    if not m[ck]:
+        m.pop(ck, None)
+    _AD_KW_VERSION[ck] = _AD_KW_VERSION.get(ck, 0) + 1
+    update_core(KEY_AD_KEYWORDS, m, [core_mark(KEY_AD_KEYWORDS, ck)])
+    return True
+
+
+def ad_keywords_text(chat_id: int) -> str:
+    own = chat_ad_keywords(chat_id)
+    lines = ["🚫 廣告關鍵字\n", "🌐 全域：" + "、".join(AD_KEYWORDS)]
+    lines.append("🏷️ 本群組：" + ("、".join(own) if own else "（無）"))
+    return "\n".join(lines)
+
+
 def msg_hit_ad_keywords(msg: dict) -> bool:
     if not isinstance(msg, dict):
         return False
@@ -901,38 +3074,519 @@ def msg_hit_ad_keywords(msg: dict) -> bool:
     if not text:
         return False
 
-    raw = text.lower()
-    norm = _norm_text(text)
+    chat_id = (msg.get("chat") or {}).get("id")
+    return ad_matcher(chat_id).search(text) is not None
 
-    for kw in AD_KEYWORDS:
-        k_raw = kw.lower()
-        k_norm = _norm_text(kw)
 
-        if k_raw in raw:
-            return True
-        if k_norm and k_norm in norm:
-            return True
+# ---- URL extraction + domain policy (reversed-label suffix trie) ----
+# LINK_REGEX prefixes plus the rest of the token, for links Telegram didn't mark as entities
+LINK_TEXT_REGEX = re.compile(r"(?:https?://|www\.|t\.me/|bit\.ly/|tinyurl\.com/|discord\.gg/)[^\s<>\"'）)\]]*", re.I)
+# platforms shared by everyone: built-in allows are scoped to our own path there
+# (t.me: the whole channel, so every post link passes)
+_TG_LINK_HOSTS = {"t.me", "telegram.me"}
+_SHARED_LINK_HOSTS = _TG_LINK_HOSTS | {
+    "x.com", "twitter.com", "youtube.com", "instagram.com",
+    "threads.com", "threads.net", "discord.gg", "odysee.com", "linktr.ee", "lock.jup.ag",
+}
+
+
+def _utf16_slice(text: str, offset: int, length: int) -> str:
+    """
+    Telegram entity offsets/lengths count UTF-16 code units, not Python characters.
+    """
+    b = text.encode("utf-16-le")
+    return b[2 * int(offset): 2 * (int(offset) + int(length))].decode("utf-16-le", errors="ignore")
+
+
+def extract_urls(msg: dict) -> list:
+    """
+    URLs from url/text_link entities (UTF-16 offsets) and LINK_REGEX-style fragments in the text.
+    """
+    urls = []
+    for tkey, ekey in (("text", "entities"), ("caption", "caption_entities")):
+        text = msg.get(tkey) or ""
+        ents = msg.get(ekey) or []
+        if not isinstance(ents, list):
+            ents = []
+        for e in ents:
+            t = (e.get("type") or "").lower()
+            if t == "text_link" and e.get("url"):
+                urls.append(e["url"])
+            elif t == "url":
+                try:
+                    urls.append(_utf16_slice(text, e.get("offset", 0), e.get("length", 0)))
+                except Exception:
+                    urls.append("")  # unparseable: still counts as a link
+        if text:
+            urls.extend(m.group(0) for m in LINK_TEXT_REGEX.finditer(text))
+    return list(dict.fromkeys(urls))
+
+
+def _split_url(url: str):
+    """
+    (host, path) lowercased, "www." stripped; (None, None) if no usable host.
+    """
+    u = (url or "").strip()
+    if not u:
+        return None, None
+    if "://" not in u[:12]:
+        u = "http://" + u
+    try:
+        parts = urlsplit(u)
+        host = (parts.hostname or "").strip(".").lower()
+    except Exception:
+        return None, None
+    if not host or "." not in host:
+        return None, None
+    if host.startswith("www."):
+        host = host[4:]
+    return host, (parts.path or "").rstrip("/").lower()
+
+
+def normalize_domain_rule(rule: str) -> str:
+    """
+    "https://www.Example.com/Foo/" -> "example.com/foo"; "" if invalid.
+    """
+    r = (rule or "").strip()
+    if r.startswith("*."):
+        r = r[2:]
+    host, path = _split_url(r)
+    if not host:
+        return ""
+    return host + path
+
+
+class DomainTrie:
+    """
+    Suffix index over reversed host labels; "example.com" also covers sub.example.com.
+    A rule may carry a path prefix ("t.me/tenkdogcrypto"), matched on "/" boundaries.
+    match() returns the verdict of the most specific rule (longest host, then longest path).
+    """
+
+    def __init__(self, rules=None):
+        self._root = {}
+        self.size = 0
+        for rule, verdict in (rules or ()):
+            self.add(rule, verdict)
+
+    def add(self, rule: str, verdict: str):
+        rule = normalize_domain_rule(rule)
+        if not rule:
+            return
+        host, _, path = rule.partition("/")
+        node = self._root
+        for label in reversed(host.split(".")):
+            node = node.setdefault(label, {})
+        paths = node.setdefault("", {})  # "" can't be a DNS label: holds {path_prefix: verdict}
+        if path:
+            path = "/" + path
+        if path not in paths:
+            self.size += 1
+        paths[path] = verdict
+
+    def match(self, host: str, path: str = ""):
+        node = self._root
+        best = None
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            paths = node.get("")
+            if not paths:
+                continue
+            hit, hit_len = None, -1
+            for prefix, verdict in paths.items():
+                if len(prefix) > hit_len and (not prefix or path == prefix or path.startswith(prefix + "/")):
+                    hit, hit_len = verdict, len(prefix)
+            if hit is not None:
+                best = hit
+        return best
+
+
+def _builtin_link_rules():
+    urls = [u for _, u in VOTE_LINKS] + [u for _, u in SOCIAL_MEDIA_LINKS]
+    for v in COMMANDS.values():
+        if isinstance(v, str):
+            urls.extend(LINK_TEXT_REGEX.findall(v) or ([v] if v.startswith("http") else []))
+    rules = []
+    for u in urls:
+        host, path = _split_url(u)
+        if not host:
+            continue
+        if host in _SHARED_LINK_HOSTS:
+            if host in _TG_LINK_HOSTS:
+                path = "/" + path.split("/")[1] if len(path) > 1 else ""
+            if not path:
+                continue
+            rules.append((host + path, "allow"))
+        else:
+            rules.append((host, "allow"))
+    return list(dict.fromkeys(rules))
+
+
+BUILTIN_LINK_TRIE = DomainTrie(_builtin_link_rules())
+_LINK_TRIES = {}  # ck -> (rules dict ref, version, trie)
+_LINK_DOMAINS_VERSION = {}
+_LINK_TRIES_LOCK = threading.Lock()
+
+
+def chat_link_trie(chat_id: int):
+    ck = _chat_key(chat_id)
+    rules = get_link_domains_map().get(ck)
+    if not rules:
+        return None
+    ver = _LINK_DOMAINS_VERSION.get(ck, 0)
+    ent = _LINK_TRIES.get(ck)
+    if ent is not None and ent[0] is rules and ent[1] == ver:
+        return ent[2]
+    with _LINK_TRIES_LOCK:
+        trie = DomainTrie()
+        for verdict in ("allow", "deny"):
+            for rule in (rules.get(verdict) or {}):
+                trie.add(rule, verdict)
+        _LINK_TRIES[ck] = (rules, ver, trie)
+    return trie
+
+
+def link_verdict(chat_id, url: str) -> str:
+    """
+    "allow" / "deny" for one URL: chat rules first, then our own links, default deny.
+    """
+    host, path = _split_url(url)
+    if not host:
+        return "deny"
+    if chat_id is not None:
+        trie = chat_link_trie(chat_id)
+        v = trie.match(host, path) if trie else None
+        if v:
+            return v
+    return BUILTIN_LINK_TRIE.match(host, path) or "deny"
+
+
+def link_domain_set(chat_id: int, rule: str, verdict: str, added_by: int) -> str:
+    """
+    Add/replace a per-chat allow/deny rule; returns the normalized rule ("" if invalid).
+    """
+    rule = normalize_domain_rule(rule)
+    if not rule or verdict not in ("allow", "deny"):
+        return ""
+    m = get_link_domains_map()
+    ck = _chat_key(chat_id)
+    ent = m.setdefault(ck, {})
+    ent.setdefault(verdict, {})[rule] = {"added_by": int(added_by), "added_time": datetime.datetime.now(TAIWAN_TZ).isoformat()}
+    other = "deny" if verdict == "allow" else "allow"
+    if rule in (ent.get(other) or {}):
+        ent[other].pop(rule, None)
+        if not ent[other]:
+            ent.pop(other, None)
+    _LINK_DOMAINS_VERSION[ck] = _LINK_DOMAINS_VERSION.get(ck, 0) + 1
+    update_core(KEY_LINK_DOMAINS, m, [core_mark(KEY_LINK_DOMAINS, ck)])
+    return rule
+
+
+def link_domain_remove(chat_id: int, rule: str) -> bool:
+    rule = normalize_domain_rule(rule)
+    m = get_link_domains_map()
+    ck = _chat_key(chat_id)
+    ent = m.get(ck) or {}
+    removed = False
+    for verdict in ("allow", "deny"):
+        if rule in (ent.get(verdict) or {}):
+            ent[verdict].pop(rule, None)
+            if not ent[verdict]:
+                ent.pop(verdict, None)
+            removed = True
+    if not removed:
+        return False
+    if not ent:
+        m.pop(ck, None)
+    _LINK_DOMAINS_VERSION[ck] = _LINK_DOMAINS_VERSION.get(ck, 0) + 1
+    update_core(KEY_LINK_DOMAINS, m, [core_mark(KEY_LINK_DOMAINS, ck)])
+    return True
 
-    return False
+
+def link_domains_text(chat_id: int) -> str:
+    ent = get_link_domains_map().get(_chat_key(chat_id)) or {}
+    allow = sorted(ent.get("allow") or {})
+    deny = sorted(ent.get("deny") or {})
+    return (
+        "🌐 網域規則（子網域一併適用）\n\n"
+        "✅ 允許：" + ("、".join(allow) if allow else "（無）") + "\n"
+        "⛔ 封鎖：" + ("、".join(deny) if deny else "（無）") + "\n\n"
+        "🔗 官方連結（指令 / 投票 / 社媒）預設允許"
+    )
 
 
 def msg_has_link(msg: dict) -> bool:
+    """
+    True if the message carries any link the chat's domain policy doesn't allow.
+    """
     if not isinstance(msg, dict):
         return False
+    chat_id = (msg.get("chat") or {}).get("id")
+    for url in extract_urls(msg):
+        if link_verdict(chat_id, url) != "allow":
+            return True
+    return False
 
-    text = (msg.get("text") or msg.get("caption") or "").strip()
-    if text and LINK_REGEX.search(text):
-        return True
 
-    for key in ("entities", "caption_entities"):
-        ents = msg.get(key) or []
-        if not isinstance(ents, list):
+# ---- flood detection (ring-buffer time buckets per (chat, user) and per chat) ----
+FLOOD_BUCKETS = int(os.environ.get("FLOOD_BUCKETS", "10"))
+FLOOD_MAX_TRACKED = int(os.environ.get("FLOOD_MAX_TRACKED", "50000"))
+
+
+class RateWindow:
+    """
+    Message count over the last `span` seconds in FLOOD_BUCKETS fixed buckets; O(1) add/total.
+    """
+    __slots__ = ("width", "counts", "epoch", "total", "last_ts")
+
+    def __init__(self, span: float, n: int = None):
+        n = max(2, int(n or FLOOD_BUCKETS))
+        self.width = max(0.1, float(span)) / n
+        self.counts = [0] * n
+        self.epoch = None  # absolute bucket number of the newest bucket
+        self.total = 0
+        self.last_ts = 0.0
+
+    def _advance(self, ts: float):
+        b = int(ts // self.width)
+        if self.epoch is None:
+            self.epoch = b
+            return
+        n = len(self.counts)
+        gap = b - self.epoch
+        if gap <= 0:
+            return
+        if gap >= n:
+            self.counts = [0] * n
+            self.total = 0
+        else:
+            for i in range(1, gap + 1):
+                j = (self.epoch + i) % n
+                self.total -= self.counts[j]
+                self.counts[j] = 0
+        self.epoch = b
+
+    def add(self, ts: float) -> int:
+        self._advance(ts)
+        self.counts[self.epoch % len(self.counts)] += 1
+        self.total += 1
+        self.last_ts = ts
+        return self.total
+
+
+class FloodDetector:
+    """
+    Per-(chat, user) and per-chat RateWindows in an LRU; entries idle longer than their span are evicted
+    as new traffic arrives, and the table never exceeds FLOOD_MAX_TRACKED.
+    """
+
+    def __init__(self, max_tracked: int = None):
+        self.max_tracked = max(100, int(max_tracked or FLOOD_MAX_TRACKED))
+        self._wins = OrderedDict()  # key -> RateWindow
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _hit(self, key, span: float, ts: float) -> int:
+        w = self._wins.get(key)
+        if w is None or abs(w.width * len(w.counts) - span) > 1e-6:
+            w = self._wins[key] = RateWindow(span)
+        else:
+            self._wins.move_to_end(key)
+        return w.add(ts)
+
+    def _evict(self, now: float):
+        while self._wins:
+            key, w = next(iter(self._wins.items()))
+            if len(self._wins) <= self.max_tracked and now - w.last_ts <= w.width * len(w.counts):
+                break
+            self._wins.popitem(last=False)
+            self.evictions += 1
+
+    def hit(self, chat_id: int, user_id: int, span: float, ts: float = None):
+        """
+        Count one message; returns (user_count, chat_count) within the window.
+        """
+        ts = _now() if ts is None else ts
+        with self._lock:
+            uc = self._hit((int(chat_id), int(user_id)), span, ts)
+            cc = self._hit(int(chat_id), span, ts)
+            self._evict(ts)
+            return uc, cc
+
+    def reset_user(self, chat_id: int, user_id: int):
+        with self._lock:
+            self._wins.pop((int(chat_id), int(user_id)), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked": len(self._wins), "evictions": self.evictions}
+
+
+FLOOD = FloodDetector()
+
+
+def flood_hit(msg: dict, settings: dict) -> bool:
+    """
+    True if this (non-edited) message pushes its sender over the chat's flood threshold.
+    While the whole chat is over flood_chat_max (raid), the per-user threshold is halved.
+    Admins / whitelisted senders aren't counted, so their bursts can't trigger raid mode.
+    """
+    if not settings.get("flood_enabled") or msg.get("edit_date"):
+        return False
+    try:
+        chat_id = int(msg["chat"]["id"])
+        user_id = int((msg.get("from") or {}).get("id"))
+        span = float(settings.get("flood_window_sec", 10) or 10)
+        user_max = int(settings.get("flood_user_max", 8) or 8)
+        chat_max = int(settings.get("flood_chat_max", 60) or 60)
+    except Exception:
+        return False
+    if should_bypass_link_rule(chat_id, user_id):
+        return False
+    uc, cc = FLOOD.hit(chat_id, user_id, span, msg.get("date") and min(float(msg["date"]), _now()) or None)
+    if cc > chat_max:
+        stat_inc("flood_raid_msgs")
+        user_max = max(2, user_max // 2)
+    return uc > user_max
+
+
+# ---- near-duplicate spam across chats (MinHash signatures, LSH band index) ----
+DUP_WINDOW_SEC = float(os.environ.get("DUP_WINDOW_SEC", "600"))
+DUP_MAX_ENTRIES = int(os.environ.get("DUP_MAX_ENTRIES", "100000"))
+DUP_MIN_LEN = int(os.environ.get("DUP_MIN_LEN", "20"))          # normalized chars
+DUP_MAX_CHARS = int(os.environ.get("DUP_MAX_CHARS", "1024"))
+DUP_MIN_SIMILARITY = float(os.environ.get("DUP_MIN_SIMILARITY", "0.5"))  # estimated Jaccard of 3-grams
+DUP_MIN_SOURCES = int(os.environ.get("DUP_MIN_SOURCES", "3"))    # distinct users or chats
+DUP_MAX_COMPARE = int(os.environ.get("DUP_MAX_COMPARE", "2000"))  # per lookup, bounds hot-bucket cost
+DUP_HASHES = 16
+DUP_BAND_ROWS = 2  # 8 bands x 2 rows: candidate odds ~0.9 at Jaccard 0.5, ~0.08 at 0.1
+_DUP_MASKS = tuple(int.from_bytes(os.urandom(8), "big") for _ in range(DUP_HASHES))
+
+
+def minhash_signature(norm: str) -> tuple:
+    """
+    MinHash of the character 3-grams of already-normalized text; the permutation family is
+    hash() XOR a per-process random mask. Signatures are only comparable within this process.
+    """
+    norm = norm[:DUP_MAX_CHARS]
+    hs = [hash(gm) for gm in {norm[i:i + 3] for i in range(max(1, len(norm) - 2))}]
+    return tuple(min(map(m.__xor__, hs)) for m in _DUP_MASKS)
+
+
+class NearDupIndex:
+    """
+    Recent MinHash signatures bounded by DUP_WINDOW_SEC and DUP_MAX_ENTRIES.
+    LSH: a lookup only compares against entries sharing one of the signature's bands,
+    so its cost does not grow with the window size.
+    """
+
+    def __init__(self, window: float = None, max_entries: int = None, min_similarity: float = None):
+        self.window = float(window if window is not None else DUP_WINDOW_SEC)
+        self.max_entries = max(1, int(max_entries if max_entries is not None else DUP_MAX_ENTRIES))
+        self.min_similarity = float(min_similarity if min_similarity is not None else DUP_MIN_SIMILARITY)
+        self._entries = deque()  # [seq, ts, sig, chat_id, user_id, message_id, handled]
+        self._buckets = {}       # band key -> {seq: entry}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bands(sig: tuple):
+        r = DUP_BAND_ROWS
+        return [(b,) + sig[b * r:(b + 1) * r] for b in range(len(sig) // r)]
+
+    def _evict(self, now: float):
+        while self._entries and (len(self._entries) >= self.max_entries or now - self._entries[0][1] > self.window):
+            e = self._entries.popleft()
+            for k in self._bands(e[2]):
+                bucket = self._buckets.get(k)
+                if bucket is not None:
+                    bucket.pop(e[0], None)
+                    if not bucket:
+                        self._buckets.pop(k, None)
+
+    def add(self, sig: tuple, chat_id: int, user_id: int, message_id=None, ts: float = None, need: int = None):
+        """
+        Index one message and return (users, chats, matches): distinct senders/chats of the
+        near-duplicates in the window (this one included) and the matched earlier entries.
+        Stops comparing once `need` users and chats are found, or after DUP_MAX_COMPARE candidates.
+        """
+        ts = _now() if ts is None else ts
+        need = need or DUP_MIN_SOURCES
+        min_eq = self.min_similarity * len(sig)
+        users, chats, matches, seen = {user_id}, {chat_id}, [], set()
+        with self._lock:
+            self._evict(ts)
+            keys = self._bands(sig)
+            for k in keys:
+                if len(seen) >= DUP_MAX_COMPARE or (len(users) >= need and len(chats) >= need):
+                    break
+                for seq, e in (self._buckets.get(k) or {}).items():
+                    if seq in seen:
+                        continue
+                    seen.add(seq)
+                    if ts - e[1] <= self.window and sum(map(int.__eq__, sig, e[2])) >= min_eq:
+                        users.add(e[4])
+                        chats.add(e[3])
+                        matches.append(e)
+                    if len(seen) >= DUP_MAX_COMPARE or (len(users) >= need and len(chats) >= need):
+                        break
+            self._seq += 1
+            e = [self._seq, ts, sig, chat_id, user_id, message_id, False]
+            self._entries.append(e)
+            for k in keys:
+                self._buckets.setdefault(k, {})[e[0]] = e
+        return users, chats, matches
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "buckets": len(self._buckets)}
+
+
+DUP_INDEX = NearDupIndex()
+
+
+def dup_check(msg: dict, settings: dict):
+    """
+    Index long-enough texts from non-bypassed senders in chats with dup_enabled; returns earlier
+    matched entries if this message is part of a near-duplicate wave (>= DUP_MIN_SOURCES users or chats), else None.
+    """
+    if not settings.get("dup_enabled") or msg.get("edit_date"):
+        # cheap gate first: chats that didn't opt in pay no hashing / admin lookups
+        return None
+    text = msg.get("text") or msg.get("caption") or ""
+    norm = _norm_text(text)
+    if len(norm) < DUP_MIN_LEN:
+        return None
+    try:
+        chat_id = int(msg["chat"]["id"])
+        user_id = int((msg.get("from") or {}).get("id"))
+    except Exception:
+        return None
+    if should_bypass_link_rule(chat_id, user_id):
+        # admins / whitelisted users never enter the index, so their announcements can't make a wave
+        return None
+    users, chats, matches = DUP_INDEX.add(minhash_signature(norm), chat_id, user_id, msg.get("message_id"))
+    if len(users) >= DUP_MIN_SOURCES or len(chats) >= DUP_MIN_SOURCES:
+        stat_inc("dup_wave_hits")
+        return matches
+    return None
+
+
+def _purge_dup_matches(matches: list):
+    """
+    Remove the earlier copies of a flagged wave (once each, only where dup_enabled, never from bypassed users).
+    """
+    for e in matches:
+        if e[6] or not e[5]:
             continue
-        for e in ents:
-            t = (e.get("type") or "").lower()
-            if t in ("url", "text_link"):
-                return True
-    return False
+        e[6] = True
+        try:
+            if get_link_settings(e[3]).get("dup_enabled") and not should_bypass_link_rule(e[3], e[4]):
+                delete_message(e[3], e[5])
+        except Exception as ex:
+            print("[DUP_PURGE_ERR]", ex)
 
 
 def _chat_key(chat_id: int) -> str:
@@ -949,18 +3603,30 @@ def get_link_settings(chat_id: int) -> dict:
         s["mute_days"] = 1
     if s.get("third_action") not in ("kick", "ban"):
         s["third_action"] = "kick"
+    s.setdefault("flood_enabled", False)
+    s.setdefault("flood_user_max", 8)
+    s.setdefault("flood_window_sec", 10)
+    s.setdefault("flood_chat_max", 60)
+    s.setdefault("dup_enabled", False)
     return s
 
 
 def set_link_settings(chat_id: int, new_s: dict):
     s_map = get_link_settings_map()
     ck = _chat_key(chat_id)
-    s_map[ck] = {
+    # keep fields added by later features; normalize the known ones
+    s_map[ck] = dict(new_s)
+    s_map[ck].update({
         "enabled": bool(new_s.get("enabled", True)),
         "mute_days": int(new_s.get("mute_days", 1) or 1),
         "third_action": "ban" if new_s.get("third_action") == "ban" else "kick",
-    }
-    update_core(KEY_LINK_SETTINGS, s_map)
+        "flood_enabled": bool(new_s.get("flood_enabled", False)),
+        "flood_user_max": max(2, int(new_s.get("flood_user_max", 8) or 8)),
+        "flood_window_sec": max(1, int(new_s.get("flood_window_sec", 10) or 10)),
+        "flood_chat_max": max(2, int(new_s.get("flood_chat_max", 60) or 60)),
+        "dup_enabled": bool(new_s.get("dup_enabled", False)),
+    })
+    update_core(KEY_LINK_SETTINGS, s_map, [core_mark(KEY_LINK_SETTINGS, ck)])
 
 
 def is_whitelisted(chat_id: int, user_id: int) -> bool:
@@ -977,7 +3643,7 @@ def whitelist_add(chat_id: int, user_id: int, added_by: int) -> bool:
     if uid in wl[ck]:
         return False
     wl[ck][uid] = {"added_by": int(added_by), "added_time": datetime.datetime.now(TAIWAN_TZ).isoformat()}
-    update_core(KEY_LINK_WHITELIST, wl)
+    update_core(KEY_LINK_WHITELIST, wl, [core_mark(KEY_LINK_WHITELIST, ck)])
     return True
 
 
@@ -990,7 +3656,7 @@ def whitelist_remove(chat_id: int, user_id: int) -> bool:
     wl[ck].pop(uid, None)
     if not wl[ck]:
         wl.pop(ck, None)
-    update_core(KEY_LINK_WHITELIST, wl)
+    update_core(KEY_LINK_WHITELIST, wl, [core_mark(KEY_LINK_WHITELIST, ck)])
     return True
 
 
@@ -1013,7 +3679,7 @@ def inc_violation(chat_id: int, user_id: int) -> int:
     rec = vio[ck].get(uid) or {}
     c = int(rec.get("count", 0) or 0) + 1
     vio[ck][uid] = {"count": c, "last_time": datetime.datetime.now(TAIWAN_TZ).isoformat()}
-    update_rt(KEY_LINK_VIOLATIONS, vio)
+    update_rt(KEY_LINK_VIOLATIONS, vio, [rt_mark_vio(ck, uid)])
     return c
 
 
@@ -1026,7 +3692,7 @@ def clear_violation(chat_id: int, user_id: int):
         vio[ck].pop(uid, None)
         if not vio[ck]:
             vio.pop(ck, None)
-        update_rt(KEY_LINK_VIOLATIONS, vio)
+        update_rt(KEY_LINK_VIOLATIONS, vio, [rt_mark_vio(ck, uid)])
         removed = True
     return removed
 
@@ -1047,14 +3713,10 @@ def list_violations_text(chat_id: int, limit: int = 50) -> str:
     items.sort(key=lambda x: (x[0], x[1]), reverse=True)
     items = items[: max(1, int(limit))]
 
+    resolved = resolve_many([("user", int(uid)) for _, _, uid in items if str(uid).lstrip("-").isdigit()], "violations")
     lines = ["📌 違規名單（連結違規）\n"]
     for c, t, uid in items:
-        name = ""
-        try:
-            uinfo = get_user_info(int(uid))
-            name = get_display_name(uinfo) if uinfo else ""
-        except:
-            name = ""
+        name = _resolved_name(resolved, uid)
         if name:
             lines.append(f"• {name}\n  🔢 UID: {uid} | 次數: {c} | ⏰ {t}")
         else:
@@ -1075,20 +3737,17 @@ def whitelist_text(chat_id: int, limit: int = 60) -> str:
     items.sort(key=lambda x: x[0], reverse=True)
     items = items[: max(1, int(limit))]
 
+    keys = []
+    for _, uid, rec in items:
+        for v in (uid, rec.get("added_by")):
+            if str(v or "").lstrip("-").isdigit() and int(v):
+                keys.append(("user", int(v)))
+    resolved = resolve_many(keys, "whitelist")
+
     lines = ["✅ 白名單成員\n"]
     for added_time, uid, rec in items:
-        name = ""
-        adder = ""
-        try:
-            uinfo = get_user_info(int(uid))
-            name = get_display_name(uinfo) if uinfo else ""
-        except:
-            name = ""
-        try:
-            adder_info = get_user_info(int(rec.get("added_by", 0)))
-            adder = get_display_name(adder_info) if adder_info else ""
-        except:
-            adder = ""
+        name = _resolved_name(resolved, uid)
+        adder = _resolved_name(resolved, rec.get("added_by", 0))
 
         if name:
             lines.append(
@@ -1111,10 +3770,64 @@ def should_bypass_link_rule(chat_id: int, user_id: int) -> bool:
         return True
     if is_whitelisted(chat_id, user_id):
         return True
-    st = get_chat_member_status(chat_id, user_id)
-    if st in ("administrator", "creator"):
-        return True
-    return False
+    return is_chat_admin(chat_id, user_id)
+
+
+# ---- media groups (albums): one decision per group, bulk delete ----
+MEDIA_GROUP_TTL = float(os.environ.get("MEDIA_GROUP_TTL", "60"))
+MEDIA_GROUP_FLUSH_SEC = float(os.environ.get("MEDIA_GROUP_FLUSH_SEC", "1.5"))
+MEDIA_GROUPS = TTLCache("media_groups", int(os.environ.get("MEDIA_GROUP_MAX", "2000")), MEDIA_GROUP_TTL)
+_MEDIA_GROUP_LOCK = threading.Lock()
+
+
+def media_group_item(chat_id: int, msg: dict):
+    """
+    Register an album item; returns (group state, is_first_item) or (None, True) for plain messages.
+    """
+    mg = msg.get("media_group_id")
+    if not mg:
+        return None, True
+    key = (int(chat_id), str(mg))
+    with _MEDIA_GROUP_LOCK:
+        grp = MEDIA_GROUPS.get(key)
+        first = grp is TTLCache.MISS
+        if first:
+            grp = {"key": key, "mids": set(), "violation": False, "pending": set(), "scheduled": False}
+            MEDIA_GROUPS.set(key, grp)
+        if msg.get("message_id"):
+            grp["mids"].add(int(msg["message_id"]))
+        return grp, first
+
+
+def _media_group_delete_later(grp: dict, mids):
+    # caller holds _MEDIA_GROUP_LOCK
+    grp["pending"].update(mids)
+    if not grp["scheduled"]:
+        grp["scheduled"] = True
+        enqueue_delayed(grp["key"][0], "deleteMessages", MEDIA_GROUP_FLUSH_SEC, _media_group_flush, grp)
+
+
+def _media_group_flush(grp: dict):
+    with _MEDIA_GROUP_LOCK:
+        mids = list(grp["pending"])
+        grp["pending"].clear()
+        grp["scheduled"] = False
+    if mids:
+        stat_observe("media_group_bulk_delete", len(mids))
+        return delete_messages(grp["key"][0], mids, wait=True)
+    return True
+
+
+def media_group_claim(grp: dict) -> bool:
+    """
+    Mark the album as violating and schedule removal of every item seen so far (and any that follow).
+    Returns False if another item already claimed it: the violation was counted once already.
+    """
+    with _MEDIA_GROUP_LOCK:
+        first_claim = not grp["violation"]
+        grp["violation"] = True
+        _media_group_delete_later(grp, grp["mids"])
+        return first_claim
 
 
 def apply_link_moderation(msg: dict) -> bool:
@@ -1134,22 +3847,51 @@ def apply_link_moderation(msg: dict) -> bool:
         if not settings.get("enabled", True):
             return False
 
+        grp, first_item = media_group_item(chat_id, msg)
+        if grp is not None and grp["violation"]:
+            # rest of an album already judged: just goes with the bulk delete
+            media_group_claim(grp)
+            return True
+
         hit_link = msg_has_link(msg)
-        hit_ad = msg_hit_ad_keywords(msg)
+        hit_ad = (not hit_link) and msg_hit_ad_keywords(msg)
+        dup_matches = dup_check(msg, settings)
+        hit_dup = dup_matches is not None
+        hit_flood = first_item and flood_hit(msg, settings)
 
-        if (not hit_link) and (not hit_ad):
+        if (not hit_link) and (not hit_ad) and (not hit_dup) and (not hit_flood):
             return False
 
-        reason = "連結" if hit_link else "廣告"
-        reason1 = "link" if hit_link else "AD"
+        if hit_link:
+            reason, reason1 = "連結", "link"
+        elif hit_ad:
+            reason, reason1 = "廣告", "AD"
+        elif hit_dup:
+            reason, reason1 = "重複洗版", "duplicate spam"
+        else:
+            reason, reason1 = "洗版", "flood"
 
         if should_bypass_link_rule(chat_id, user_id):
             return False
 
-        try:
-            delete_message(chat_id, msg.get("message_id"))
-        except:
-            pass
+        if hit_dup:
+            _purge_dup_matches(dup_matches)
+
+        if hit_flood:
+            # one violation per burst: the next one has to build up again
+            FLOOD.reset_user(chat_id, user_id)
+
+        if grp is not None:
+            if not media_group_claim(grp):
+                return True
+        else:
+            try:
+                delete_message(chat_id, msg.get("message_id"))
+            except:
+                pass
+            # an edit of (or redelivered) message already punished: delete again, count once
+            if not claim_once(chat_id, msg.get("message_id"), "violation"):
+                return True
 
         offender = group_user_label(user_id)
         count = inc_violation(chat_id, user_id)
@@ -1207,20 +3949,90 @@ def apply_link_moderation(msg: dict) -> bool:
         return False
 
 
+# ================== Batched name resolution (list renderers) ==================
+RESOLVE_WORKERS = int(os.environ.get("RESOLVE_WORKERS", "8"))
+RESOLVE_DEADLINE_SEC = float(os.environ.get("RESOLVE_DEADLINE_SEC", "3"))
+_RESOLVE = {"pid": None, "pool": None}
+_RESOLVE_LOCK = threading.Lock()
+
+
+def _resolve_pool() -> ThreadPoolExecutor:
+    pid = os.getpid()
+    if _RESOLVE["pid"] == pid:
+        return _RESOLVE["pool"]
+    with _RESOLVE_LOCK:
+        if _RESOLVE["pid"] != pid:
+            _RESOLVE.update({"pid": pid, "pool": ThreadPoolExecutor(max_workers=max(1, RESOLVE_WORKERS), thread_name_prefix="resolve")})
+        return _RESOLVE["pool"]
+
+
+def _resolver(kind: str):
+    # (cache, cache key of lookup key, fetch)
+    if kind == "user":
+        return USER_CACHE, lambda k: int(k), lambda k: get_user_info(int(k))
+    if kind == "chat":
+        return CHAT_CACHE, lambda k: int(k), lambda k: get_chat_info(int(k))
+    return TOPIC_CACHE, lambda k: (int(k[0]), int(k[1])), lambda k: get_thread_name(k[0], k[1])
+
+
+def resolve_many(keys, label: str) -> dict:
+    """
+    keys: iterable of ("user", uid) / ("chat", chat_id) / ("topic", (chat_id, thread_id)).
+    Cache hits are answered inline; misses are fetched concurrently until RESOLVE_DEADLINE_SEC.
+    Returns {(kind, key): result} for whatever finished; late fetches still fill the caches.
+    """
+    t0 = _now()
+    out, pending = {}, {}
+    keys = list(dict.fromkeys(keys))
+    for kind, key in keys:
+        try:
+            cache, ck, fetch = _resolver(kind)
+            hit = cache.get(ck(key))
+        except Exception:
+            continue
+        if hit is not TTLCache.MISS:
+            out[(kind, key)] = hit
+        else:
+            pending[(kind, key)] = fetch
+
+    if pending:
+        pool = _resolve_pool()
+        futs = {pool.submit(fetch, k[1]): k for k, fetch in pending.items()}
+        done, late = _futures_wait(list(futs), timeout=RESOLVE_DEADLINE_SEC)
+        for f in done:
+            try:
+                out[futs[f]] = f.result()
+            except Exception:
+                pass
+        if late:
+            stat_inc("render_deadline_hits")
+            print("[RENDER]", label, f"deadline hit: {len(late)}/{len(futs)} lookups unresolved")
+
+    ms = (_now() - t0) * 1000.0
+    stat_observe(f"render_ms:{label}", ms)
+    stat_observe("render_fanout", len(pending))
+    return out
+
+
+def _resolved_name(resolved: dict, uid) -> str:
+    try:
+        info = resolved.get(("user", int(uid)))
+        return get_display_name(info) if info else ""
+    except Exception:
+        return ""
+
+
 # ================== List renderers ==================
 def get_admin_list_with_names():
     admins = get_admins()
     if not admins:
         return "👥 目前沒有管理員"
 
+    resolved = resolve_many([("user", int(a)) for a in admins if str(a).lstrip("-").isdigit()], "admins")
     msg = "👥 管理員列表：\n\n"
     for admin_id, info in admins.items():
-        try:
-            u = get_user_info(int(admin_id))
-            name = get_display_name(u)
-            msg += f"👤 管理員 - {name}\n🔢 ID: {admin_id}\n\n"
-        except:
-            msg += f"👤 管理員 - 未知用戶\n🔢 ID: {admin_id}\n\n"
+        name = _resolved_name(resolved, admin_id) or "未知用戶"
+        msg += f"👤 管理員 - {name}\n🔢 ID: {admin_id}\n\n"
     return msg
 
 
@@ -1231,22 +4043,32 @@ def get_thread_list_with_names(scope="jarvis"):
     if not threads:
         return f"{label} 目前沒有允許的話題"
 
-    msg = f"{label} 允許的話題列表：\n\n"
+    parsed, keys = {}, []
     for thread_key in threads.keys():
         try:
             chat_id, tid = thread_key.split("_")
-            tid_int = int(tid) if tid != "0" else 0
-
-            chat_info = get_chat_info(chat_id)
-            chat_title = chat_info.get("title", "未知群組") if chat_info else "未知群組"
-
-            if tid_int == 0:
-                msg += f"💬 主聊天室\n🏷️ 群組: {chat_title}\n🔢 識別碼: {thread_key}\n\n"
-            else:
-                tname = get_thread_name(chat_id, tid_int)
-                msg += f"💬 話題: {tname}\n🏷️ 群組: {chat_title}\n🔢 識別碼: {thread_key}\n\n"
+            parsed[thread_key] = (int(chat_id), int(tid))
+            keys.append(("chat", int(chat_id)))
+            if int(tid):
+                keys.append(("topic", (int(chat_id), int(tid))))
         except:
+            continue
+    resolved = resolve_many(keys, f"threads_{scope}")
+
+    msg = f"{label} 允許的話題列表：\n\n"
+    for thread_key in threads.keys():
+        if thread_key not in parsed:
             msg += f"💬 話題\n🔢 識別碼: {thread_key}\n\n"
+            continue
+        chat_id, tid_int = parsed[thread_key]
+        chat_info = resolved.get(("chat", chat_id))
+        chat_title = chat_info.get("title", "未知群組") if chat_info else "未知群組"
+
+        if tid_int == 0:
+            msg += f"💬 主聊天室\n🏷️ 群組: {chat_title}\n🔢 識別碼: {thread_key}\n\n"
+        else:
+            tname = resolved.get(("topic", (chat_id, tid_int))) or "未知話題"
+            msg += f"💬 話題: {tname}\n🏷️ 群組: {chat_title}\n🔢 識別碼: {thread_key}\n\n"
     return msg
 
 
@@ -1435,6 +4257,9 @@ def admin_group_panel(user_id: int):
     enabled = "✅" if s.get("enabled") else "❌"
     third = "KICK" if s.get("third_action") == "kick" else "BAN"
     mute_days = int(s.get("mute_days", 1) or 1)
+    flood = "✅" if s.get("flood_enabled") else "❌"
+    dup = "✅" if s.get("dup_enabled") else "❌"
+    flood_limit = f"{s.get('flood_user_max', 8)}/{s.get('flood_window_sec', 10)}s"
 
     kb = []
     kb.append([{"text": f"🏷️ 目前群組：{title}", "callback_data": "g_chat_select"}])
@@ -1456,6 +4281,24 @@ def admin_group_panel(user_id: int):
         {"text": "❌ 移白名單", "callback_data": "g_wl_remove"},
         {"text": "🛠️ 指令說明", "callback_data": "g_help"},
     ])
+    kb.append([
+        {"text": f"🌊 洗版：{flood}", "callback_data": "g_toggle_flood"},
+        {"text": f"⏱️ 門檻：{flood_limit}", "callback_data": "g_set_flood"},
+    ])
+    kb.append([{"text": f"🧬 跨群重複訊息：{dup}", "callback_data": "g_toggle_dup"}])
+    kb.append([
+        {"text": "🌐 網域規則", "callback_data": "g_dom_list"},
+        {"text": "✅ 允許網域", "callback_data": "g_dom_allow"},
+    ])
+    kb.append([
+        {"text": "⛔ 封鎖網域", "callback_data": "g_dom_deny"},
+        {"text": "🗑️ 移除網域", "callback_data": "g_dom_remove"},
+    ])
+    kb.append([
+        {"text": "🚫 廣告詞", "callback_data": "g_kw_list"},
+        {"text": "➕ 加廣告詞", "callback_data": "g_kw_add"},
+        {"text": "➖ 移廣告詞", "callback_data": "g_kw_remove"},
+    ])
     kb.append([
         {"text": "📋 Jarvis 話題", "callback_data": "g_threads_jarvis"},
         {"text": "✨ SparkSign 話題", "callback_data": "g_threads_sparksign"},
@@ -1478,20 +4321,61 @@ def chat_select_panel(user_id: int):
 
 
 def send_or_edit_panel(chat_id: int, mid: int, text: str, markup: dict):
-    edit_message_text(chat_id, mid, text, markup=markup, disable_preview=True)
-
-
-def send_command_response(chat_id, payload, thread_id=None):
-    if isinstance(payload, dict):
-        return send_message(
-            chat_id,
-            payload.get("text", ""),
-            payload.get("markup"),
-            thread_id,
-            parse_mode=payload.get("parse_mode"),
-            entities=payload.get("entities"),
-        )
-    return send_message(chat_id, payload, None, thread_id)
+    edit_message_text(chat_id, mid, text, markup=markup, entities=apply_premium_emoji_entities(text)[1], disable_preview=True)
+
+
+# ================== Routing registry ==================
+# kind -> {key: handler}; 新增面板按鈕/指令/等待狀態時用 @route 註冊即可
+#   callback        (chat_id, user_id, mid, data_cb)          private admin panel, exact match
+#   callback_prefix (chat_id, user_id, mid, data_cb)          e.g. "wladd_<uid>"; longest prefix wins
+#   command         (chat_id, thread_id)                      public slash commands (lowercased, no @bot)
+#   group_command   (cmd, chat_id, user_id, thread_id, update) group admin commands
+#   waiting         (chat_id, user_id, raw, waiting)          admin panel input states
+ROUTES = {"callback": {}, "callback_prefix": {}, "command": {}, "group_command": {}, "waiting": {}}
+_PREFIX_LENS = []  # distinct callback prefix lengths, longest first
+
+
+def route(kind: str, *keys):
+    def deco(fn):
+        table = ROUTES[kind]
+        for k in keys:
+            if k in table:
+                raise ValueError(f"duplicate route {kind}:{k}")
+            table[k] = fn
+            if kind == "callback_prefix" and len(k) not in _PREFIX_LENS:
+                _PREFIX_LENS.append(len(k))
+                _PREFIX_LENS.sort(reverse=True)
+        return fn
+    return deco
+
+
+def find_route(kind: str, key: str):
+    """
+    -> (route key, handler) or (None, None). Prefix callbacks cost one dict probe per distinct prefix length.
+    """
+    fn = ROUTES[kind].get(key)
+    if fn is not None:
+        return key, fn
+    if kind == "callback":
+        prefixes = ROUTES["callback_prefix"]
+        for n in _PREFIX_LENS:
+            fn = prefixes.get(key[:n])
+            if fn is not None:
+                return key[:n], fn
+    return None, None
+
+
+def dispatch(kind: str, key: str, *args) -> bool:
+    name, fn = find_route(kind, key)
+    if fn is None:
+        return False
+    t0 = _now()
+    try:
+        fn(*args)
+    finally:
+        hist_observe("jarvis_route_duration_seconds", _now() - t0, "Handler latency per dispatch route",
+                     kind=kind, route=name)
+    return True
 
 
 # ================== Handlers ==================
@@ -1548,14 +4432,20 @@ def handle_uid_input(text, chat_id, user_id):
         send_message(chat_id, "❌ 請輸入有效的數字 UID")
 
 
+def _send_admin_panel(chat_id, user_id):
+    # runs on the outbox worker: needs the message_id back, so it waits for the send there
+    res = send_message(chat_id, "👑 Jarvis 管理員控制面板", admin_main_panel(), wait=True)
+    try:
+        mid = res.json()["result"]["message_id"] if res and res.status_code == 200 else None
+        _get_sess(user_id)["active_panel_mid"] = mid
+    except:
+        pass
+    return res
+
+
 def handle_admin_command(text, chat_id, user_id):
     if text == "/admin":
-        res = send_message(chat_id, "👑 Jarvis 管理員控制面板", admin_main_panel())
-        try:
-            mid = res.json()["result"]["message_id"] if res and res.status_code == 200 else None
-            _get_sess(user_id)["active_panel_mid"] = mid
-        except:
-            pass
+        enqueue_action(chat_id, "sendMessage", _send_admin_panel, chat_id, user_id)
 
 
 def _delete_group_admin_cmd(chat_id: int, update: dict):
@@ -1570,127 +4460,86 @@ def _delete_group_admin_cmd(chat_id: int, update: dict):
 def handle_group_admin(text, chat_id, user_id, update):
     cmd = normalize_cmd(text)
 
-    thread_id = (update.get("message") or {}).get("message_thread_id", 0)
-    admin_name = group_user_label(user_id)
-
-    _delete_group_admin_cmd(chat_id, update)
-
-    if cmd == "/admin_add_jarvis":
-        if toggle_thread(chat_id, thread_id, True, "jarvis"):
-            send_message(chat_id, "✅ 已允許當前話題（Jarvis）", thread_id=thread_id)
-            log_action(user_id, "add_thread_jarvis", details=f"{chat_id}_{thread_id}")
-        else:
-            send_message(chat_id, "❌ 操作失敗", thread_id=thread_id)
-        return
-
-    if cmd == "/admin_remove_jarvis":
-        if toggle_thread(chat_id, thread_id, False, "jarvis"):
-            send_message(chat_id, "✅ 已移除話題權限（Jarvis）", thread_id=thread_id)
-            log_action(user_id, "remove_thread_jarvis", details=f"{chat_id}_{thread_id}")
-        else:
-            send_message(chat_id, "❌ 此話題未被允許（Jarvis）", thread_id=thread_id)
-        return
-
-    if cmd == "/admin_add_sparksign":
-        if toggle_thread(chat_id, thread_id, True, "sparksign"):
-            send_message(chat_id, "✅ 已允許當前話題（SparkSign）", thread_id=thread_id)
-            log_action(user_id, "add_thread_sparksign", details=f"{chat_id}_{thread_id}")
-        else:
-            send_message(chat_id, "❌ 操作失敗", thread_id=thread_id)
-        return
-
-    if cmd == "/admin_remove_sparksign":
-        if toggle_thread(chat_id, thread_id, False, "sparksign"):
-            send_message(chat_id, "✅ 已移除話題權限（SparkSign）", thread_id=thread_id)
-            log_action(user_id, "remove_thread_sparksign", details=f"{chat_id}_{thread_id}")
-        else:
-            send_message(chat_id, "❌ 此話題未被允許（SparkSign）", thread_id=thread_id)
-        return
+    thread_id = (update.get("message") or {}).get("message_thread_id", 0)
 
-    if cmd == "/admin_add_wl":
-        rep = (update.get("message") or {}).get("reply_to_message") or {}
-        target = (rep.get("from") or {}).get("id")
-        if not target:
-            send_message(
-                chat_id,
-                "❌ 白名單加入失敗\n\n"
-                "請先「回覆」目標用戶的訊息\n"
-                "再輸入：\n"
-                "• /admin_add_wl",
-                thread_id=thread_id
-            )
-            return
+    _delete_group_admin_cmd(chat_id, update)
+    dispatch("group_command", cmd, cmd, chat_id, user_id, thread_id, update)
 
-        target_name = group_user_label(int(target))
-        ok = whitelist_add(chat_id, int(target), int(user_id))
-        if ok:
-            send_message(
-                chat_id,
-                "✅ 已加入白名單\n\n"
-                f"• 用戶：{target_name}\n"
-                f"• 操作者：{admin_name}",
-                thread_id=thread_id
-            )
-            log_action(user_id, "wl_add", target=int(target), details={"chat_id": int(chat_id)})
-        else:
-            send_message(
-                chat_id,
-                "⚠️ 白名單已存在\n\n"
-                f"• 用戶：{target_name}",
-                thread_id=thread_id
-            )
-        return
 
-    if cmd == "/admin_remove_wl":
-        rep = (update.get("message") or {}).get("reply_to_message") or {}
-        target = (rep.get("from") or {}).get("id")
-        if not target:
-            send_message(
-                chat_id,
-                "❌ 白名單移除失敗\n\n"
-                "請先「回覆」目標用戶的訊息\n"
-                "再輸入：\n"
-                "• /admin_remove_wl",
-                thread_id=thread_id
-            )
-            return
+@route("group_command", "/admin_add_jarvis", "/admin_remove_jarvis", "/admin_add_sparksign", "/admin_remove_sparksign")
+def _gcmd_toggle_thread(cmd, chat_id, user_id, thread_id, update):
+    enable = cmd.startswith("/admin_add_")
+    scope = "jarvis" if cmd.endswith("_jarvis") else "sparksign"
+    label = "Jarvis" if scope == "jarvis" else "SparkSign"
+    if toggle_thread(chat_id, thread_id, enable, scope):
+        send_message(chat_id, f"✅ 已允許當前話題（{label}）" if enable else f"✅ 已移除話題權限（{label}）", thread_id=thread_id)
+        log_action(user_id, f"{'add' if enable else 'remove'}_thread_{scope}", details=f"{chat_id}_{thread_id}")
+    else:
+        send_message(chat_id, "❌ 操作失敗" if enable else f"❌ 此話題未被允許（{label}）", thread_id=thread_id)
 
-        target_name = group_user_label(int(target))
-        ok = whitelist_remove(chat_id, int(target))
-        if ok:
-            send_message(
-                chat_id,
-                "✅ 已移除白名單\n\n"
-                f"• 用戶：{target_name}\n"
-                f"• 操作者：{admin_name}",
-                thread_id=thread_id
-            )
-            log_action(user_id, "wl_remove", target=int(target), details={"chat_id": int(chat_id)})
-        else:
-            send_message(
-                chat_id,
-                "⚠️ 白名單不存在\n\n"
-                f"• 用戶：{target_name}",
-                thread_id=thread_id
-            )
+
+@route("group_command", "/admin_add_wl", "/admin_remove_wl")
+def _gcmd_whitelist(cmd, chat_id, user_id, thread_id, update):
+    adding = cmd == "/admin_add_wl"
+    rep = (update.get("message") or {}).get("reply_to_message") or {}
+    target = (rep.get("from") or {}).get("id")
+    if not target:
+        send_message(
+            chat_id,
+            f"❌ 白名單{'加入' if adding else '移除'}失敗\n\n"
+            "請先「回覆」目標用戶的訊息\n"
+            "再輸入：\n"
+            f"• {cmd}",
+            thread_id=thread_id
+        )
         return
 
+    admin_name = group_user_label(user_id)
+    target_name = group_user_label(int(target))
+    ok = whitelist_add(chat_id, int(target), int(user_id)) if adding else whitelist_remove(chat_id, int(target))
+    if ok:
+        send_message(
+            chat_id,
+            f"✅ 已{'加入' if adding else '移除'}白名單\n\n"
+            f"• 用戶：{target_name}\n"
+            f"• 操作者：{admin_name}",
+            thread_id=thread_id
+        )
+        log_action(user_id, "wl_add" if adding else "wl_remove", target=int(target), details={"chat_id": int(chat_id)})
+    else:
+        send_message(
+            chat_id,
+            f"⚠️ 白名單{'已存在' if adding else '不存在'}\n\n"
+            f"• 用戶：{target_name}",
+            thread_id=thread_id
+        )
+
 
 def handle_user_command(text, chat_id, is_private, update=None):
     clean_text = text.split("@")[0] if "@" in text else text
+    if not clean_text.startswith("/"):
+        return
 
     thread_id = None
     if not is_private and update and "message" in update:
         thread_id = update["message"].get("message_thread_id", 0)
 
-    if clean_text == "/start":
-        send_message(chat_id, "🤖 歡迎使用 10K DOG - Jarvis", main_menu(), thread_id)
-    elif clean_text == "/help":
-        send_message(chat_id, HELP_TEXT, None, thread_id)
-    elif clean_text.startswith("/"):
-        cmd = clean_text[1:].lower().split(" ")[0]
-        if cmd in COMMANDS:
-            send_command_response(chat_id, COMMANDS[cmd], thread_id)
+    # /start、/help 只認完全相同的文字（帶參數的 deep link 不回覆）；其餘指令取第一個字、不分大小寫
+    if dispatch("command", clean_text, chat_id, thread_id):
+        return
+    cmd = clean_text[1:].lower().split(" ")[0]
+    if cmd in COMMANDS:
+        send_static_reply(chat_id, cmd, thread_id, inline=True)
+
+
+@route("command", "/start")
+def _cmd_start(chat_id, thread_id):
+    send_static_reply(chat_id, "/start", thread_id, inline=True)
+
+
+@route("command", "/help")
+def _cmd_help(chat_id, thread_id):
+    send_static_reply(chat_id, "help", thread_id, inline=True)
 
 
 def handle_callback(data_cb, chat_id, user_id, message_thread_id=None):
@@ -1703,12 +4552,8 @@ def handle_callback(data_cb, chat_id, user_id, message_thread_id=None):
             send_message(chat_id, "❌ 此話題未啟用 Jarvis 功能", None, message_thread_id)
             return
 
-        if data_cb in COMMANDS:
-            send_command_response(chat_id, COMMANDS[data_cb], message_thread_id)
-        elif data_cb == "help":
-            send_message(chat_id, HELP_TEXT, None, message_thread_id)
-        elif data_cb == "main_menu":
-            send_message(chat_id, "🤖 10K DOG - Jarvis", main_menu(), message_thread_id)
+        if data_cb in COMMANDS or data_cb in ("help", "main_menu"):
+            send_static_reply(chat_id, data_cb, message_thread_id, inline=True)
         return
 
     # Private callbacks: admin-only
@@ -1721,263 +4566,432 @@ def handle_callback(data_cb, chat_id, user_id, message_thread_id=None):
     if not mid:
         return
 
-    # navigation
-    if data_cb == "p_main":
-        clear_wait(int(user_id))
-        release_setting_lock(int(user_id))
-        send_or_edit_panel(chat_id, mid, "👑 Jarvis 管理員控制面板", admin_main_panel())
-        return
+    dispatch("callback", data_cb, chat_id, int(user_id), mid, data_cb)
 
-    if data_cb == "p_admin":
-        clear_wait(int(user_id))
-        release_setting_lock(int(user_id))
-        send_or_edit_panel(chat_id, mid, "👑 管理員設定", admin_admin_panel(int(user_id)))
-        return
 
-    if data_cb == "p_group":
-        clear_wait(int(user_id))
-        release_setting_lock(int(user_id))
-        send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(int(user_id)))
+def _begin_input(chat_id, user_id: int, waiting: str, return_panel: str, prompt: str):
+    if not try_acquire_setting_lock(user_id):
+        holder = ACTIVE_SETTING["user_id"]
+        send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
         return
+    refresh_setting_lock(user_id)
+    set_wait(user_id, waiting, return_panel)
+    send_message(chat_id, prompt)
 
-    if data_cb == "p_premium":
-        send_message(chat_id, "請直接傳送一個 Telegram Premium Emoji 給我，我會回覆它的 custom_emoji_id（純 ID）。\n注意：一般 emoji 不會有 ID。")
-        return
 
-    # submenu: logs
-    if data_cb == "p_logs":
-        logs = (get_logs() or [])[-12:]
-        if not logs:
-            show_subpanel(chat_id, mid, "📊 操作紀錄", "目前沒有操作紀錄", "p_main")
-        else:
-            msg = "📊 最近操作紀錄：\n\n"
-            for log in reversed(logs):
-                try:
-                    t = datetime.datetime.fromisoformat(log["timestamp"]).strftime("%m/%d %H:%M")
-                except:
-                    t = log.get("timestamp", "")
-                admin_name = log.get("admin_name", log.get("admin_id"))
-                action = log.get("action")
-                details = log.get("details")
-                line = f"⏰ {t} | 👤 {admin_name} | {action}"
-                if details:
-                    line += f" | {details}"
-                msg += line + "\n"
-            show_subpanel(chat_id, mid, "📊 操作紀錄", msg, "p_main")
-        return
+# ---- navigation ----
+_NAV_PANELS = {
+    "p_main": ("👑 Jarvis 管理員控制面板", lambda uid: admin_main_panel()),
+    "p_admin": ("👑 管理員設定", admin_admin_panel),
+    "p_group": ("🛠️ 群組設定", admin_group_panel),
+}
 
-    # ---- Admin Settings actions ----
-    if data_cb == "a_list":
-        show_subpanel(chat_id, mid, "👥 管理員列表", get_admin_list_with_names(), "p_admin")
-        return
 
-    if data_cb == "a_query_uid":
-        send_message(chat_id, "🔍 請轉發用戶訊息給我查詢 UID")
-        return
+@route("callback", *_NAV_PANELS)
+def _cb_nav(chat_id, user_id, mid, data_cb):
+    clear_wait(user_id)
+    release_setting_lock(user_id)
+    title, build = _NAV_PANELS[data_cb]
+    send_or_edit_panel(chat_id, mid, title, build(user_id))
 
-    if data_cb == "a_add":
-        if not is_super_admin(int(user_id)):
-            send_message(chat_id, "❌ 只有超級管理員可以新增管理員")
-            return
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "admin_add_uid", "p_admin")
-        send_message(chat_id, "➕ 請直接輸入要新增的用戶 UID 數字")
-        return
 
-    if data_cb == "a_remove":
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "admin_remove_uid", "p_admin")
-        send_message(chat_id, "❌ 請直接輸入要移除的用戶 UID 數字")
-        return
+@route("callback", "p_premium")
+def _cb_premium(chat_id, user_id, mid, data_cb):
+    send_message(chat_id, "請直接傳送一個 Telegram Premium Emoji 給我，我會回覆它的 custom_emoji_id（純 ID）。\n注意：一般 emoji 不會有 ID。")
 
-    # ---- Group Settings actions ----
-    if data_cb == "g_chat_select":
-        send_or_edit_panel(chat_id, mid, "🏷️ 選擇群組", chat_select_panel(int(user_id)))
-        return
 
-    if data_cb.startswith("g_chat_set:"):
+# submenu: logs
+@route("callback", "p_logs")
+def _cb_logs(chat_id, user_id, mid, data_cb):
+    logs = (get_logs() or [])[-12:]
+    if not logs:
+        show_subpanel(chat_id, mid, "📊 操作紀錄", "目前沒有操作紀錄", "p_main")
+        return
+    msg = "📊 最近操作紀錄：\n\n"
+    for log in reversed(logs):
         try:
-            cid = int(data_cb.split(":", 1)[1])
-            _get_sess(int(user_id))["active_chat_id"] = cid
-            send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(int(user_id)))
+            t = datetime.datetime.fromisoformat(log["timestamp"]).strftime("%m/%d %H:%M")
         except:
-            pass
-        return
+            t = log.get("timestamp", "")
+        admin_name = log.get("admin_name", log.get("admin_id"))
+        action = log.get("action")
+        details = log.get("details")
+        line = f"⏰ {t} | 👤 {admin_name} | {action}"
+        if details:
+            line += f" | {details}"
+        msg += line + "\n"
+    show_subpanel(chat_id, mid, "📊 操作紀錄", msg, "p_main")
 
-    if data_cb == "g_toggle_link":
-        cid = _get_active_chat_id(int(user_id))
-        if not cid:
-            send_message(chat_id, "❌ 尚未選擇群組")
-            return
-        conf = get_link_settings(cid)
-        conf["enabled"] = not bool(conf.get("enabled", True))
-        set_link_settings(cid, conf)
-        log_action(int(user_id), "link_toggle_enabled", details={"chat_id": cid, "enabled": conf["enabled"]})
-        send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(int(user_id)))
-        return
 
-    if data_cb == "g_toggle_third":
-        cid = _get_active_chat_id(int(user_id))
-        if not cid:
-            send_message(chat_id, "❌ 尚未選擇群組")
-            return
-        conf = get_link_settings(cid)
-        conf["third_action"] = "ban" if conf.get("third_action") == "kick" else "kick"
-        set_link_settings(cid, conf)
-        log_action(int(user_id), "link_toggle_third", details={"chat_id": cid, "third_action": conf["third_action"]})
-        send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(int(user_id)))
-        return
+# ---- Admin Settings actions ----
+@route("callback", "a_list")
+def _cb_admin_list(chat_id, user_id, mid, data_cb):
+    show_subpanel(chat_id, mid, "👥 管理員列表", get_admin_list_with_names(), "p_admin")
 
-    if data_cb == "g_set_mute_days":
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "mute_days", "p_group")
-        send_message(chat_id, "🔇 請輸入「第二次違規」禁言天數（整數，例如 1 / 3 / 7）")
-        return
 
-    if data_cb == "g_wl_list":
-        cid = _get_active_chat_id(int(user_id))
-        if not cid:
-            show_subpanel(chat_id, mid, "✅ 白名單列表", "❌ 尚未選擇群組", "p_group")
-            return
-        show_subpanel(chat_id, mid, "✅ 白名單列表", whitelist_text(cid), "p_group")
-        return
+@route("callback", "a_query_uid")
+def _cb_query_uid(chat_id, user_id, mid, data_cb):
+    send_message(chat_id, "🔍 請轉發用戶訊息給我查詢 UID")
 
-    if data_cb == "g_vio_list":
-        cid = _get_active_chat_id(int(user_id))
-        if not cid:
-            show_subpanel(chat_id, mid, "📌 違規名單列表", "❌ 尚未選擇群組", "p_group")
-            return
-        show_subpanel(chat_id, mid, "📌 違規名單列表", list_violations_text(cid), "p_group")
-        return
 
-    if data_cb == "g_vio_remove":
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "vio_remove_uid", "p_group")
-        send_message(chat_id, "🧹 請輸入要從違規名單移除的 UID（數字）")
+@route("callback", "a_add")
+def _cb_admin_add(chat_id, user_id, mid, data_cb):
+    if not is_super_admin(user_id):
+        send_message(chat_id, "❌ 只有超級管理員可以新增管理員")
         return
+    _begin_input(chat_id, user_id, "admin_add_uid", "p_admin", "➕ 請直接輸入要新增的用戶 UID 數字")
+
+
+# callback -> (waiting state, return panel, prompt)
+_INPUT_PROMPTS = {
+    "a_remove": ("admin_remove_uid", "p_admin", "❌ 請直接輸入要移除的用戶 UID 數字"),
+    "g_set_flood": ("flood_limit", "p_group", "⏱️ 請輸入洗版門檻：每人訊息數/秒數[/全群訊息數]（例如 8/10 或 8/10/60）"),
+    "g_set_mute_days": ("mute_days", "p_group", "🔇 請輸入「第二次違規」禁言天數（整數，例如 1 / 3 / 7）"),
+    "g_vio_remove": ("vio_remove_uid", "p_group", "🧹 請輸入要從違規名單移除的 UID（數字）"),
+    "g_wl_add": ("wl_add_uid", "p_group", "➕ 請輸入要加入白名單的 UID（數字）"),
+    "g_wl_remove": ("wl_remove_uid", "p_group", "❌ 請輸入要移除白名單的 UID（數字）"),
+    "g_dom_allow": ("dom_allow", "p_group", "✅ 請輸入要允許的網域（例如 example.com 或 t.me/channel，多個可用換行或逗號分隔）"),
+    "g_dom_deny": ("dom_deny", "p_group", "⛔ 請輸入要封鎖的網域（例如 example.com，多個可用換行或逗號分隔）"),
+    "g_dom_remove": ("dom_remove", "p_group", "🗑️ 請輸入要移除的網域規則（多個可用換行或逗號分隔）"),
+    "g_kw_add": ("kw_add", "p_group", "➕ 請輸入要加入的廣告關鍵字（多個可用換行或逗號分隔）"),
+    "g_kw_remove": ("kw_remove", "p_group", "➖ 請輸入要移除的廣告關鍵字（多個可用換行或逗號分隔）"),
+}
 
-    if data_cb == "g_wl_add":
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "wl_add_uid", "p_group")
-        send_message(chat_id, "➕ 請輸入要加入白名單的 UID（數字）")
-        return
 
-    if data_cb == "g_wl_remove":
-        if not try_acquire_setting_lock(int(user_id)):
-            holder = ACTIVE_SETTING["user_id"]
-            send_message(chat_id, f"⛔ 目前有其他管理員正在設定（UID: {holder}），請稍後再試。")
-            return
-        refresh_setting_lock(int(user_id))
-        set_wait(int(user_id), "wl_remove_uid", "p_group")
-        send_message(chat_id, "❌ 請輸入要移除白名單的 UID（數字）")
+@route("callback", *_INPUT_PROMPTS)
+def _cb_begin_input(chat_id, user_id, mid, data_cb):
+    waiting, back, prompt = _INPUT_PROMPTS[data_cb]
+    _begin_input(chat_id, user_id, waiting, back, prompt)
+
+
+# ---- Group Settings actions ----
+@route("callback", "g_chat_select")
+def _cb_chat_select(chat_id, user_id, mid, data_cb):
+    send_or_edit_panel(chat_id, mid, "🏷️ 選擇群組", chat_select_panel(user_id))
+
+
+@route("callback_prefix", "g_chat_set:")
+def _cb_chat_set(chat_id, user_id, mid, data_cb):
+    try:
+        cid = int(data_cb.split(":", 1)[1])
+        _get_sess(user_id)["active_chat_id"] = cid
+        send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(user_id))
+    except:
+        pass
+
+
+# callback -> (link_settings field, flip, log action)
+_LINK_TOGGLES = {
+    "g_toggle_link": ("enabled", lambda v: not bool(v), "link_toggle_enabled"),
+    "g_toggle_third": ("third_action", lambda v: "ban" if v == "kick" else "kick", "link_toggle_third"),
+    "g_toggle_flood": ("flood_enabled", lambda v: not bool(v), "link_toggle_flood"),
+    "g_toggle_dup": ("dup_enabled", lambda v: not bool(v), "link_toggle_dup"),
+}
+
+
+@route("callback", *_LINK_TOGGLES)
+def _cb_link_toggle(chat_id, user_id, mid, data_cb):
+    cid = _get_active_chat_id(user_id)
+    if not cid:
+        send_message(chat_id, "❌ 尚未選擇群組")
         return
+    field, flip, action = _LINK_TOGGLES[data_cb]
+    conf = get_link_settings(cid)
+    conf[field] = flip(conf.get(field))
+    set_link_settings(cid, conf)
+    log_action(user_id, action, details={"chat_id": cid, field: conf[field]})
+    send_or_edit_panel(chat_id, mid, "🛠️ 群組設定", admin_group_panel(user_id))
+
+
+# callback -> (subpanel title, body(chat_id))
+_CHAT_SUBPANELS = {
+    "g_wl_list": ("✅ 白名單列表", whitelist_text),
+    "g_vio_list": ("📌 違規名單列表", list_violations_text),
+    "g_dom_list": ("🌐 網域規則", link_domains_text),
+    "g_kw_list": ("🚫 廣告關鍵字", ad_keywords_text),
+}
+
+
+@route("callback", *_CHAT_SUBPANELS)
+def _cb_chat_subpanel(chat_id, user_id, mid, data_cb):
+    title, body = _CHAT_SUBPANELS[data_cb]
+    cid = _get_active_chat_id(user_id)
+    show_subpanel(chat_id, mid, title, body(cid) if cid else "❌ 尚未選擇群組", "p_group")
 
+
+@route("callback", "g_threads_jarvis", "g_threads_sparksign")
+def _cb_threads(chat_id, user_id, mid, data_cb):
     if data_cb == "g_threads_jarvis":
         show_subpanel(chat_id, mid, "📋 Jarvis 話題列表", get_thread_list_with_names("jarvis"), "p_group")
-        return
-
-    if data_cb == "g_threads_sparksign":
+    else:
         show_subpanel(chat_id, mid, "✨ SparkSign 話題列表", get_thread_list_with_names("sparksign"), "p_group")
-        return
 
-    if data_cb == "g_help":
-        show_subpanel(
-            chat_id,
-            mid,
-            "🛠️ 群組指令說明",
-            "🛠️ 群組話題授權（只透過 Jarvis 操作）：\n"
-            "/admin_add_jarvis - 允許當前話題（Jarvis）\n"
-            "/admin_remove_jarvis - 移除當前話題（Jarvis）\n\n"
-            "✨ SparkSign 話題授權（仍由 Jarvis 操作）：\n"
-            "/admin_add_sparksign - 允許當前話題（SparkSign）\n"
-            "/admin_remove_sparksign - 移除當前話題（SparkSign）\n\n"
-            "🔗 白名單（群組內由管理員使用，需回覆目標用戶訊息）：\n"
-            "/admin_add_wl - 加入白名單\n"
-            "/admin_remove_wl - 移除白名單\n",
-            "p_group"
-        )
-        return
 
-    if data_cb.startswith("copy_"):
-        send_message(chat_id, data_cb.replace("copy_", ""))
+@route("callback", "g_help")
+def _cb_group_help(chat_id, user_id, mid, data_cb):
+    show_subpanel(
+        chat_id,
+        mid,
+        "🛠️ 群組指令說明",
+        "🛠️ 群組話題授權（只透過 Jarvis 操作）：\n"
+        "/admin_add_jarvis - 允許當前話題（Jarvis）\n"
+        "/admin_remove_jarvis - 移除當前話題（Jarvis）\n\n"
+        "✨ SparkSign 話題授權（仍由 Jarvis 操作）：\n"
+        "/admin_add_sparksign - 允許當前話題（SparkSign）\n"
+        "/admin_remove_sparksign - 移除當前話題（SparkSign）\n\n"
+        "🔗 白名單（群組內由管理員使用，需回覆目標用戶訊息）：\n"
+        "/admin_add_wl - 加入白名單\n"
+        "/admin_remove_wl - 移除白名單\n",
+        "p_group"
+    )
+
+
+# ---- UID query buttons ----
+@route("callback_prefix", "copy_")
+def _cb_copy(chat_id, user_id, mid, data_cb):
+    send_message(chat_id, data_cb.replace("copy_", ""))
+
+
+@route("callback_prefix", "add_")
+def _cb_add_admin(chat_id, user_id, mid, data_cb):
+    if not is_super_admin(user_id):
         return
+    try:
+        uid = int(data_cb.replace("add_", ""))
+        ok = add_admin(uid, user_id)
+        send_message(chat_id, f"✅ 已新增用戶 {uid} 為管理員" if ok else f"❌ 用戶 {uid} 已經是管理員")
+        if ok:
+            log_action(user_id, "add_admin", uid)
+    except:
+        send_message(chat_id, "❌ 操作失敗")
 
-    if data_cb.startswith("add_") and is_super_admin(user_id):
-        try:
-            uid = int(data_cb.replace("add_", ""))
+
+@route("callback_prefix", "wladd_", "wlrm_")
+def _cb_whitelist_uid(chat_id, user_id, mid, data_cb):
+    adding = data_cb.startswith("wladd_")
+    try:
+        uid = int(data_cb.split("_", 1)[1])
+        cid = _get_active_chat_id(user_id)
+        if not cid:
+            send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
+            return
+        if adding:
+            ok = whitelist_add(cid, uid, user_id)
+            send_message(chat_id, "✅ 已加入白名單" if ok else "⚠️ 白名單已存在")
+        else:
+            ok = whitelist_remove(cid, uid)
+            send_message(chat_id, "✅ 已移除白名單" if ok else "⚠️ 白名單不存在")
+        if ok:
+            log_action(user_id, "wl_add" if adding else "wl_remove", target=uid, details={"chat_id": cid, "src": "uid_query_button"})
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 操作失敗")
+
+
+# ---- waiting_for 輸入處理（呼叫後一律 clear_wait + release lock）----
+def _input_chat_id(chat_id, user_id: int):
+    cid = _get_active_chat_id(user_id)
+    if not cid:
+        send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
+    return cid
+
+
+@route("waiting", "admin_add_uid")
+def _wait_admin_add(chat_id, user_id, raw, waiting):
+    try:
+        uid = int(raw)
+        if not is_super_admin(user_id):
+            send_message(chat_id, "❌ 只有超級管理員可以新增管理員")
+        else:
             ok = add_admin(uid, user_id)
-            send_message(chat_id, f"✅ 已新增用戶 {uid} 為管理員" if ok else f"❌ 用戶 {uid} 已經是管理員")
+            send_message(chat_id, f"✅ 已新增管理員: {uid}" if ok else f"⚠️ 用戶 {uid} 已經是管理員")
             if ok:
-                log_action(user_id, "add_admin", uid)
-        except:
-            send_message(chat_id, "❌ 操作失敗")
+                log_action(user_id, "add_admin", target=uid)
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 請輸入有效的 UID 數字")
+
+
+@route("waiting", "admin_remove_uid")
+def _wait_admin_remove(chat_id, user_id, raw, waiting):
+    try:
+        uid = int(raw)
+        ok, msg2 = remove_admin(uid, user_id)
+        send_message(chat_id, msg2)
+        if ok:
+            log_action(user_id, "remove_admin", target=uid)
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 請輸入有效的 UID 數字")
+
+
+@route("waiting", "mute_days")
+def _wait_mute_days(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
         return
+    try:
+        days = int(float(raw))
+        if days < 1:
+            days = 1
+        conf = get_link_settings(cid)
+        conf["mute_days"] = days
+        set_link_settings(cid, conf)
+        log_action(user_id, "link_set_mute_days", details={"chat_id": cid, "mute_days": days})
+        send_message(chat_id, f"✅ 已設定第二次違規禁言：{days} 天")
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 請輸入整數天數（例如 1 / 3 / 7）")
 
-    if data_cb.startswith("wladd_"):
-        try:
-            uid = int(data_cb.replace("wladd_", ""))
-            cid = _get_active_chat_id(int(user_id))
-            if not cid:
-                send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                return
-            ok = whitelist_add(cid, uid, int(user_id))
-            send_message(chat_id, "✅ 已加入白名單" if ok else "⚠️ 白名單已存在")
-            if ok:
-                log_action(int(user_id), "wl_add", target=uid, details={"chat_id": cid, "src": "uid_query_button"})
-            try_flush_dirty(force=True)
-        except:
-            send_message(chat_id, "❌ 操作失敗")
+
+@route("waiting", "flood_limit")
+def _wait_flood_limit(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
+        return
+    try:
+        parts = [int(float(p)) for p in re.split(r"[/\s,]+", raw) if p]
+        if len(parts) not in (2, 3):
+            raise ValueError(raw)
+        conf = get_link_settings(cid)
+        conf["flood_user_max"], conf["flood_window_sec"] = parts[0], parts[1]
+        if len(parts) == 3:
+            conf["flood_chat_max"] = parts[2]
+        set_link_settings(cid, conf)
+        conf = get_link_settings(cid)
+        log_action(user_id, "link_set_flood", details={
+            "chat_id": cid,
+            "flood_user_max": conf["flood_user_max"],
+            "flood_window_sec": conf["flood_window_sec"],
+            "flood_chat_max": conf["flood_chat_max"],
+        })
+        send_message(chat_id, f"✅ 已設定洗版門檻：{conf['flood_user_max']} 則 / {conf['flood_window_sec']} 秒（全群 {conf['flood_chat_max']} 則）")
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 格式錯誤，請輸入例如 8/10 或 8/10/60")
+
+
+@route("waiting", "vio_remove_uid")
+def _wait_vio_remove(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
         return
+    try:
+        uid = int(raw)
+        ok = clear_violation(cid, uid)
+        send_message(chat_id, "✅ 已移除違規名單" if ok else "⚠️ 找不到此 UID 的違規紀錄")
+        if ok:
+            log_action(user_id, "vio_remove", target=uid, details={"chat_id": cid})
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 請輸入有效的 UID 數字")
 
-    if data_cb.startswith("wlrm_"):
-        try:
-            uid = int(data_cb.replace("wlrm_", ""))
-            cid = _get_active_chat_id(int(user_id))
-            if not cid:
-                send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                return
+
+@route("waiting", "wl_add_uid", "wl_remove_uid")
+def _wait_whitelist(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
+        return
+    adding = waiting == "wl_add_uid"
+    try:
+        uid = int(raw)
+        if adding:
+            ok = whitelist_add(cid, uid, user_id)
+            send_message(chat_id, "✅ 已加入白名單" if ok else "⚠️ 白名單已存在")
+        else:
             ok = whitelist_remove(cid, uid)
             send_message(chat_id, "✅ 已移除白名單" if ok else "⚠️ 白名單不存在")
-            if ok:
-                log_action(int(user_id), "wl_remove", target=uid, details={"chat_id": cid, "src": "uid_query_button"})
-            try_flush_dirty(force=True)
-        except:
-            send_message(chat_id, "❌ 操作失敗")
+        if ok:
+            log_action(user_id, "wl_add" if adding else "wl_remove", target=uid, details={"chat_id": cid, "src": "panel_input"})
+        request_flush(force=True)
+    except:
+        send_message(chat_id, "❌ 請輸入有效的 UID 數字")
+
+
+@route("waiting", "dom_allow", "dom_deny", "dom_remove")
+def _wait_domains(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
         return
+    rules = [r.strip() for r in re.split(r"[\s,，]+", raw) if r.strip()]
+    if waiting == "dom_remove":
+        done = [normalize_domain_rule(r) for r in rules if link_domain_remove(cid, r)]
+        send_message(chat_id, f"✅ 已移除網域規則：{'、'.join(done)}" if done else "⚠️ 找不到此網域規則")
+    else:
+        verdict = "allow" if waiting == "dom_allow" else "deny"
+        done = [d for d in (link_domain_set(cid, r, verdict, user_id) for r in rules) if d]
+        label = "允許" if verdict == "allow" else "封鎖"
+        send_message(chat_id, f"✅ 已{label}網域：{'、'.join(done)}" if done else "❌ 請輸入有效的網域")
+    if done:
+        log_action(user_id, f"link_{waiting}", details={"chat_id": cid, "rules": done})
+        request_flush(force=True)
+
+
+@route("waiting", "kw_add", "kw_remove")
+def _wait_keywords(chat_id, user_id, raw, waiting):
+    cid = _input_chat_id(chat_id, user_id)
+    if not cid:
+        return
+    kws = [k.strip() for k in re.split(r"[\n,，]+", raw) if k.strip()]
+    if waiting == "kw_add":
+        done = [k for k in kws if ad_keyword_add(cid, k, user_id)]
+        send_message(chat_id, f"✅ 已加入廣告關鍵字：{'、'.join(done)}" if done else "⚠️ 關鍵字已存在或無效")
+        action = "ad_kw_add"
+    else:
+        done = [k for k in kws if ad_keyword_remove(cid, k)]
+        send_message(chat_id, f"✅ 已移除廣告關鍵字：{'、'.join(done)}" if done else "⚠️ 找不到此關鍵字")
+        action = "ad_kw_remove"
+    if done:
+        log_action(user_id, action, details={"chat_id": cid, "keywords": done})
+        request_flush(force=True)
 
 
 # ================== Routes ==================
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    g.inline_reply = None
+    g.inline_open = True
+    update = request.get_json(force=True, silent=True) or {}
+    process_update(update)
+    g.inline_open = False
+
+    reply = getattr(g, "inline_reply", None)
+    if reply:
+        body = reply if isinstance(reply, bytes) else json.dumps(reply, ensure_ascii=False)
+        return app.response_class(body, mimetype="application/json")
+    return "OK"
+
+
+_UPDATE_TYPES = ("message", "edited_message", "callback_query", "chat_member", "my_chat_member")
+_METRIC_CTX = threading.local()
+
+
+def _branch(name: str):
+    _METRIC_CTX.branch = name
+
+
+def process_update(update: dict):
+    t0 = _now()
+    _branch("ignored")
     try:
-        # 1) 先把到期的 dirty 合併寫回（不阻塞）
-        try_flush_dirty(force=False)
+        return _process_update(update)
+    finally:
+        utype = next((k for k in _UPDATE_TYPES if k in update), "other")
+        hist_observe("jarvis_webhook_duration_seconds", _now() - t0, "Webhook update handling latency",
+                     update_type=utype, branch=getattr(_METRIC_CTX, "branch", "ignored"))
 
-        update = request.get_json(force=True, silent=True) or {}
 
+def _process_update(update: dict):
+    if not first_delivery(update):
+        _branch("duplicate")
+        return "OK"
+    try:
         # Callback query
         if "callback_query" in update:
+            _branch("callback")
             cb = update["callback_query"]
+            remember_user(cb.get("from"))
+            remember_chat((cb.get("message") or {}).get("chat"))
             data_cb = cb["data"]
             chat_id = cb["message"]["chat"]["id"]
             user_id = cb["from"]["id"]
@@ -1991,13 +5005,24 @@ def webhook():
 
             thread_id = None if is_private else cb["message"].get("message_thread_id", 0)
             handle_callback(data_cb, chat_id, user_id, thread_id)
-            answer_callback(cb["id"])
+            answer_callback(cb["id"], chat_id, inline=True)
+            return "OK"
+
+        # Membership changes: keep the admin roster current
+        if "chat_member" in update or "my_chat_member" in update:
+            _branch("chat_member")
+            own = "my_chat_member" in update
+            apply_chat_member_update(update["my_chat_member" if own else "chat_member"], own=own)
             return "OK"
 
         # Messages (包含 edited_message)
         msg_key = "message" if "message" in update else ("edited_message" if "edited_message" in update else None)
         if msg_key:
             msg = update[msg_key]
+            remember_user(msg.get("from"))
+            remember_user((msg.get("reply_to_message") or {}).get("from"))
+            remember_chat(msg.get("chat"))
+            remember_topics(msg)
             chat_id = msg["chat"]["id"]
             user_id = (msg.get("from") or {}).get("id")
             is_private = not str(chat_id).startswith("-100")
@@ -2007,17 +5032,21 @@ def webhook():
             if not is_private:
                 handled = apply_link_moderation(msg)
                 if handled:
+                    _branch("moderation")
                     return "OK"
+                _branch("group_chatter")
 
             # Premium Emoji ID
             if is_private and user_id and is_admin(int(user_id)):
                 if handle_premium_emoji_id_message(msg, chat_id):
+                    _branch("premium_emoji")
                     return "OK"
 
             # Private admin panel input flow
             if is_private and user_id and is_admin(int(user_id)):
                 # (A) 轉發查 UID（避免跟指令衝突）
                 if ("forward_from" in msg) and (not (text or "").strip().startswith("/")):
+                    _branch("uid_query")
                     handle_uid_query(update, chat_id)
                     return "OK"
 
@@ -2026,6 +5055,7 @@ def webhook():
                 waiting = s.get("waiting_for")
 
                 if waiting:
+                    _branch("admin_input")
                     refresh_setting_lock(int(user_id))
 
                     raw = (text or "").strip()
@@ -2037,148 +5067,41 @@ def webhook():
                         send_message(chat_id, "✅ 已取消本次設定。")
                         return "OK"
 
-                    # ---- 各種等待狀態處理 ----
-                    if waiting == "admin_add_uid":
-                        try:
-                            uid = int(raw)
-                            if not is_super_admin(int(user_id)):
-                                send_message(chat_id, "❌ 只有超級管理員可以新增管理員")
-                            else:
-                                ok = add_admin(uid, int(user_id))
-                                send_message(chat_id, f"✅ 已新增管理員: {uid}" if ok else f"⚠️ 用戶 {uid} 已經是管理員")
-                                if ok:
-                                    log_action(int(user_id), "add_admin", target=uid)
-                            try_flush_dirty(force=True)
-                        except:
-                            send_message(chat_id, "❌ 請輸入有效的 UID 數字")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    if waiting == "admin_remove_uid":
-                        try:
-                            uid = int(raw)
-                            ok, msg2 = remove_admin(uid, int(user_id))
-                            send_message(chat_id, msg2)
-                            if ok:
-                                log_action(int(user_id), "remove_admin", target=uid)
-                            try_flush_dirty(force=True)
-                        except:
-                            send_message(chat_id, "❌ 請輸入有效的 UID 數字")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    if waiting == "mute_days":
-                        cid = _get_active_chat_id(int(user_id))
-                        if not cid:
-                            send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                        else:
-                            try:
-                                days = int(float(raw))
-                                if days < 1:
-                                    days = 1
-                                conf = get_link_settings(cid)
-                                conf["mute_days"] = days
-                                set_link_settings(cid, conf)
-                                log_action(int(user_id), "link_set_mute_days", details={"chat_id": cid, "mute_days": days})
-                                send_message(chat_id, f"✅ 已設定第二次違規禁言：{days} 天")
-                                try_flush_dirty(force=True)
-                            except:
-                                send_message(chat_id, "❌ 請輸入整數天數（例如 1 / 3 / 7）")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    if waiting == "vio_remove_uid":
-                        cid = _get_active_chat_id(int(user_id))
-                        if not cid:
-                            send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                        else:
-                            try:
-                                uid = int(raw)
-                                ok = clear_violation(cid, uid)
-                                send_message(chat_id, "✅ 已移除違規名單" if ok else "⚠️ 找不到此 UID 的違規紀錄")
-                                if ok:
-                                    log_action(int(user_id), "vio_remove", target=uid, details={"chat_id": cid})
-                                try_flush_dirty(force=True)
-                            except:
-                                send_message(chat_id, "❌ 請輸入有效的 UID 數字")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    if waiting == "wl_add_uid":
-                        cid = _get_active_chat_id(int(user_id))
-                        if not cid:
-                            send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                        else:
-                            try:
-                                uid = int(raw)
-                                ok = whitelist_add(cid, uid, int(user_id))
-                                send_message(chat_id, "✅ 已加入白名單" if ok else "⚠️ 白名單已存在")
-                                if ok:
-                                    log_action(int(user_id), "wl_add", target=uid, details={"chat_id": cid, "src": "panel_input"})
-                                try_flush_dirty(force=True)
-                            except:
-                                send_message(chat_id, "❌ 請輸入有效的 UID 數字")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    if waiting == "wl_remove_uid":
-                        cid = _get_active_chat_id(int(user_id))
-                        if not cid:
-                            send_message(chat_id, "❌ 尚未選擇群組（群組設定 → 選擇群組）")
-                        else:
-                            try:
-                                uid = int(raw)
-                                ok = whitelist_remove(cid, uid)
-                                send_message(chat_id, "✅ 已移除白名單" if ok else "⚠️ 白名單不存在")
-                                if ok:
-                                    log_action(int(user_id), "wl_remove", target=uid, details={"chat_id": cid, "src": "panel_input"})
-                                try_flush_dirty(force=True)
-                            except:
-                                send_message(chat_id, "❌ 請輸入有效的 UID 數字")
-                        clear_wait(int(user_id))
-                        release_setting_lock(int(user_id))
-                        return "OK"
-
-                    # fallback：未知等待狀態
+                    handled = dispatch("waiting", waiting, chat_id, int(user_id), raw, waiting)
                     clear_wait(int(user_id))
                     release_setting_lock(int(user_id))
-                    send_message(chat_id, "⚠️ 設定狀態已失效，請重新開啟 /admin 面板操作。")
+                    if not handled:
+                        # 未知等待狀態
+                        send_message(chat_id, "⚠️ 設定狀態已失效，請重新開啟 /admin 面板操作。")
                     return "OK"
 
             # Group admin commands
-            if (not is_private) and user_id and is_admin(int(user_id)):
-                cmd0 = normalize_cmd(text)
-                if cmd0 in (
-                    "/admin_add_jarvis", "/admin_remove_jarvis",
-                    "/admin_add_sparksign", "/admin_remove_sparksign",
-                    "/admin_add_wl", "/admin_remove_wl",
-                ):
-                    handle_group_admin(text, chat_id, int(user_id), update)
-                    try_flush_dirty(force=False)
-                    return "OK"
+            cmd = normalize_cmd(text)
+            if (not is_private) and user_id and cmd in ROUTES["group_command"] and is_admin(int(user_id)):
+                _branch("group_admin")
+                handle_group_admin(text, chat_id, int(user_id), update)
+                request_flush()
+                return "OK"
 
             # Normal user commands (只處理新訊息，不處理 edited_message)
             if msg_key == "message" and text:
+                _branch("command" if text.startswith("/") else ("private_text" if is_private else "group_chatter"))
                 if is_private and user_id and is_admin(int(user_id)):
                     # ✅ 先處理 /admin 面板
                     handle_admin_command(text, chat_id, int(user_id))
                     # 若是 /admin 就直接結束，避免落到一般指令
-                    if normalize_cmd(text) == "/admin":
-                        try_flush_dirty(force=False)
+                    if cmd == "/admin":
+                        request_flush()
                         return "OK"
             handle_user_command(text, chat_id, is_private, update)
 
-            try_flush_dirty(force=False)
+            request_flush()
             return "OK"
 
         return "OK"
 
     except Exception as e:
+        _branch("error")
         print("[WEBHOOK_ERR]", e)
         return "OK"
 
@@ -2192,15 +5115,70 @@ def health():
         "rt_ok": (RT_CACHE.get("last_err") == ""),
         "core_dirty": bool(CORE_CACHE.get("dirty")),
         "rt_dirty": bool(RT_CACHE.get("dirty")),
+        "stats": stats_snapshot(),
+        "http": http_pool_stats(),
+        "outbox_depth": outbox_depth(),
+        "caches": cache_stats(),
+        "flood": FLOOD.stats(),
+        "near_dup": DUP_INDEX.stats(),
+        "dedup": dedup_stats(),
     }
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = []
+    _prom_histograms(lines)
+    _prom_counters(lines)
+
+    now = _now()
+    sides = (("core", CORE_CACHE), ("rt", RT_CACHE))
+    _prom_gauge(lines, "jarvis_dirty_age_seconds", "Age of the oldest unflushed write (0 when clean)", [
+        ((("side", side),), round(now - float(c.get("dirty_since") or now), 3) if c.get("dirty") else 0) for side, c in sides
+    ])
+    _prom_gauge(lines, "jarvis_circuit_breaker_open", "Persistence circuit breaker open (1) / closed (0)", [
+        ((("side", side),), int(_cb_is_open(c))) for side, c in sides
+    ])
+    _prom_gauge(lines, "jarvis_circuit_breaker_failures", "Consecutive persistence failures", [
+        ((("side", side),), int(c.get("fail_count", 0) or 0)) for side, c in sides
+    ])
+
+    with _METRICS_LOCK:
+        gist = dict((HISTOGRAMS.get("jarvis_gist_request_duration_seconds") or {}).get("series") or {})
+    gets = sum(row[-1] for k, row in gist.items() if ("op", "get") in k)
+    not_mod = sum(row[-1] for k, row in gist.items() if ("op", "get") in k and ("status", "304") in k)
+    _prom_gauge(lines, "jarvis_gist_not_modified_ratio", "Share of conditional gist GETs answered 304", [
+        ((), round(not_mod / gets, 4) if gets else 0)
+    ])
+
+    st = stats_snapshot()
+
+    cstats = cache_stats()
+    _prom_gauge(lines, "jarvis_cache_hit_ratio", "In-process cache hit ratio", [
+        ((("cache", n),), v["hit_rate"]) for n, v in sorted(cstats.items())
+    ])
+    _prom_gauge(lines, "jarvis_cache_entries", "In-process cache size", [
+        ((("cache", n),), v["size"]) for n, v in sorted(cstats.items())
+    ])
+    _prom_gauge(lines, "jarvis_outbox_depth", "Queued outbound Telegram actions", [((), outbox_depth())])
+
+    counters = [((("name", k),), v) for k, v in sorted(st.items()) if isinstance(v, (int, float))]
+    lines.append("# HELP jarvis_events_total In-process event counters (stat_inc)")
+    lines.append("# TYPE jarvis_events_total counter")
+    lines.extend(f"jarvis_events_total{_prom_labels(l)} {v}" for l, v in counters)
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# chat_member is opt-in: without it admin promotions/demotions only show up after ADMIN_ROSTER_TTL
+TG_ALLOWED_UPDATES = ["message", "edited_message", "callback_query", "chat_member", "my_chat_member"]
+
+
 @app.route("/set_tg_webhook", methods=["GET"])
 def set_tg_webhook():
     host = request.headers.get("x-forwarded-host") or request.host
     scheme = request.headers.get("x-forwarded-proto") or "https"
     url = f"{scheme}://{host}/webhook"
-    r = tg("setWebhook", {"url": url}, timeout=10)
+    r = tg("setWebhook", {"url": url, "allowed_updates": TG_ALLOWED_UPDATES}, timeout=10)
     try:
         return r.json() if r is not None else {"ok": False, "url": url}
     except: